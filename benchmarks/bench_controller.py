@@ -0,0 +1,97 @@
+'''Time the ExperimentController hot paths against a local SQLite store.
+
+ - get_next_suggestion against the number of observations and the number of hyperparameters, with a
+   cold surrogate (fit from scratch) and a warm one (reused from the surrogate cache)
+ - update_design as the design grows
+ - _create_design_entry warm up generation
+
+Results are printed as json, e.g.
+
+    $ python benchmarks/bench_controller.py --quick > controller_times.json
+'''
+import json
+import argparse
+import tempfile
+import numpy as np
+from common import write_config, measure, quiet
+
+
+def make_controller(directory, num_dimensions, num_warm_up=10, name='bench'):
+    from ml_experiments.controller import ExperimentController
+    with quiet():
+        return ExperimentController(write_config(directory, num_dimensions, num_warm_up, name=name))
+
+
+def seed_design(ec, num_observations, seed=0):
+    ''' Replace the design with num_observations random observations, past the end of the warm up. '''
+    rng = np.random.default_rng(seed)
+    X_steps = rng.random((num_observations, len(ec.bounds)))
+    Y_steps = np.sum((X_steps - 0.5)**2, axis=1, keepdims=True) + 0.01 * rng.standard_normal((num_observations, 1))
+    ec.col.update_one({'_id' : ec.raster_id}, {'$set' : {'X_steps' : X_steps.tolist(),
+                                                         'Y_steps' : Y_steps.tolist(),
+                                                         'num_observations' : num_observations,
+                                                         'next_iter' : ec.num_warm_up + num_observations,
+                                                         'pending' : []}})
+    ec._in_flight = {}
+    ec._get_design()
+
+
+def bench_get_next_suggestion(directory, sizes, dimensions, repeat):
+    from ml_experiments import controller
+    results = []
+    for num_dimensions in dimensions:
+        ec = make_controller(directory, num_dimensions, name='suggest_{}'.format(num_dimensions))
+        for num_observations in sizes:
+            seed_design(ec, num_observations)
+
+            # Suggestions are marked pending, clear them so every run sees the same design
+            def reset(cold):
+                ec.col.update_one({'_id' : ec.raster_id}, {'$set' : {'pending' : []}})
+                ec._in_flight = {}
+                if cold:
+                    controller._surrogate_cache.clear()
+
+            cold = measure(ec.get_next_suggestion, repeat, setup=lambda: reset(True))
+            warm = measure(ec.get_next_suggestion, repeat, setup=lambda: reset(False))
+            results.append({'num_observations' : num_observations, 'num_dimensions' : num_dimensions,
+                            'cold' : cold, 'warm' : warm})
+    return results
+
+
+def bench_update_design(directory, sizes, repeat):
+    results = []
+    ec = make_controller(directory, 2, name='update')
+    for num_observations in sizes:
+        seed_design(ec, num_observations)
+        x_step = np.array([0.5, 0.5])
+        results.append({'num_observations' : num_observations,
+                        'seconds' : measure(lambda: ec.update_design(x_step, [0.1]), repeat)})
+    return results
+
+
+def bench_create_design_entry(directory, num_warm_ups, dimensions, repeat):
+    results = []
+    for num_dimensions in dimensions:
+        ec = make_controller(directory, num_dimensions, name='warm_up_{}'.format(num_dimensions))
+        for num_warm_up in num_warm_ups:
+            ec.num_warm_up = num_warm_up
+            results.append({'num_warm_up' : num_warm_up, 'num_dimensions' : num_dimensions,
+                            'seconds' : measure(ec._create_design_entry, repeat, setup=ec.col.drop)})
+    return results
+
+
+def run(quick=False, repeat=3):
+    sizes = [10, 50, 100] if quick else [10, 100, 500, 1000, 2000]
+    dimensions = [2, 5] if quick else [2, 5, 10]
+    with tempfile.TemporaryDirectory() as directory:
+        return {'get_next_suggestion' : bench_get_next_suggestion(directory, sizes, dimensions, repeat),
+                'update_design' : bench_update_design(directory, sizes + [10 * sizes[-1]], repeat),
+                'create_design_entry' : bench_create_design_entry(directory, [10, 100, 1000], dimensions, repeat)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Fewer and smaller designs')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per measurement')
+    args = parser.parse_args()
+    print(json.dumps(run(args.quick, args.repeat), indent=2))
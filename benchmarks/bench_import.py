@@ -0,0 +1,50 @@
+'''Time how long importing ml_experiments takes, and which heavy frameworks each import pulls in.
+
+Each import runs in a fresh interpreter. Results are printed as json, e.g.
+
+    $ python benchmarks/bench_import.py --repeat 5 > import_times.json
+'''
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Statements timed in a fresh interpreter
+IMPORTS = {'package' : 'import ml_experiments',
+           'base' : 'from ml_experiments import BaseReader',
+           'controller' : 'from ml_experiments import ExperimentController',
+           'manager' : 'from ml_experiments import ExperimentRecorder',
+           'server' : 'from ml_experiments import SuggestionClient'}
+
+HEAVY_MODULES = ['tensorflow', 'GPy', 'GPyOpt', 'pandas']
+
+SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds' : elapsed, 'heavy_modules' : [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+
+def time_import(statement, repeat):
+    ''' Time a statement in fresh interpreters, keeping the fastest run. '''
+    runs = []
+    for _ in range(repeat):
+        script = SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return {'seconds' : min(r['seconds'] for r in runs),
+            'heavy_modules' : runs[0]['heavy_modules']}
+
+
+def run(repeat=3):
+    return {name : time_import(statement, repeat) for name, statement in IMPORTS.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='Number of fresh interpreters per import')
+    args = parser.parse_args()
+    print(json.dumps(run(args.repeat), indent=2))
@@ -0,0 +1,56 @@
+'''Time the ExperimentRecorder per epoch writes against a local SQLite store, written directly and through the async writer.
+
+Results are printed as json, e.g.
+
+    $ python benchmarks/bench_recorder.py --epochs 200 > recorder_times.json
+'''
+import time
+import json
+import argparse
+import tempfile
+import statistics
+from common import write_config, quiet
+
+
+def bench_epochs(directory, num_epochs, async_recording):
+    ''' Time on_epoch_end for every epoch of one simulated training run. '''
+    from ml_experiments.manager import ExperimentRecorder
+    name = 'async' if async_recording else 'sync'
+    with quiet():
+        recorder = ExperimentRecorder(write_config(directory, name=name, async_recording=async_recording, flush_interval=1.))
+    metrics = recorder.experiment['train_metrics']
+
+    runs = []
+    with quiet():
+        for epoch in range(num_epochs):
+            logs = {}
+            for m in metrics:
+                logs[m] = 1. / (epoch + 1)
+                logs['val_' + m] = 1. / (epoch + 1)
+            recorder.on_epoch_begin(epoch)
+            start = time.perf_counter()
+            recorder.on_epoch_end(epoch, logs)
+            runs.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        recorder.on_train_end()
+        train_end = time.perf_counter() - start
+
+    return {'num_epochs' : num_epochs,
+            'epoch_min' : min(runs),
+            'epoch_median' : statistics.median(runs),
+            'epoch_total' : sum(runs),
+            'train_end' : train_end}
+
+
+def run(num_epochs=100):
+    with tempfile.TemporaryDirectory() as directory:
+        return {'on_epoch_end' : bench_epochs(directory, num_epochs, async_recording=False),
+                'on_epoch_end_async' : bench_epochs(directory, num_epochs, async_recording=True)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--epochs', type=int, default=100, help='Number of epochs to record')
+    args = parser.parse_args()
+    print(json.dumps(run(args.epochs), indent=2))
@@ -0,0 +1,85 @@
+'''Helpers shared by the benchmarks: timing, and experiment configs backed by a local SQLite store.'''
+import io
+import os
+import time
+import yaml
+import contextlib
+import statistics
+
+
+DEMO_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'demo', 'demo_config.yaml')
+
+
+def write_config(directory, num_dimensions=2, num_warm_up=10, max_iter=100000, name='bench', **settings):
+    ''' Write a config with num_dimensions continuous hyperparameters, storing everything in a SQLite file in directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the config and the store
+    num_dimensions : int
+        Number of continuous hyperparameters, each over (0, 1)
+    num_warm_up : int
+        Number of warm up experiments
+    max_iter : int
+        Maximum number of experiments
+    settings : dict
+        Extra config values, such as async_recording
+
+    Returns
+    -------
+    config_path : str
+        Path to the written config
+    '''
+    with open(DEMO_CONFIG, 'r') as f:
+        config = yaml.safe_load(f)
+    path = os.path.join(directory, name + '.db')
+
+    # Keep the demo's other settings, such as the train metrics, and swap the Mongo connection for the store
+    for prefix in ['controller', 'manager']:
+        for key in ['host', 'port', 'ssl_certfile', 'ssl_ca_file', 'max_pool_size', 'server_selection_timeout_ms']:
+            config[prefix].pop(prefix + '_' + key, None)
+        config[prefix][prefix + '_backend'] = 'local'
+        config[prefix][prefix + '_path'] = path
+    config['controller'].update({'controller_collection' : name + '_design',
+                                 'num_warm_up' : num_warm_up,
+                                 'max_iter' : max_iter,
+                                 'max_local_iter' : 5})
+    config['manager'].update({'manager_collection' : name + '_trial',
+                              'start_recording' : 0})
+    for key, value in settings.items():
+        config['manager' if key in config['manager'] else 'controller'][key] = value
+    config['hyperparameters'] = {'param_{}'.format(i) : {'name' : 'x{}'.format(i), 'type' : 'continuous', 'domain' : '(0, 1)'}
+                                 for i in range(num_dimensions)}
+    config.pop('architecture', None)
+
+    config_path = os.path.join(directory, name + '.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def measure(func, repeat=5, setup=None):
+    ''' Time func over repeat runs, calling setup untimed before each run.
+
+    Returns
+    -------
+    timings : dict
+        Fastest, median and mean run in seconds
+    '''
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            func()
+            runs.append(time.perf_counter() - start)
+    return {'min' : min(runs), 'median' : statistics.median(runs), 'mean' : statistics.mean(runs)}
+
+
+@contextlib.contextmanager
+def quiet():
+    ''' Silence the status messages printed by the library. '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
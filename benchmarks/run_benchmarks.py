@@ -0,0 +1,108 @@
+'''Run every benchmark and save the results as json, or compare two saved results.
+
+    $ python benchmarks/run_benchmarks.py --output before.json
+    $ python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+Everything runs against a local SQLite store, no mongo server is needed. Comparing prints the ratio
+of every timing to its baseline, and exits with 1 if any timing is slower than the threshold allows.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_import
+import bench_controller
+import bench_recorder
+
+
+def run(quick=False, repeat=3):
+    import ml_experiments
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('ml_experiments').version
+    except Exception:
+        version = None
+
+    return {'meta' : {'version' : version,
+                      'python' : platform.python_version(),
+                      'platform' : platform.platform(),
+                      'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'quick' : quick},
+            'import' : bench_import.run(repeat),
+            'controller' : bench_controller.run(quick, repeat),
+            'recorder' : bench_recorder.run(20 if quick else 100)}
+
+
+def flatten(results, prefix=''):
+    ''' Map every timing to a key naming its benchmark and parameters, e.g. controller/update_design[num_observations=10]/median.
+
+    List entries are keyed by their integer parameters, so results with different sizes line up where they overlap.
+    '''
+    flat = {}
+    if isinstance(results, dict):
+        for k, v in results.items():
+            if k != 'meta':
+                flat.update(flatten(v, '{}/{}'.format(prefix, k) if prefix else k))
+    elif isinstance(results, list):
+        for entry in results:
+            params = ','.join('{}={}'.format(k, v) for k, v in sorted(entry.items()) if isinstance(v, int) and not isinstance(v, bool))
+            timings = {k : v for k, v in entry.items() if not isinstance(v, int) or isinstance(v, bool)}
+            flat.update(flatten(timings, '{}[{}]'.format(prefix, params)))
+    elif isinstance(results, float):
+        flat[prefix] = results
+    return flat
+
+
+def compare(results, baseline, threshold=1.2):
+    ''' Print the ratio of every timing to the baseline.
+
+    Returns
+    -------
+    regressions : list
+        Keys of the timings slower than threshold times the baseline
+    '''
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for key in sorted(set(current) & set(previous)):
+        ratio = current[key] / previous[key] if previous[key] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(key)
+            flag = 'SLOWER'
+        elif ratio < 1. / threshold:
+            flag = 'faster'
+        print('{:80} {:10.4g} {:10.4g} {:7.2f}x {}'.format(key, previous[key], current[key], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Fewer and smaller benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per measurement')
+    parser.add_argument('--output', default=None, help='Save the results to this json file')
+    parser.add_argument('--compare', default=None, help='Compare the results to a saved json file')
+    parser.add_argument('--results', default=None, help='Compare these saved results instead of running the benchmarks')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    if args.results is not None:
+        with open(args.results, 'r') as f:
+            results = json.load(f)
+    else:
+        results = run(args.quick, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif args.compare is None:
+        print(json.dumps(results, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        print('{} timings slower than {}x the baseline'.format(len(regressions), args.threshold))
+        sys.exit(1 if regressions else 0)
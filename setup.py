@@ -13,7 +13,7 @@ DESCRIPTION = 'A library for recording experiments.'
 URL = 'https://gitlab.ccds.io/bradley.wright/ml_experiments.git'
 EMAIL = 'bwright9@@partners.org'
 AUTHOR = 'Bradley Wright'
-REQUIRES_PYTHON = '>=3.6.0'
+REQUIRES_PYTHON = '>=3.7.0'
 
 
 # The rest you shouldn't have to touch too much :)
@@ -97,8 +97,6 @@ setup(
             'License :: OSI Approved :: Apache Software License',
             'Programming Language :: Python',
             'Programming Language :: Python :: 3',
-            'Programming Language :: Python :: 3.5',
-            'Programming Language :: Python :: 3.6',
             'Programming Language :: Python :: 3.7',
             'Programming Language :: Python :: 3.8',
             'Intended Audience :: Healthcare Industry'
@@ -1,3 +1,32 @@
-from ml_experiments import base
-from ml_experiments import manager 
-from ml_experiments import controller
\ No newline at end of file
+import importlib
+
+# Submodules and classes are imported on first access, so importing the package doesn't pull in
+# tensorflow, GPy or GPyOpt until a class that needs them is used.
+_submodules = ['base', 'callbacks', 'controller', 'designs', 'encoding', 'instrumentation', 'manager', 'scheduler', 'server', 'stopping', 'storage', 'surrogates', 'writer']
+
+_exports = {'BaseConnection' : 'base',
+            'BaseReader' : 'base',
+            'KerasExperimentRecorder' : 'callbacks',
+            'ExperimentController' : 'controller',
+            'Instrumentation' : 'instrumentation',
+            'ExperimentNamer' : 'manager',
+            'ExperimentRecorder' : 'manager',
+            'StudyScheduler' : 'scheduler',
+            'SuggestionClient' : 'server',
+            'SuggestionServer' : 'server',
+            'ASHA' : 'stopping',
+            'MedianStoppingRule' : 'stopping',
+            'LocalClient' : 'storage',
+            'AsyncWriter' : 'writer'}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _exports:
+        return getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + _submodules + list(_exports.keys()))
@@ -1,12 +1,234 @@
 import os
-import ssl
+import copy
+import json
 import yaml
+import atexit
+import hashlib
+import tempfile
+import threading
+import collections
 import numpy as np
 from ast import literal_eval
-from pymongo import MongoClient
+
+
+# libyaml's C loader when PyYAML was built with it, the pure python one otherwise
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Bump when StudySpec or the way it's compiled changes, so stale cached specs aren't loaded
+SPEC_VERSION = 2
+
+# Compiled specs already loaded in this process, keyed by the hash of their yaml
+_specs = {}
+
+
+# MongoClients shared by every connection in this process, keyed by server, certificates and pool options
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Optional yaml settings for the connection pool, mapped to their MongoClient option names
+CLIENT_OPTIONS = {'max_pool_size' : 'maxPoolSize',
+                  'min_pool_size' : 'minPoolSize',
+                  'max_idle_time_ms' : 'maxIdleTimeMS',
+                  'connect_timeout_ms' : 'connectTimeoutMS',
+                  'socket_timeout_ms' : 'socketTimeoutMS',
+                  'server_selection_timeout_ms' : 'serverSelectionTimeoutMS'}
+
+
+def get_client(host, port, ssl_certfile, ssl_ca_file, **options):
+    ''' Get the shared MongoClient for a server, creating it on first use.
+
+    Parameters
+    ----------
+    host : str
+        Host name of the mongo server
+    port : int
+        Port of the mongo server
+    ssl_certfile : str
+        Path to the client certificate
+    ssl_ca_file : str
+        Path to the root certificate
+    options : dict
+        Extra MongoClient options, such as pool size and timeouts
+
+    Returns
+    -------
+    client : pymongo.MongoClient
+        Client with its own connection pool, reused by every connection to the same server with the same options
+    '''
+    key = (host, port, ssl_certfile, ssl_ca_file, tuple(sorted(options.items())))
+    with _clients_lock:
+        if key not in _clients:
+            # pymongo is only imported once a connection is needed
+            from pymongo import MongoClient
+            _clients[key] = MongoClient(host=host,
+                                        tls=True,
+                                        tlsCertificateKeyFile=ssl_certfile,
+                                        tlsCAFile=ssl_ca_file,
+                                        port=port,
+                                        **options)
+        return _clients[key]
+
+
+def get_local_client(path):
+    ''' Get the shared LocalClient for a SQLite file, creating it on first use.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file, ':memory:' keeps the store in this process
+
+    Returns
+    -------
+    client : LocalClient
+        Embedded client, reused by every connection to the same file
+    '''
+    key = ('local', path if path == ':memory:' else os.path.abspath(path))
+    with _clients_lock:
+        if key not in _clients:
+            from .storage import LocalClient
+            _clients[key] = LocalClient(path)
+        return _clients[key]
+
+
+def close_clients():
+    ''' Close every shared client, called automatically at interpreter exit. '''
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+atexit.register(close_clients)
+
+
+StudySpec = collections.namedtuple('StudySpec', ['config_dict', 'experiment', 'bounds', 'hyperparameter_names', 'domains'])
+StudySpec.__doc__ = ''' A compiled experiment config, shared between readers and treated as read only.
+
+config_dict : dict
+    The parsed yaml
+experiment : dict
+    Every heading but the hyperparameters merged into one dictionary, without trial_name
+bounds : list
+    Hyperparameter dictionaries in the format required by GPyOpt
+hyperparameter_names : list
+    Name of each hyperparameter in bounds
+domains : tuple
+    Read only float arrays of each hyperparameter's domain, in the order of bounds
+'''
+
+
+def spec_cache_dir():
+    ''' Directory compiled specs are cached in, ML_EXPERIMENTS_CACHE or ~/.cache/ml_experiments/specs. '''
+    return os.environ.get('ML_EXPERIMENTS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ml_experiments', 'specs'))
+
+
+def compile_spec(text):
+    ''' Parse and validate a yaml config.
+
+    Parameters
+    ----------
+    text : bytes or str
+        Contents of the yaml config
+
+    Returns
+    -------
+    spec : StudySpec
+        The compiled config
+    '''
+    reader = BaseReader()
+    reader.config_dict = yaml.load(text, Loader=SafeLoader)
+    reader._bundle_experiment()
+    reader._fix_none()
+    reader._bundle_hyperparameters()
+    return _make_spec(reader.config_dict, reader.experiment, reader.bounds, reader.hyperparameter_names)
+
+
+def _make_spec(config_dict, experiment, bounds, hyperparameter_names):
+    ''' Build a StudySpec, with read only arrays of the domains. '''
+    domains = []
+    for b in bounds:
+        domain = np.array(b['domain'], dtype=float)
+        domain.flags.writeable = False
+        domains.append(domain)
+    return StudySpec(config_dict, experiment, bounds, hyperparameter_names, tuple(domains))
+
+
+def load_spec(config):
+    ''' Get the compiled spec of a yaml config, from memory, from the disk cache, or by compiling it.
+
+    Specs are keyed by a hash of the yaml's contents, so editing a config compiles it again.
+
+    Parameters
+    ----------
+    config : str
+        Path to the yaml config
+
+    Returns
+    -------
+    spec : StudySpec
+        The compiled config, shared with every other reader of the same yaml
+    '''
+    with open(config, 'rb') as f:
+        text = f.read()
+    key = hashlib.sha256(b'%d:' % SPEC_VERSION + text).hexdigest()
+    if key in _specs:
+        return _specs[key]
+
+    # The cache holds plain json, loading a file from it can't run code whatever wrote the file
+    path = os.path.join(spec_cache_dir(), key + '.json')
+    try:
+        with open(path, 'r') as f:
+            spec = _make_spec(**json.load(f, object_hook=_from_json))
+    except FileNotFoundError:
+        spec = compile_spec(text)
+        _store_spec(spec, path)
+    except (OSError, ValueError, TypeError) as e:
+        print('Compiling {} again, its cached spec {} could not be read: {}'.format(config, path, e))
+        spec = compile_spec(text)
+        _store_spec(spec, path)
+
+    _specs[key] = spec
+    return spec
+
+
+def _store_spec(spec, path):
+    ''' Write a spec to the disk cache atomically. Specs that don't survive a round trip through json aren't cached. '''
+    fields = {k : getattr(spec, k) for k in ['config_dict', 'experiment', 'bounds', 'hyperparameter_names']}
+    try:
+        text = json.dumps(_to_json(fields), allow_nan=False)
+    except (TypeError, ValueError):
+        return
+    if json.loads(text, object_hook=_from_json) != fields:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+            f.write(text)
+        os.replace(f.name, path)
+    except OSError as e:
+        print('Could not cache the compiled spec in {}: {}'.format(path, e))
+
+
+def _to_json(value):
+    ''' Tag tuples, such as the domains in the bounds, so they're read back as tuples rather than lists. '''
+    if isinstance(value, tuple):
+        return {'__tuple__' : [_to_json(v) for v in value]}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k : _to_json(v) for k, v in value.items()}
+    return value
+
+
+def _from_json(value):
+    if list(value.keys()) == ['__tuple__']:
+        return tuple(value['__tuple__'])
+    return value
+
 
 class BaseConnection:
-    '''Get a connection to a mongo database server'''
+    '''Get a connection to a mongo database server, or to a local SQLite store when {prefix}_backend is 'local'.'''
     
     def establish_db_connection(self, prefix):
         '''
@@ -16,24 +238,36 @@ class BaseConnection:
             Which database service to connect to, references yaml config
 `        '''
 
+        backend = self.experiment.get('{}_backend'.format(prefix), 'mongo')
+        assert backend in ['mongo', 'local'], '{}_backend must be either mongo or local.'.format(prefix)
+
         # Check that all needed values are in the experiment configuration.
-        required_vals = [prefix + '_host', 
-                         prefix + '_ssl_ca_file', 
-                         prefix + '_database', 
-                         prefix + '_collection', 
-                         prefix + '_port',
-                         prefix + '_ssl_certfile']
+        required_vals = [prefix + '_database', 
+                         prefix + '_collection']
+        if backend == 'mongo':
+            required_vals += [prefix + '_host', 
+                              prefix + '_ssl_ca_file', 
+                              prefix + '_port',
+                              prefix + '_ssl_certfile']
         
         experiment_key_list = list(self.experiment.keys())
         for rv in required_vals:
             assert rv in experiment_key_list, '{} {}'.format(rv, ' must be set in the experiment config yaml.')
 
-        client = MongoClient(host=self.experiment['{}_host'.format(prefix)],
-                     ssl=True,
-                     ssl_cert_reqs=ssl.CERT_REQUIRED,
-                     ssl_certfile=self.experiment['{}_ssl_certfile'.format(prefix)],
-                     ssl_ca_certs=self.experiment['{}_ssl_ca_file'.format(prefix)],
-                     port=self.experiment['{}_port'.format(prefix)])
+        if backend == 'local':
+            client = get_local_client(self.experiment.get('{}_path'.format(prefix), 'ml_experiments.db'))
+        else:
+            # Optional connection pool settings
+            options = {}
+            for name, option in CLIENT_OPTIONS.items():
+                if '{}_{}'.format(prefix, name) in experiment_key_list:
+                    options[option] = self.experiment['{}_{}'.format(prefix, name)]
+
+            client = get_client(host=self.experiment['{}_host'.format(prefix)],
+                                port=self.experiment['{}_port'.format(prefix)],
+                                ssl_certfile=self.experiment['{}_ssl_certfile'.format(prefix)],
+                                ssl_ca_file=self.experiment['{}_ssl_ca_file'.format(prefix)],
+                                **options)
         
         self.db = client[self.experiment['{}_database'.format(prefix)]]
         self.col = self.db[self.experiment['{}_collection'.format(prefix)]]        
@@ -43,18 +277,25 @@ class BaseReader:
     '''Base class for reading and manipulating an experiment yaml config file.'''
     
     def get_config(self, config):
-        '''Read yaml config file, and create the experiment dictionary, and hyperparameter bounds.'''
+        '''Read yaml config file, and create the experiment dictionary, and hyperparameter bounds.
+        
+        The config is compiled once into a StudySpec and cached on disk, this reader gets its own copy of it.
+        '''
 
-        self._load_config(config)
-        self._bundle_experiment()
-        self._set_config_name(config)        
-        self._fix_none()
-        self._bundle_hyperparameters()
+        spec = load_spec(config)
+        self.spec = spec
+        self.config_dict = copy.deepcopy(spec.config_dict)
+        self.config_keys = [k for k in self.config_dict.keys() if k != 'hyperparameters']
+        self.experiment = copy.deepcopy(spec.experiment)
+        self.bounds = copy.deepcopy(spec.bounds)
+        self.hyperparameter_names = list(spec.hyperparameter_names)
+        self._set_config_name(config)
 
 
     def _load_config(self, config):
         ''' Load the yaml config file. '''
-        self.config_dict = yaml.load(open(config, 'r'))
+        with open(config, 'r') as f:
+            self.config_dict = yaml.load(f, Loader=SafeLoader)
 
     def _set_config_name(self, config):
         '''
@@ -124,20 +365,20 @@ class BaseReader:
         for k,v in hyperparameters.items():
             if 'param' in k:
                 # the tuple is read as a string during the yaml read, change it back to a tuple
-                v['domain'] = literal_eval(v['domain'])
+                if isinstance(v['domain'], str):
+                    v['domain'] = literal_eval(v['domain'])
                 
                 self.hyperparameter_names.append(v['name'])
                 self.bounds.append(v)
                 
         # Re-Order the hyperparameters in case a specific order is required to construct a model
         if 'read_order' in self.experiment.keys():
+            positions = {name : i for i, name in enumerate(self.hyperparameter_names)}
             ordered_names = []
             ordered_bounds = []
             for r in self.experiment['read_order']:
                 ordered_names.append(r)
-
-                idx = self.hyperparameter_names.index(r)
-                ordered_bounds.append(self.bounds[idx])
+                ordered_bounds.append(self.bounds[positions[r]])
 
             self.hyperparameter_names = ordered_names
             self.bounds = ordered_bounds
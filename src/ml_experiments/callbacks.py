@@ -0,0 +1,16 @@
+from tensorflow.keras.callbacks import Callback
+from .manager import ExperimentRecorder
+
+
+class KerasExperimentRecorder(ExperimentRecorder, Callback):
+    '''Keras callback that records an experiment in mongo, the only part of the library that needs tensorflow.'''
+
+    def __init__(self, config_path, experiment=None, heartbeat=None):
+        Callback.__init__(self)
+        ExperimentRecorder.__init__(self, config_path, experiment, heartbeat)
+
+
+    def on_epoch_end(self, epoch, logs={}):
+        ExperimentRecorder.on_epoch_end(self, epoch, logs)
+        if self.stop_training:
+            self.model.stop_training = True
@@ -1,7 +1,24 @@
-import GPy, GPyOpt
+import time
 import numpy
+import threading
 import numpy as np
+from pymongo import ReturnDocument
 from .base import BaseReader, BaseConnection
+from .designs import warm_up_design, CandidateGrid
+from .encoding import ENCODINGS, encode_row, decode_rows, encode_matrix, decode_matrix, migrate_design
+from .instrumentation import Instrumentation
+from .storage import bulk_write
+
+
+# Fitted surrogate models shared by every controller in this process, keyed by study
+_surrogate_cache = {}
+_surrogate_lock = threading.Lock()
+
+# Limit of the $slice that reads the observations past the local replica, the store caps it at the array's end
+_MAX_SLICE = 2**31 - 1
+
+# Number of times a suggestion that collides with another worker's trial is made again, before it's handed out anyway
+_MAX_SUGGESTION_ATTEMPTS = 5
 
 
 class ExperimentController(BaseReader, BaseConnection):
@@ -28,6 +45,56 @@ class ExperimentController(BaseReader, BaseConnection):
         self.max_iter = self.experiment['max_iter']
         self.max_local_iter = self.experiment['max_local_iter']
         self.num_warm_up = self.experiment['num_warm_up']
+        self.warm_up_strategy = self.experiment.get('warm_up_design', 'latin')
+
+        # Surrogate model, see ml_experiments.surrogates, the exact gp's cost grows with the cube of the design
+        self.surrogate = self.experiment.get('surrogate', 'gp')
+        self.num_inducing = self.experiment.get('num_inducing', 100)
+        self.surrogate_window = self.experiment.get('surrogate_window', 500)
+        self.num_trees = self.experiment.get('num_trees', 100)
+
+        # Fully discrete search spaces up to max_grid_size combinations are searched exhaustively, grid_chunk_size at a time
+        self.discrete_fast_path = self.experiment.get('discrete_fast_path', True)
+        self.max_grid_size = self.experiment.get('max_grid_size', 10000000)
+        self.grid_chunk_size = self.experiment.get('grid_chunk_size', 10000)
+        # Candidates scoring within this relative tolerance of the best are tied, and one of them is picked at random
+        self.grid_tie_tolerance = self.experiment.get('grid_tie_tolerance', 1e-6)
+        self._grid = None
+
+        # Surrogate caching, refit from scratch every refit_interval observations and warm start in between
+        self.refit_interval = self.experiment.get('refit_interval', 10)
+        self.warm_start_iters = self.experiment.get('warm_start_iters', 100)
+
+        # Opt-in background prefetch of the next suggestion, discarded once it falls too many observations behind
+        self.prefetch = self.experiment.get('prefetch', False)
+        self.prefetch_max_staleness = self.experiment.get('prefetch_max_staleness', 1)
+        self._prefetch_thread = None
+        self._prefetched = None
+
+        # Iterations of the trials this controller handed out and hasn't reported yet, keyed by trial
+        self._in_flight = {}
+
+        # Guards the replica and the trials in flight, so results and heartbeats can come in while a fit runs
+        self._lock = threading.RLock()
+
+        # Opt-in leases on handed out trials in seconds, a trial whose lease runs out without a heartbeat is handed out again
+        self.lease_duration = self.experiment.get('lease_duration', None)
+        self._last_heartbeat = 0.
+        # No lease can run out before this time, so the pending trials aren't read again until then
+        self._next_lease_check = 0.
+
+        # Storage format of X_steps, Y_steps and warm_up_list for new designs, see ml_experiments.encoding. An existing
+        # design keeps its own format, and is only rewritten in this one if migrate_design is set
+        self.design_encoding = self.experiment.get('design_encoding', 'list')
+        assert self.design_encoding in ENCODINGS, 'design_encoding must be one of {}'.format(ENCODINGS)
+        self.migrate_design = self.experiment.get('migrate_design', False)
+
+        # Number of leading observations of the local design that mirror the store, None until the first read
+        self.raster_id = None
+        self._num_synced = None
+
+        # Opt-in timing of every phase of a suggestion, see ml_experiments.instrumentation
+        self.instrumentation = Instrumentation.from_experiment('controller', self.experiment)
         
         self.establish_db_connection(prefix='controller') # inherited method, connect to mongo
         self._get_design()
@@ -36,18 +103,105 @@ class ExperimentController(BaseReader, BaseConnection):
         
     def _get_design(self):
         ''' Get the latest updated experiment. '''
-        
+        with self.instrumentation.phase('get_design'), self._lock:
+            self._read_design()
+
+
+    def _read_design(self):
+        ''' Bring the local replica of the design up to date, reading only the observations it hasn't seen. '''
+        if self._num_synced is not None and self._sync_design():
+            return
+        self._read_full_design()
+
+
+    def _sync_design(self):
+        ''' Fetch the observations past the local replica, and the iteration tally and pending trials.
+
+        Observations are only ever appended, so the replica is a prefix of the stored design and the
+        num_observations counter is its version. A read that doesn't line up with the counter, e.g. after
+        the design was overwritten, is left to a full read.
+
+        Returns
+        -------
+        synced : bool
+            True if the replica is up to date, False if the design has to be read in full
+        '''
+        num_synced = self._num_synced
+        raster = self._read_tail(num_synced)
+        if raster is None:
+            return False
+
+        # Drop observations this controller appended locally but hasn't read back in the stored order
+        del self.X_steps[num_synced:]
+        del self.Y_steps[num_synced:]
+        self.X_steps.extend(raster['X_steps'])
+        self.Y_steps.extend(raster['Y_steps'])
+        self._num_synced = raster['num_observations']
+        self.next_iter = raster['next_iter']
+        self.pending = raster.get('pending', [])
+        self.released = raster.get('released', [])
+        self.design_encoding = raster.get('encoding', 'list')
+        return True
+
+
+    def _read_tail(self, num_synced):
+        ''' Read the observations past the first num_synced, with the iteration tally and pending trials.
+
+        Returns
+        -------
+        raster : dict
+            Projected design document, None if the design is gone or the read doesn't line up with its counter
+        '''
+        raster = self.col.find_one({'_id' : self.raster_id},
+                                   projection={'next_iter' : True,
+                                               'num_observations' : True,
+                                               'pending' : True,
+                                               'released' : True,
+                                               'encoding' : True,
+                                               'X_steps' : {'$slice' : [num_synced, _MAX_SLICE]},
+                                               'Y_steps' : {'$slice' : [num_synced, _MAX_SLICE]}})
+        if raster is None or raster.get('num_observations') != num_synced + len(raster['X_steps']):
+            return None
+        if len(raster['X_steps']) != len(raster['Y_steps']):
+            return None
+        raster['X_steps'] = decode_rows(raster['X_steps'])
+        raster['Y_steps'] = decode_rows(raster['Y_steps'])
+        return raster
+
+
+    def _read_full_design(self):
+        ''' Read the whole design from the store, or create it if there is none. '''
+        num_designs = self.col.estimated_document_count()
+
         # Retrieve the existing design
-        if self.col.estimated_document_count() == 1:
+        if num_designs == 1:
             self.raster = self.col.find_one()
             self.raster_id = self.raster['_id']
-            self.X_steps = self.raster['X_steps']
-            self.Y_steps = self.raster['Y_steps']
+            self.X_steps = decode_rows(self.raster['X_steps'])
+            self.Y_steps = decode_rows(self.raster['Y_steps'])
             self.next_iter = self.raster['next_iter']
-            self.warm_up_list = self.raster['warm_up_list']
-            
+            self.warm_up_list = decode_matrix(self.raster['warm_up_list'])
+            self.pending = self.raster.get('pending', [])
+            self.released = self.raster.get('released', [])
+            self._num_synced = len(self.X_steps)
+
+            # The stored encoding wins, a design is only rewritten in the configured one on request.
+            # The decoded replica stays as it is either way
+            if self.raster.get('encoding', 'list') != self.design_encoding:
+                if self.migrate_design:
+                    print('Migrating the design to the {} encoding'.format(self.design_encoding))
+                    migrate_design(self.col, self.design_encoding, self.raster_id)
+                else:
+                    print('Keeping the {} encoding of the design, set migrate_design to rewrite it as {}'.format(self.raster.get('encoding', 'list'), self.design_encoding))
+                    self.design_encoding = self.raster.get('encoding', 'list')
+
+            # Designs written before the counter existed, or overwritten since, get it set to their size
+            if self.raster.get('num_observations') != self._num_synced:
+                self.col.update_one({'_id' : self.raster_id, 'X_steps' : {'$size' : self._num_synced}},
+                                    {'$set' : {'num_observations' : self._num_synced}})
+
         # Create a new design
-        elif self.col.estimated_document_count() == 0:
+        elif num_designs == 0:
             self._create_design_entry()
 
         else:
@@ -57,57 +211,117 @@ class ExperimentController(BaseReader, BaseConnection):
     def _create_design_entry(self):
         ''' Create the controller document in mongo. '''
         
-        # Determine the dimensionality of each hyperparameter
-        experiment_dimensions = []        
-        for i in self.bounds:
-            experiment_dimensions.append(len(i['domain'])) # list of counts of dimensions per hyperparameter
-            
-        warm_up_array = np.zeros((self.num_warm_up, len(experiment_dimensions)))
-        
         # Populate the warm up table (each row is an experiment, each column is a hyperparameter)
-        for i in range(self.num_warm_up):
-            for j, dim in enumerate(experiment_dimensions):
-
-                # Draw a random sample for this hyperparameter from its domain
-                this_dimensions_sample = np.random.choice(dim, 1)
-                warm_up_array[i][j] = self.bounds[j]['domain'][this_dimensions_sample[0]]
-                
+        with self.instrumentation.phase('warm_up'):
+            warm_up_array = warm_up_design(self.bounds, self.num_warm_up, self.warm_up_strategy)
+        
         # Make it into a list
         self.X_steps = []
         self.Y_steps = []
-        self.warm_up_list = []
-        for i in warm_up_array:
-            self.warm_up_list.append(list(i))
+        warm_up_list = encode_matrix(warm_up_array, self.design_encoding)
+        self.warm_up_list = decode_matrix(warm_up_list)
+        self.pending = []
+        self.released = []
             
         # Insert into mongo
         self.next_iter = 0
         self.entry_id = self.col.insert_one({'next_iter' : 0,
                                 'num_warm_up' : self.num_warm_up,
-                                'warm_up_list' : self.warm_up_list,
+                                'warm_up_list' : warm_up_list,
                                 'X_steps' : self.X_steps,
-                                'Y_steps' : self.Y_steps})
+                                'Y_steps' : self.Y_steps,
+                                'num_observations' : 0,
+                                'encoding' : self.design_encoding,
+                                'pending' : self.pending})
         
         # Keep the ID for reference
         self.raster_id = self.entry_id.inserted_id
+        self._num_synced = 0
+
+
+    def _tally_iterations(self, num_iters):
+        ''' Claim a block of iterations with a single atomic increment on the server, and update the tally locally.
+
+        Iterations given back by failed suggestions are claimed again first, one at a time. The increment only
+        matches while none are given back, so the usual claim stays a single round trip.
+
+        Parameters
+        ----------
+        num_iters : int
+            Number of consecutive iterations to claim
+
+        Returns
+        -------
+        claimed_iters : list
+            The iterations owned by this caller. Concurrent callers are never handed the same value.
+        '''
+
+        claimed_iters = []
+        with self.instrumentation.phase('claim'):
+            while len(claimed_iters) < num_iters:
+                num_new = num_iters - len(claimed_iters)
+                raster = self.col.find_one_and_update({'_id' : self.raster_id, 'released.0' : {'$exists' : False}},
+                                                      {'$inc' : {'next_iter' : num_new}},
+                                                      projection={'next_iter' : True},
+                                                      return_document=ReturnDocument.AFTER)
+                if raster is not None:
+                    # The range comes from this caller's own result, self.next_iter may already be another thread's
+                    last = raster['next_iter']
+                    self.next_iter = last
+                    claimed_iters.extend(range(last - num_new, last))
+                    break
+
+                # Take the oldest given back iteration, the document before the $pop shows which one it was
+                raster = self.col.find_one_and_update({'_id' : self.raster_id},
+                                                      {'$pop' : {'released' : -1}},
+                                                      projection={'next_iter' : True, 'released' : {'$slice' : 1}})
+                assert raster is not None, 'The design {} is missing from the controller collection'.format(self.raster_id)
+                self.next_iter = raster['next_iter']
+                claimed_iters.extend(raster.get('released', []))
+        return claimed_iters
+
+
+    def _release_iterations(self, claimed_iters):
+        ''' Give back claimed iterations whose suggestion failed, so they are claimed again instead of lost.
+
+        Parameters
+        ----------
+        claimed_iters : list
+            Iterations claimed with _tally_iterations that weren't handed out
+        '''
+        if len(claimed_iters) == 0:
+            return
+        print('Giving back iterations {}'.format([i + 1 for i in claimed_iters]))
+        self.col.update_one({'_id' : self.raster_id}, {'$push' : {'released' : {'$each' : list(claimed_iters)}}})
 
 
     def _tally_an_iteration(self):
-        ''' Update the experiments completed tally locally and globally.'''
+        ''' Claim the next iteration with a single atomic increment on the server, and update the tally locally.
+
+        Returns
+        -------
+        claimed_iter : int
+            The iteration owned by this caller. Concurrent callers are never handed the same value.
+        '''
 
-        self.next_iter += 1
-        self._set_val('next_iter', self.next_iter)
+        return self._tally_iterations(1)[0]
     
     
-    def _checkout_warmup(self):
+    def _checkout_warmup(self, claimed_iter):
         ''' Get an experiment from the warm up raster.
 
+        Parameters
+        ----------
+        claimed_iter : int
+            Iteration claimed with _tally_an_iteration, indexes the warm up raster
+
         Returns
         -------
         warm_up_entry : array
             1D array of encoded hyperparameter combinations
         '''
         
-        warm_up_entry = self.warm_up_list[self.next_iter]
+        warm_up_entry = self.warm_up_list[claimed_iter]
         return warm_up_entry
         
         
@@ -119,19 +333,541 @@ class ExperimentController(BaseReader, BaseConnection):
         next_trial : array
             1D array of encoded hyperparameter combinations
         '''
-        assert self.X_steps != [], 'X_steps cannot be an empty list'
-        assert self.Y_steps != [], 'Y_steps cannot be an empty list'
+        next_trial = self._suggest_locations(1)[0]
+        return next_trial
+
+
+    def _suggest_locations(self, batch_size, X_steps=None, Y_steps=None, pending_X=None):
+        ''' Fit the surrogate once and suggest a batch of locations with GPyOpt.
+
+        The surrogate is chosen with the surrogate key of the config. Batches larger than one are spread out
+        with local penalization, so they don't cluster on a single point.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of locations to suggest
+        X_steps : list
+            Design to fit the surrogate on, defaults to the controller's X_steps
+        Y_steps : list
+            Objective values of the design, defaults to the controller's Y_steps
+        pending_X : array
+            2D array of trials that have been handed out but not reported, these won't be suggested again.
+            Defaults to the pending trials in the design store
+
+        Returns
+        -------
+        x_next : array
+            2D array, each row is an encoded hyperparameter combination
+        '''
+        # GPyOpt is only imported once bayesian optimization is needed
+        import GPyOpt
+        from .surrogates import select_observations, optimizer_options
 
-        b_opt = GPyOpt.methods.BayesianOptimization(f=None, 
-                                            domain=self.bounds, 
-                                            X = np.array(self.X_steps),
-                                            Y = self.Y_steps)
+        if X_steps is None:
+            with self._lock:
+                X_steps, Y_steps = list(self.X_steps), list(self.Y_steps)
+        if pending_X is None:
+            pending_X = self._pending_X(self.pending)
+        assert X_steps != [], 'X_steps cannot be an empty list'
+        assert Y_steps != [], 'Y_steps cannot be an empty list'
+
+        with self.instrumentation.phase('setup'):
+            X, Y = select_observations(np.array(X_steps), np.array(Y_steps), self.surrogate, self.surrogate_window, self.bounds)
+            b_opt = GPyOpt.methods.BayesianOptimization(f=None, 
+                                                domain=self.bounds, 
+                                                X = X,
+                                                Y = Y,
+                                                batch_size=batch_size,
+                                                de_duplication=True,
+                                                **optimizer_options(self.surrogate, batch_size, self.num_inducing, self.num_trees))
+            warm_started = self._restore_surrogate(b_opt, len(X_steps))
         
-        x_next = b_opt.suggest_next_locations(ignored_X=self.ignored_experiments)
-        next_trial = x_next[0]
-        return next_trial
+        # The steps of b_opt.suggest_next_locations, run separately so the fit and the acquisition are timed apart
+        b_opt.model_parameters_iterations = None
+        b_opt.num_acquisitions = 0
+        b_opt.context = None
+        with self.instrumentation.phase('fit'):
+            b_opt._update_model(b_opt.normalization_type)
+        with self.instrumentation.phase('acquisition'):
+            grid = self._candidate_grid()
+            if grid is not None:
+                x_next = self._suggest_from_grid(grid, b_opt, batch_size, [X_steps, pending_X, self.ignored_experiments])
+            else:
+                x_next = b_opt._compute_next_evaluations(pending_zipped_X=pending_X, ignored_zipped_X=self.ignored_experiments)
+
+        self._store_surrogate(b_opt, len(X_steps), warm_started)
+        return x_next
+
+
+    def _candidate_grid(self):
+        ''' The candidate grid of the search space, built on first use.
+
+        Returns
+        -------
+        grid : CandidateGrid
+            Every combination of the hyperparameters, or None if the search space isn't fully discrete,
+            is larger than max_grid_size, or the discrete fast path is turned off
+        '''
+        if not self.discrete_fast_path or not all(b['type'] == 'discrete' for b in self.bounds):
+            return None
+        if self._grid is None:
+            self._grid = CandidateGrid(self.bounds)
+        if self._grid.size > self.max_grid_size:
+            return None
+        return self._grid
+
+
+    def _suggest_from_grid(self, grid, b_opt, batch_size, exclude):
+        ''' Suggest a batch by scoring the acquisition of every candidate in a discrete search space.
+
+        This is the exact argmax of the acquisition over the candidates not yet observed, pending or ignored.
+        Batches are spread out by penalizing around each chosen candidate, like GPyOpt's local penalization,
+        with the Lipschitz constant also taken over the whole grid. Batches from surrogates without
+        local penalization are completed with random candidates.
+
+        Parameters
+        ----------
+        grid : CandidateGrid
+            Candidate grid of the search space
+        b_opt : GPyOpt.methods.BayesianOptimization
+            Optimizer whose surrogate has been fit
+        batch_size : int
+            Number of locations to suggest
+        exclude : list
+            2D arrays of encoded trials that shouldn't be suggested, None entries are skipped
+
+        Returns
+        -------
+        x_next : array
+            2D array, each row is an encoded hyperparameter combination
+        '''
+        from GPyOpt.acquisitions import AcquisitionLP
+        acquisition = b_opt.acquisition
+        penalized = isinstance(acquisition, AcquisitionLP)
+        excluded = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + [grid.flat_indices(X) for X in exclude if X is not None and len(X) > 0]))
+
+        if penalized:
+            acquisition.update_batches(None, None, None)
+        batch = [self._grid_argmin(grid, acquisition.acquisition_function, excluded)]
+
+        if batch_size > 1 and penalized:
+            L = self._grid_lipschitz(grid, b_opt.model.model)
+            Min = b_opt.model.model.Y.min()
+        while len(batch) < batch_size:
+            excluded = np.union1d(excluded, batch[-1:])
+            if penalized:
+                acquisition.update_batches(grid.take(batch), L, Min)
+                batch.append(self._grid_argmin(grid, acquisition.acquisition_function, excluded))
+            else:
+                batch.append(self._grid_random(grid, excluded))
+
+        if penalized:
+            acquisition.update_batches(None, None, None)
+        return grid.take(batch)
+
+
+    def _grid_argmin(self, grid, function, excluded):
+        ''' Flat index of the candidate minimizing a function, scored chunk by chunk and skipping excluded candidates.
+
+        Candidates within grid_tie_tolerance of the minimum are tied, and one of them is picked at random, so
+        workers fitting the same design don't all land on the same candidate. Once every candidate is excluded,
+        the best candidate overall is returned.
+        '''
+        best_score = np.inf
+        ties, tie_scores = np.zeros(0, dtype=np.int64), np.zeros(0)
+        for start, rows in grid.chunks(self.grid_chunk_size):
+            scores = np.ravel(function(rows)).astype(float)
+            skipped = excluded[np.searchsorted(excluded, start):np.searchsorted(excluded, start + len(rows))]
+            scores[skipped - start] = np.inf
+            if not np.min(scores) < np.inf:
+                continue
+
+            # Keep the candidates tied with the best so far, the threshold only comes down as the best improves
+            best_score = min(best_score, np.min(scores))
+            threshold = best_score + self.grid_tie_tolerance * max(1., abs(best_score))
+            near = np.flatnonzero(scores <= threshold)
+            ties, tie_scores = np.concatenate([ties, start + near]), np.concatenate([tie_scores, scores[near]])
+            ties, tie_scores = ties[tie_scores <= threshold], tie_scores[tie_scores <= threshold]
+
+        if len(ties) == 0:
+            return self._grid_argmin(grid, function, np.zeros(0, dtype=np.int64))
+        return int(np.random.default_rng().choice(ties))
+
+
+    def _grid_lipschitz(self, grid, model):
+        ''' Largest norm of the gradient of the GP's mean over the grid, as in GPyOpt's estimate_L. '''
+        L = 0.
+        for start, rows in grid.chunks(self.grid_chunk_size):
+            dmdx, _ = model.predictive_gradients(rows)
+            L = max(L, np.sqrt((dmdx * dmdx).sum(1)).max())
+
+        # A flat model would exclude nothing, fall back to GPyOpt's constant
+        return L if L >= 1e-7 else 10.
+
+
+    def _grid_random(self, grid, excluded):
+        ''' Flat index of a random candidate that isn't excluded, if there is one. '''
+        rng = np.random.default_rng()
+        for _ in range(1000):
+            i = int(rng.integers(grid.size))
+            if len(excluded) >= grid.size or not np.isin(i, excluded):
+                return i
+        return i
+
+
+    def _pending_X(self, pending, num_columns=None):
+        ''' Stack the trials of pending design store entries.
+
+        Parameters
+        ----------
+        pending : list
+            Entries of the design store's pending list
+        num_columns : int
+            If set, always return a 2D array with this many columns, even when nothing is pending
+
+        Returns
+        -------
+        pending_X : array
+            2D array of pending trials, or None if nothing is pending and num_columns isn't set
+        '''
+        if pending == []:
+            return None if num_columns is None else np.zeros((0, num_columns))
+        return np.array([p['x'] for p in pending])
+
+
+    def _mark_pending(self, claimed_iters, trials, unique=False):
+        ''' Record trials that have been handed out but not reported in the design store, so other workers avoid them.
+
+        Parameters
+        ----------
+        claimed_iters : list
+            Iterations claimed for the trials
+        trials : list
+            1D arrays of encoded hyperparameters, one per claimed iteration
+        unique : bool
+            Only record the trials if none of them is pending or observed already, in the same atomic write
+
+        Returns
+        -------
+        marked : bool
+            False if the trials weren't recorded, because another worker's trial or observation came first
+        '''
+        entries = [{'iter' : i, 'x' : np.asarray(x, dtype=float).tolist()} for i, x in zip(claimed_iters, trials)]
+        if not entries:
+            return True
+        if self.lease_duration is not None:
+            for entry in entries:
+                entry['lease'] = time.time() + self.lease_duration
+
+        query = {'_id' : self.raster_id}
+        if unique:
+            xs = [entry['x'] for entry in entries]
+            query['pending.x'] = {'$nin' : xs}
+            query['X_steps'] = {'$nin' : [encode_row(x, encoding) for encoding in ENCODINGS for x in xs]}
+        with self.instrumentation.phase('write'):
+            result = self.col.update_one(query, {'$push' : {'pending' : {'$each' : entries}}})
+        if result.matched_count == 0:
+            return False
+        with self._lock:
+            for entry in entries:
+                self._in_flight[tuple(entry['x'])] = entry['iter']
+        return True
+
+
+    def _mark_suggested(self, claimed_iters, trials):
+        ''' Record bayesian trials as pending, suggesting them again if another worker suggested the same ones first.
+
+        Workers whose fits overlap don't see each other's pending trials, so they can suggest the same ones. The
+        trials are only recorded if none of them is pending or observed, otherwise the design is read again and
+        new trials are suggested with the other workers' trials excluded.
+
+        Parameters
+        ----------
+        claimed_iters : list
+            Bayesian iterations claimed for the trials
+        trials : list
+            1D arrays of encoded hyperparameters, one per claimed iteration
+
+        Returns
+        -------
+        trials : list
+            The trials that were recorded
+        '''
+        for attempt in range(_MAX_SUGGESTION_ATTEMPTS):
+            if self._mark_pending(claimed_iters, trials, unique=True):
+                return trials
+            print('Another worker suggested the same trial first, suggesting again')
+            self._get_design()
+            trials = list(self._suggest_locations(len(claimed_iters)))
+
+        # Every candidate left is taken, e.g. in a small discrete search space, so a repeat is handed out
+        self._mark_pending(claimed_iters, trials)
+        return trials
+
+
+    def heartbeat(self):
+        ''' Renew the leases of the trials this controller has handed out and not reported yet.
+
+        Call it while a trial trains, e.g. by passing it as the heartbeat of an ExperimentRecorder. Renewals
+        closer together than a quarter of lease_duration are skipped.
+        '''
+        now = time.time()
+        if self.lease_duration is None or not self._in_flight or now - self._last_heartbeat < self.lease_duration / 4:
+            return
+        with self._lock:
+            in_flight = list(self._in_flight)
+        self.renew_leases(in_flight)
+        self._last_heartbeat = now
+
+
+    def give_back(self, trials):
+        ''' Give back handed out trials that nobody will evaluate, e.g. those of a worker that left a SuggestionServer.
+
+        The trials are retired from the pending list, and their iterations are claimed again by the next suggestions.
+
+        Parameters
+        ----------
+        trials : list
+            1D arrays of encoded hyperparameters, trials that aren't in flight any more are skipped
+        '''
+        with self._lock:
+            claimed_iters = [self._in_flight.pop(tuple(np.asarray(x, dtype=float).tolist()), None) for x in trials]
+        claimed_iters = [i for i in claimed_iters if i is not None]
+        if not claimed_iters:
+            return
+        print('Giving back iterations {}'.format([i + 1 for i in claimed_iters]))
+        with self.instrumentation.phase('write'):
+            self.col.update_one({'_id' : self.raster_id}, {'$pull' : {'pending' : {'iter' : {'$in' : claimed_iters}}},
+                                                           '$push' : {'released' : {'$each' : claimed_iters}}})
+
+
+    def renew_leases(self, trials):
+        ''' Renew the leases of some of the trials this controller has handed out, e.g. for one worker of a SuggestionServer.
+
+        Parameters
+        ----------
+        trials : list
+            1D arrays of encoded hyperparameters, trials that aren't in flight any more are skipped
+        '''
+        with self._lock:
+            claimed_iters = [self._in_flight[tuple(x)] for x in trials if tuple(x) in self._in_flight]
+        if self.lease_duration is None or not claimed_iters:
+            return
+        lease = time.time() + self.lease_duration
+        requests = [('update_one', {'_id' : self.raster_id, 'pending.iter' : claimed_iter}, {'$set' : {'pending.$.lease' : lease}})
+                    for claimed_iter in claimed_iters]
+        with self.instrumentation.phase('heartbeat'):
+            bulk_write(self.col, requests, ordered=False)
+
+
+    def _expired(self, pending):
+        ''' Pending trials whose lease has run out, oldest iteration first. Trials handed out without a lease never expire. '''
+        now = time.time()
+        return sorted([p for p in pending if p.get('lease', now) < now], key=lambda p: p['iter'])
+
+
+    def _reclaim_trials(self, num_trials):
+        ''' Take over trials whose lease ran out, e.g. because their worker died, before new iterations are claimed.
+
+        Each trial is taken over by renewing its lease only if it still holds the expired value, so concurrent
+        callers never take over the same trial. The pending trials are only read once the earliest lease seen
+        could have run out, at most once per lease_duration while none do.
+
+        Parameters
+        ----------
+        num_trials : int
+            Most trials to take over
+
+        Returns
+        -------
+        reclaimed_iters : list
+            Iterations of the trials taken over
+        trials : list
+            1D arrays of encoded hyperparameters, one per iteration
+        '''
+        reclaimed_iters, trials = [], []
+        now = time.time()
+        if self.lease_duration is None or now < self._next_lease_check:
+            return reclaimed_iters, trials
+
+        with self.instrumentation.phase('claim'):
+            pending = self.col.find_one({'_id' : self.raster_id}, projection={'pending' : True}).get('pending', [])
+            # Trials handed out later get leases beyond now + lease_duration
+            self._next_lease_check = min([p['lease'] for p in pending if 'lease' in p] + [now + self.lease_duration])
+            for entry in self._expired(pending):
+                if len(trials) == num_trials:
+                    break
+                result = self.col.update_one({'_id' : self.raster_id, 'pending' : {'$elemMatch' : {'iter' : entry['iter'], 'lease' : entry['lease']}}},
+                                             {'$set' : {'pending.$.lease' : time.time() + self.lease_duration}})
+                if result.modified_count == 1:
+                    print('Handing out trial {} again, its lease ran out'.format(entry['iter'] + 1))
+                    self._in_flight[tuple(entry['x'])] = entry['iter']
+                    reclaimed_iters.append(entry['iter'])
+                    trials.append(np.array(entry['x']))
+        return reclaimed_iters, trials
+
+
+    def _study_key(self):
+        ''' Key identifying this study in the process-local surrogate cache. '''
+        return (self.experiment.get('controller_host', self.experiment.get('controller_path')),
+                self.experiment.get('controller_port'),
+                self.experiment['controller_database'],
+                self.experiment['controller_collection'],
+                self.raster_id)
+
+
+    def _restore_surrogate(self, b_opt, num_observations):
+        ''' Seed a fresh optimizer with the cached surrogate of this study, if one can be reused.
+
+        The cached GP is updated with the current observations and its kernel hyperparameters are
+        warm started from the last fit. A full refit, with GPyOpt's default restarts, is left to the
+        optimizer when nothing is cached or refit_interval observations have arrived since the last one.
+
+        Parameters
+        ----------
+        b_opt : GPyOpt.methods.BayesianOptimization
+            Optimizer about to suggest the next locations
+        num_observations : int
+            Number of observations the optimizer was given
+
+        Returns
+        -------
+        warm_started : bool
+            True if the cached surrogate was reused, False if a full refit will happen
+        '''
+        # Tree ensembles have no hyperparameters to warm start, they're refit every time
+        from .surrogates import GP_SURROGATES
+        if self.surrogate not in GP_SURROGATES:
+            return False
+
+        with _surrogate_lock:
+            cached = _surrogate_cache.get(self._study_key())
+
+        if cached is None or num_observations < cached['num_observations']:
+            return False
+        if num_observations - cached['last_refit'] >= self.refit_interval:
+            return False
+
+        b_opt.model.model = cached['model'].copy()
+        b_opt.model.optimize_restarts = 1
+        
+        # Nothing new has been observed, the cached hyperparameters are already optimal
+        if num_observations == cached['num_observations']:
+            b_opt.model.max_iters = 0
+        else:
+            b_opt.model.max_iters = self.warm_start_iters
+        return True
+
+
+    def _store_surrogate(self, b_opt, num_observations, warm_started):
+        ''' Cache the surrogate fitted by an optimizer for the next suggestion of this study.
+
+        Parameters
+        ----------
+        b_opt : GPyOpt.methods.BayesianOptimization
+            Optimizer that has just suggested the next locations
+        num_observations : int
+            Number of observations the optimizer was given
+        warm_started : bool
+            Whether the surrogate was warm started from the cache rather than fully refit
+        '''
+        from .surrogates import GP_SURROGATES
+        if self.surrogate not in GP_SURROGATES:
+            return
+
+        key = self._study_key()
+        with _surrogate_lock:
+            # Record where the last full refit happened, warm starts keep the previous one. An entry evicted
+            # since the warm start is stored as if fully refit
+            previous = _surrogate_cache.get(key)
+            if warm_started and previous is not None:
+                last_refit = previous['last_refit']
+            else:
+                last_refit = num_observations
+                
+            _surrogate_cache[key] = {'model' : b_opt.model.model,
+                                     'num_observations' : num_observations,
+                                     'last_refit' : last_refit}
     
 
+    def _start_prefetch(self, in_flight):
+        ''' Start computing the next suggestion in the background while the current trial trains.
+
+        Parameters
+        ----------
+        in_flight : array
+            1D array of the trial currently being evaluated, treated as pending so it isn't suggested again
+        '''
+        self._prefetched = None
+        self._prefetch_thread = threading.Thread(target=self._prefetch, args=(np.atleast_2d(in_flight),), daemon=True)
+        self._prefetch_thread.start()
+
+
+    def _prefetch(self, pending_X):
+        ''' Suggest the next trial from a snapshot of the design, run on the prefetch thread.
+
+        Parameters
+        ----------
+        pending_X : array
+            2D array of trials that have been handed out but not reported, besides those in the design store
+        '''
+        try:
+            # Snapshot the synced part of the replica and read only what came after it
+            num_synced = self._num_synced or 0
+            X_steps, Y_steps = self.X_steps[:num_synced], self.Y_steps[:num_synced]
+            raster = self._read_tail(num_synced)
+            if raster is None:
+                X_steps, Y_steps = [], []
+                raster = self.col.find_one({'_id' : self.raster_id}, projection={'X_steps' : True, 'Y_steps' : True, 'pending' : True})
+            raster['X_steps'] = X_steps + decode_rows(raster['X_steps'])
+            raster['Y_steps'] = Y_steps + decode_rows(raster['Y_steps'])
+            if raster['X_steps'] == []:
+                return
+            pending_X = np.vstack([pending_X, self._pending_X(raster.get('pending', []), len(self.bounds))])
+            x_next = self._suggest_locations(1, raster['X_steps'], raster['Y_steps'], pending_X)
+            self._prefetched = {'next_trial' : x_next[0], 'num_observations' : len(raster['X_steps'])}
+        except Exception as e:
+            print('Prefetching the next trial failed: {}'.format(e))
+
+
+    def _take_prefetched(self):
+        ''' Wait for the prefetch thread and take its trial, unless the design has moved on too far since.
+
+        Call it on a freshly read design, the trial is also discarded if another worker has since been handed
+        it or reported it.
+
+        Returns
+        -------
+        next_trial : array
+            1D array of encoded hyperparameters, or None if there is no usable prefetched trial
+        '''
+        if self._prefetch_thread is None:
+            return None
+        with self.instrumentation.phase('prefetch_wait'):
+            self._prefetch_thread.join()
+        self._prefetch_thread = None
+
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is None:
+            return None
+        if len(self.X_steps) - prefetched['num_observations'] > self.prefetch_max_staleness:
+            print('Discarding stale prefetched trial')
+            return None
+        if self._is_taken(prefetched['next_trial']):
+            print('Discarding prefetched trial, another worker took it')
+            return None
+        return prefetched['next_trial']
+
+
+    def _is_taken(self, trial):
+        ''' Whether a trial is pending or observed in the local replica of the design. '''
+        trial = np.asarray(trial, dtype=float)
+        with self._lock:
+            taken = [p['x'] for p in self.pending] + list(self.X_steps)
+        return len(taken) > 0 and bool(np.any(np.all(np.array(taken, dtype=float) == trial, axis=1)))
+
+
     def _set_val(self, key, value):
         ''' Set a value on the controller mongo document
         
@@ -142,7 +878,14 @@ class ExperimentController(BaseReader, BaseConnection):
         value : array/int/float
             Any valid mongo type, the updated value the element being set
         '''
-        self.col.update_one({'_id' : self.raster_id}, {'$set' : {key : value}})
+        update = {key : value}
+
+        # Overwriting the observations versions the design by its new size, and the replica is read again in full
+        if key in ['X_steps', 'Y_steps']:
+            update['num_observations'] = len(value)
+            self._num_synced = None
+        with self.instrumentation.phase('write'):
+            self.col.update_one({'_id' : self.raster_id}, {'$set' : update})
 
 
     def update_design(self, x_step, y_step):
@@ -158,13 +901,29 @@ class ExperimentController(BaseReader, BaseConnection):
         assert type(y_step) == list
         assert type(x_step) == numpy.ndarray
 
-        self._get_design()
-
-        self.X_steps.append(list(x_step))
-        self._set_val('X_steps', self.X_steps)
+        # Append x and y together in a single atomic write, so concurrent results are never lost
+        # and the cost of an update doesn't grow with the size of the design
+        # The same write retires the trial from the pending list, by iteration if this controller handed it out
+        x_step = x_step.tolist()
+        with self._lock:
+            claimed_iter = self._in_flight.pop(tuple(x_step), None)
+        retired = {'x' : x_step} if claimed_iter is None else {'iter' : claimed_iter}
+        x_stored, y_stored = encode_row(x_step, self.design_encoding), encode_row(y_step, self.design_encoding)
+        with self.instrumentation.phase('write'):
+            raster = self.col.find_one_and_update({'_id' : self.raster_id},
+                                                  {'$push' : {'X_steps' : x_stored, 'Y_steps' : y_stored},
+                                                   '$pull' : {'pending' : retired},
+                                                   '$inc' : {'num_observations' : 1}},
+                                                  projection={'num_observations' : True},
+                                                  return_document=ReturnDocument.AFTER)
 
-        self.Y_steps.append(y_step)
-        self._set_val('Y_steps', self.Y_steps)
+        # The observation is in the replica either way, but only counts as synced if nobody else's came first
+        with self._lock:
+            in_order = self._num_synced is not None and len(self.X_steps) == self._num_synced
+            self.X_steps.extend(decode_rows([x_stored]))
+            self.Y_steps.extend(decode_rows([y_stored]))
+            if in_order and raster is not None and raster.get('num_observations') == self._num_synced + 1:
+                self._num_synced += 1
 
 
     def get_next_suggestion(self):
@@ -175,22 +934,131 @@ class ExperimentController(BaseReader, BaseConnection):
         next_trial : array
             1D array giving the encoded hyperparamters for the next experiment
         '''
+        with self.instrumentation.phase('suggestion'):
+            # Trials abandoned by their worker are handed out again before new iterations are claimed
+            _, reclaimed = self._reclaim_trials(1)
+            if reclaimed:
+                self.next_trial = reclaimed[0]
+                return self.next_trial
+
+            # Claim an iteration, the claimed slot decides whether this is a warm up or a bayesian trial
+            claimed_iter = self._tally_an_iteration()
+
+            # A suggestion that fails, e.g. on a bayesian slot before any result is reported, gives the iteration back
+            try:
+                # If we're still warming up, get an experiment from the warmup
+                if claimed_iter < self.num_warm_up:
+                    warm_up_str = 'Getting warmup trial: (' + str(claimed_iter+1) + '/' + str(self.num_warm_up) + ')'
+                    print(warm_up_str)
+                    self.next_trial = self._checkout_warmup(claimed_iter)
+                    self._mark_pending([claimed_iter], [self.next_trial])
+
+                # Otherwise get the latest design of executed experiments and perform bayesian optimization
+                else:
+                    trial_str = 'Getting trial: (' + str(claimed_iter+1) + '/' + str(self.max_iter) + ')'
+                    print(trial_str)
+                    self._get_design()
+                    self.next_trial = self._take_prefetched()
+                    if self.next_trial is None:
+                        self.next_trial = self._do_bayesian_optimization()
+                    self.next_trial = self._mark_suggested([claimed_iter], [self.next_trial])[0]
+            except Exception:
+                self._release_iterations([claimed_iter])
+                raise
+
+            # Compute the trial after this one while this one trains
+            if self.prefetch and self.next_iter >= self.num_warm_up:
+                self._start_prefetch(self.next_trial)
+
+            return self.next_trial
+
+
+    def get_next_suggestions(self, num_suggestions):
+        ''' Get a batch of hyperparameters, claiming all of their iterations at once and fitting the surrogate only once.
         
-        # Get the latest design of executed experiments
-        self._get_design()
-        
-        # If we're still warming up, get an experiment from the warmup
-        if self.next_iter+1 <= self.num_warm_up:
-            warm_up_str = 'Getting warmup trial: (' + str(self.next_iter+1) + '/' + str(self.num_warm_up) + ')'
-            print(warm_up_str)
-            self.next_trial = self._checkout_warmup()
-            
-        # Otherwise perform bayesian optimization to get the next recommended experiment
-        else:
-            trial_str = 'Getting trial: (' + str(self.next_iter+1 ) + '/' + str(self.max_iter) + ')'
-            print(trial_str)
-            self.next_trial = self._do_bayesian_optimization()
+        Parameters
+        ----------
+        num_suggestions : int
+            Number of trials to return, e.g. one per available gpu
+
+        Returns
+        -------
+        next_trials : array
+            2D array, each row gives the encoded hyperparameters for one experiment
+        '''
+        with self.instrumentation.phase('suggestion'):
+            claimed_iters, next_trials, num_bayesian = self._claim_suggestions(num_suggestions)
+            try:
+                if num_bayesian > 0:
+                    self._get_design()
+                    next_trials.extend(self._suggest_locations(num_bayesian))
+                return self._finish_suggestions(claimed_iters, next_trials)
+            except Exception:
+                self._release_iterations(claimed_iters)
+                raise
+
+
+    def _claim_suggestions(self, num_suggestions):
+        ''' Take over expired trials, claim a block of iterations for the rest, and check out the warm up trials among them.
+
+        Returns
+        -------
+        claimed_iters : list
+            The newly claimed iterations
+        next_trials : list
+            Trials taken over from expired leases, followed by the warm up trials for the claimed warm up iterations
+        num_bayesian : int
+            Number of claimed iterations left for bayesian optimization
+        '''
+        assert num_suggestions > 0, 'num_suggestions must be a positive integer'
+
+        # Trials abandoned by their worker are handed out again before new iterations are claimed
+        _, next_trials = self._reclaim_trials(num_suggestions)
+        num_new = num_suggestions - len(next_trials)
+        if num_new == 0:
+            return [], next_trials, 0
+
+        # Claim a block of iterations, the claimed slots decide how many come from the warm up
+        claimed_iters = self._tally_iterations(num_new)
+        warm_up_iters = [i for i in claimed_iters if i < self.num_warm_up]
+        num_bayesian = num_new - len(warm_up_iters)
+
+        trial_str = 'Getting trials: (' + str(claimed_iters[0]+1) + '-' + str(claimed_iters[-1]+1) + '/' + str(self.max_iter) + ')'
+        print(trial_str)
+
+        next_trials.extend([self._checkout_warmup(i) for i in warm_up_iters])
+        return claimed_iters, next_trials, num_bayesian
+
+
+    def _finish_suggestions(self, claimed_iters, next_trials):
+        ''' Record a batch of trials as pending for their claimed iterations, and return them as a 2D array.
+
+        Trials taken over first are pending already, the warm up trials follow and the bayesian trials come last.
+        The bayesian trials are recorded first, they are suggested again if another worker suggested them too.
+        '''
+        next_trials = list(next_trials)
+        warm_up_iters = [i for i in claimed_iters if i < self.num_warm_up]
+        bayesian_iters = [i for i in claimed_iters if i >= self.num_warm_up]
+        num_reclaimed = len(next_trials) - len(claimed_iters)
+        if bayesian_iters:
+            next_trials[len(next_trials) - len(bayesian_iters):] = self._mark_suggested(bayesian_iters, next_trials[len(next_trials) - len(bayesian_iters):])
+        self._mark_pending(warm_up_iters, next_trials[num_reclaimed:num_reclaimed + len(warm_up_iters)])
+        self.next_trials = np.array(next_trials)
+        return self.next_trials
+
+
+    def __getstate__(self):
+        ''' Leave out the database connection, the prefetch thread and the hooks, so a controller can be sent to a fit process. '''
+        state = self.__dict__.copy()
+        for key in ['db', 'col', '_prefetch_thread', '_prefetched', '_grid', '_lock']:
+            state.pop(key, None)
+        state['instrumentation'] = Instrumentation('controller')
+        return state
+
 
-        # Update the number of experiments that have been tried to the database server as well as locally
-        self._tally_an_iteration()
-        return self.next_trial
\ No newline at end of file
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._prefetch_thread = None
+        self._prefetched = None
+        self._grid = None
@@ -0,0 +1,236 @@
+import numpy as np
+
+
+def random_design(num_samples, num_dimensions, rng):
+    ''' Independent uniform samples in the unit cube. '''
+    return rng.random((num_samples, num_dimensions))
+
+
+def latin_design(num_samples, num_dimensions, rng):
+    ''' Latin hypercube samples in the unit cube, each dimension is split into num_samples strata hit exactly once. '''
+    strata = np.argsort(rng.random((num_samples, num_dimensions)), axis=0)
+    return (strata + rng.random((num_samples, num_dimensions))) / num_samples
+
+
+def sobol_design(num_samples, num_dimensions, rng):
+    ''' Scrambled Sobol samples in the unit cube, the first num_samples points of a sequence with a power of 2 length. '''
+    from scipy.stats import qmc
+    m = int(np.ceil(np.log2(max(num_samples, 1))))
+    return qmc.Sobol(num_dimensions, scramble=True, seed=rng).random_base2(m)[:num_samples]
+
+
+def halton_design(num_samples, num_dimensions, rng):
+    ''' Scrambled Halton samples in the unit cube. '''
+    from scipy.stats import qmc
+    return qmc.Halton(num_dimensions, scramble=True, seed=rng).random(num_samples)
+
+
+# Warm up strategies, each maps (num_samples, num_dimensions, rng) to samples in the unit cube
+WARM_UP_DESIGNS = {'random' : random_design,
+                   'latin' : latin_design,
+                   'sobol' : sobol_design,
+                   'halton' : halton_design}
+
+
+def warm_up_design(bounds, num_samples, strategy='latin', seed=None):
+    ''' Create a warm up table over the hyperparameter bounds, each row is an experiment, each column a hyperparameter.
+
+    Rows are drawn with the chosen space filling strategy and mapped onto the domains. Duplicate rows are
+    then replaced with rows sampled without replacement from the discrete product, so no row repeats
+    whenever the product has at least num_samples combinations.
+
+    Parameters
+    ----------
+    bounds : list
+        Hyperparameter dictionaries in the format required by GPyOpt
+    num_samples : int
+        Number of warm up experiments
+    strategy : str or callable
+        Name of a strategy in WARM_UP_DESIGNS, 'unique' to sample the discrete product without replacement,
+        or a function with the same signature as the WARM_UP_DESIGNS strategies
+    seed : int
+        Seed for the random generator
+
+    Returns
+    -------
+    warm_up_array : array
+        2D array of encoded hyperparameter combinations
+    '''
+    rng = np.random.default_rng(seed)
+    num_dimensions = len(bounds)
+    discrete = np.array([b['type'] == 'discrete' for b in bounds])
+    sizes = np.array([len(b['domain']) if b['type'] == 'discrete' else 0 for b in bounds])
+
+    # Pad the discrete domains into one table, so every column is looked up at once
+    table = np.full((num_dimensions, max([1] + list(sizes))), np.nan)
+    for j, b in enumerate(bounds):
+        if discrete[j]:
+            table[j, :sizes[j]] = b['domain']
+    low = np.array([0. if discrete[j] else b['domain'][0] for j, b in enumerate(bounds)])
+    high = np.array([0. if discrete[j] else b['domain'][1] for j, b in enumerate(bounds)])
+
+    if strategy == 'unique':
+        unit = rng.random((num_samples, num_dimensions))
+        indices = np.zeros((num_samples, num_dimensions), dtype=int)
+
+        # Once the product is exhausted, duplicates can't be avoided and sampling starts over
+        filled = 0
+        while filled < num_samples and discrete.any():
+            sampled = _sample_product(sizes[discrete], num_samples - filled, rng)
+            indices[filled:filled + len(sampled), discrete] = sampled
+            filled += len(sampled)
+    else:
+        design = WARM_UP_DESIGNS[strategy] if isinstance(strategy, str) else strategy
+        unit = design(num_samples, num_dimensions, rng)
+        indices = np.minimum((unit * sizes).astype(int), np.maximum(sizes - 1, 0))
+
+        # Continuous columns always differ, only fully discrete rows can repeat
+        if discrete.all():
+            indices = _replace_duplicates(indices, sizes, rng)
+
+    warm_up_array = np.where(discrete, table[np.arange(num_dimensions), indices], low + unit * (high - low))
+    return warm_up_array
+
+
+def _product_size(sizes):
+    ''' Number of combinations in the discrete product, as an exact python integer. '''
+    total = 1
+    for s in sizes:
+        total *= int(s)
+    return total
+
+
+def _sample_product(sizes, num_samples, rng, exclude=None):
+    ''' Sample rows of domain indices from the discrete product without replacement.
+
+    Parameters
+    ----------
+    sizes : array
+        Number of values in each dimension's domain
+    num_samples : int
+        Number of rows to draw, capped at the number of combinations not excluded
+    rng : np.random.Generator
+        Random generator
+    exclude : set
+        Flat indices into the product that must not be drawn
+
+    Returns
+    -------
+    indices : array
+        2D array of domain indices, one row per sample
+    '''
+    exclude = set() if exclude is None else exclude
+    total = _product_size(sizes)
+    num_samples = min(num_samples, total - len(exclude))
+    if num_samples <= 0:
+        return np.zeros((0, len(sizes)), dtype=int)
+
+    # Small enough for numpy's integers, draw enough distinct flat indices to cover the excluded ones
+    if total < 2**62:
+        flat = rng.choice(total, size=min(total, num_samples + len(exclude)), replace=False)
+        flat = np.array([f for f in flat if f not in exclude][:num_samples], dtype=np.int64)
+        return np.stack(np.unravel_index(flat, sizes), axis=1)
+
+    # Otherwise collisions are vanishingly rare, draw independently and reject repeats
+    rows, seen = [], set(exclude)
+    while len(rows) < num_samples:
+        for row in rng.integers(0, sizes, size=(num_samples, len(sizes))):
+            key = _flat_index(row, sizes)
+            if key not in seen:
+                seen.add(key)
+                rows.append(row)
+    return np.array(rows[:num_samples])
+
+
+def _flat_index(row, sizes):
+    ''' Exact flat index of a row of domain indices into the discrete product. '''
+    key = 0
+    for i, s in zip(row, sizes):
+        key = key * int(s) + int(i)
+    return key
+
+
+def _replace_duplicates(indices, sizes, rng):
+    ''' Replace repeated rows of domain indices with unused combinations from the discrete product. '''
+    _, first = np.unique(indices, axis=0, return_index=True)
+    if len(first) == len(indices):
+        return indices
+
+    keep = np.zeros(len(indices), dtype=bool)
+    keep[first] = True
+    exclude = set(_flat_index(row, sizes) for row in indices[keep])
+    replacements = _sample_product(sizes, int((~keep).sum()), rng, exclude)
+
+    # When the product is smaller than the table, the remaining rows have to stay duplicates
+    duplicate_rows = np.flatnonzero(~keep)[:len(replacements)]
+    indices = indices.copy()
+    indices[duplicate_rows] = replacements
+    return indices
+
+
+class CandidateGrid:
+    ''' Every combination of a fully discrete search space, enumerated in chunks by flat index into the product.
+
+    Grids up to max_cached rows are built once and kept, larger ones are built chunk by chunk as they're scanned.
+    '''
+
+    def __init__(self, bounds, max_cached=1000000):
+        '''
+        Parameters
+        ----------
+        bounds : list
+            Hyperparameter dictionaries in the format required by GPyOpt, every one discrete
+        max_cached : int
+            Largest number of rows to keep in memory
+        '''
+        assert all(b['type'] == 'discrete' for b in bounds), 'A candidate grid needs every hyperparameter to be discrete'
+        self.values = [np.array(b['domain'], dtype=float) for b in bounds]
+        self.sizes = np.array([len(v) for v in self.values])
+        self.size = _product_size(self.sizes)
+        self._grid = None
+        if self.size <= max_cached:
+            self._grid = self.rows(0, self.size)
+
+
+    def rows(self, start, stop):
+        ''' Encoded rows of the grid between two flat indices. '''
+        if self._grid is not None:
+            return self._grid[start:stop]
+        columns = np.unravel_index(np.arange(start, stop, dtype=np.int64), self.sizes)
+        return np.stack([v[c] for v, c in zip(self.values, columns)], axis=1)
+
+
+    def take(self, indices):
+        ''' Encoded rows of the grid at flat indices. '''
+        columns = np.unravel_index(np.asarray(indices, dtype=np.int64), self.sizes)
+        return np.stack([v[c] for v, c in zip(self.values, columns)], axis=-1)
+
+
+    def chunks(self, chunk_size):
+        ''' Yield (start, rows) chunks covering the whole grid. '''
+        for start in range(0, self.size, chunk_size):
+            yield start, self.rows(start, min(start + chunk_size, self.size))
+
+
+    def flat_indices(self, X):
+        ''' Flat indices of encoded rows, rows that aren't on the grid are left out.
+
+        Parameters
+        ----------
+        X : array
+            2D array of encoded hyperparameter combinations
+
+        Returns
+        -------
+        indices : array
+            1D array of flat indices into the grid
+        '''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if X.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        columns, on_grid = [], np.ones(len(X), dtype=bool)
+        for j, v in enumerate(self.values):
+            matches = np.isclose(X[:, j, None], v[None, :])
+            on_grid &= matches.any(axis=1)
+            columns.append(matches.argmax(axis=1))
+        return np.ravel_multi_index([c[on_grid] for c in columns], self.sizes).astype(np.int64)
@@ -0,0 +1,106 @@
+import numpy as np
+from bson.binary import Binary
+
+# Formats the design matrices can be stored in, see design_encoding in the config
+ENCODINGS = ['list', 'binary']
+
+# Packed values are little endian float64, whatever machine wrote them
+DTYPE = '<f8'
+
+
+def encode_row(row, encoding='list'):
+    ''' Encode one row of X_steps or Y_steps for the design store.
+
+    Parameters
+    ----------
+    row : list
+        1D list or array of floats
+    encoding : str
+        list to store an array of doubles, binary to store the row packed into one binary value
+
+    Returns
+    -------
+    stored : list or Binary
+    '''
+    if encoding == 'binary':
+        return Binary(np.asarray(row, dtype=DTYPE).tobytes())
+    return np.asarray(row, dtype=float).tolist()
+
+
+def decode_rows(rows):
+    ''' Decode stored rows of X_steps or Y_steps.
+
+    Each packed row is its own binary value in the store, so packed rows of the same length are joined into
+    one block, which copies them once, and decoded with a single np.frombuffer. They come back as read-only
+    row views of that block. Mixed rows, e.g. part way through a migration, are decoded one by one as views
+    of their stored bytes. Only matrices stored as one block, see decode_matrix, decode without any copy.
+    '''
+    if rows and all(isinstance(row, bytes) for row in rows) and len(set(map(len, rows))) == 1:
+        return list(np.frombuffer(b''.join(rows), dtype=DTYPE).reshape(len(rows), -1))
+    return [np.frombuffer(row, dtype=DTYPE) if isinstance(row, bytes) else row for row in rows]
+
+
+def encode_matrix(array, encoding='list'):
+    ''' Encode a whole matrix such as the warm up list for the design store.
+
+    Parameters
+    ----------
+    array : array
+        2D array of floats
+    encoding : str
+        list to store nested arrays of doubles, binary to store one packed block with its shape
+
+    Returns
+    -------
+    stored : list or dict
+    '''
+    array = np.asarray(array, dtype=float)
+    if encoding == 'binary':
+        return {'shape' : list(array.shape), 'dtype' : DTYPE, 'data' : Binary(array.astype(DTYPE).tobytes())}
+    return array.tolist()
+
+
+def decode_matrix(stored):
+    ''' Decode a stored matrix, a packed block becomes a read-only 2D array on the stored bytes without a copy. '''
+    if isinstance(stored, dict):
+        return np.frombuffer(stored['data'], dtype=stored['dtype']).reshape(stored['shape'])
+    return stored
+
+
+def migrate_design(col, encoding, design_id=None):
+    ''' Rewrite a stored design in another encoding.
+
+    The rewrite only goes through if no observation arrived since the design was read, otherwise it is read
+    and rewritten again, so concurrent results are never lost. Every controller of the study must be on a
+    version that reads the encoding before a design is migrated to binary.
+
+    Parameters
+    ----------
+    col : Collection
+        Controller collection holding the design
+    encoding : str
+        Encoding to migrate to, one of ENCODINGS
+    design_id : ObjectId
+        _id of the design, defaults to the only document in the collection
+
+    Returns
+    -------
+    migrated : bool
+        False if the design was already in the encoding
+    '''
+    assert encoding in ENCODINGS, 'encoding must be one of {}'.format(ENCODINGS)
+    query = {} if design_id is None else {'_id' : design_id}
+    while True:
+        raster = col.find_one(query)
+        if raster.get('encoding', 'list') == encoding:
+            return False
+
+        num_observations = len(raster['X_steps'])
+        update = {'X_steps' : [encode_row(x, encoding) for x in decode_rows(raster['X_steps'])],
+                  'Y_steps' : [encode_row(y, encoding) for y in decode_rows(raster['Y_steps'])],
+                  'warm_up_list' : encode_matrix(decode_matrix(raster['warm_up_list']), encoding),
+                  'num_observations' : num_observations,
+                  'encoding' : encoding}
+        result = col.update_one({'_id' : raster['_id'], 'X_steps' : {'$size' : num_observations}}, {'$set' : update})
+        if result.matched_count == 1:
+            return True
@@ -0,0 +1,150 @@
+import time
+import logging
+import threading
+import contextlib
+
+
+logger = logging.getLogger('ml_experiments.timing')
+
+# Upper bounds in seconds of the histogram buckets, the last bucket catches everything slower
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 60.)
+
+# Handed out for every phase while instrumentation is off, so timing a phase costs one method call
+_NULL_PHASE = contextlib.nullcontext()
+
+
+class Instrumentation:
+    ''' Records how long each phase of a component takes.
+
+    Every finished phase is passed to the registered hooks as hook(component, phase, seconds), logged
+    at DEBUG level to the ml_experiments.timing logger, and, if metrics are kept, added to per phase
+    counters and histograms. While it's off, phases aren't timed at all.
+    '''
+
+    def __init__(self, component, enabled=False, metrics=False, buckets=DEFAULT_BUCKETS):
+        '''
+        Parameters
+        ----------
+        component : str
+            Name reported with every timing, e.g. controller or recorder
+        enabled : bool
+            Whether to time phases, adding a hook turns this on
+        metrics : bool
+            Whether to keep counters and histograms of the timings, implies enabled
+        buckets : tuple
+            Upper bounds in seconds of the histogram buckets
+        '''
+        self.component = component
+        self.hooks = []
+        self.metrics = TimingMetrics(buckets) if metrics else None
+        self.enabled = enabled or metrics
+
+
+    @classmethod
+    def from_experiment(cls, component, experiment):
+        ''' Configure from the optional instrumentation and timing_metrics keys of an experiment config. '''
+        return cls(component,
+                   enabled=experiment.get('instrumentation', False),
+                   metrics=experiment.get('timing_metrics', False))
+
+
+    def add_hook(self, hook):
+        ''' Call hook(component, phase, seconds) after every phase, and turn instrumentation on. '''
+        self.hooks.append(hook)
+        self.enabled = True
+
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+
+    def phase(self, name):
+        ''' Context manager timing one phase. '''
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+
+    def record(self, name, seconds):
+        ''' Report the duration of a phase. '''
+        logger.debug('%s %s %.6fs', self.component, name, seconds)
+        if self.metrics is not None:
+            self.metrics.observe(name, seconds)
+        for hook in self.hooks:
+            hook(self.component, name, seconds)
+
+
+class _Phase:
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start)
+
+
+class TimingMetrics:
+    ''' Thread safe counters and histograms of phase durations. '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.phases = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, name, seconds):
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = {'count' : 0, 'total' : 0., 'min' : seconds, 'max' : seconds,
+                                             'buckets' : [0] * (len(self.buckets) + 1)}
+            phase['count'] += 1
+            phase['total'] += seconds
+            phase['min'] = min(phase['min'], seconds)
+            phase['max'] = max(phase['max'], seconds)
+            phase['buckets'][sum(1 for b in self.buckets if seconds > b)] += 1
+
+
+    def snapshot(self):
+        ''' Copy of the metrics, keyed by phase.
+
+        Returns
+        -------
+        metrics : dict
+            Per phase count, total, mean, min and max seconds, and the histogram as a list of
+            (upper bound, count) pairs, with None as the upper bound of the last bucket
+        '''
+        with self._lock:
+            return {name : {'count' : p['count'],
+                            'total' : p['total'],
+                            'mean' : p['total'] / p['count'],
+                            'min' : p['min'],
+                            'max' : p['max'],
+                            'histogram' : list(zip(self.buckets + (None,), p['buckets']))}
+                    for name, p in self.phases.items()}
+
+
+    def prometheus(self, component, prefix='ml_experiments'):
+        ''' The metrics in the prometheus text exposition format, as cumulative histograms. '''
+        metric = '{}_phase_seconds'.format(prefix)
+        lines = ['# TYPE {} histogram'.format(metric)]
+        for name, p in sorted(self.snapshot().items()):
+            labels = 'component="{}",phase="{}"'.format(component, name)
+            cumulative = 0
+            for bound, count in p['histogram']:
+                cumulative += count
+                le = '+Inf' if bound is None else repr(float(bound))
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, le, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(metric, labels, repr(p['total'])))
+            lines.append('{}_count{{{}}} {}'.format(metric, labels, p['count']))
+        return '\n'.join(lines) + '\n'
+
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
@@ -1,9 +1,26 @@
+import csv
 import datetime
+import functools
 import numpy as np
-import pkg_resources
-import pandas as pd
+from pymongo.errors import DuplicateKeyError
 from .base import BaseConnection, BaseReader
-from tensorflow.keras.callbacks import Callback
+from .writer import AsyncWriter
+from .instrumentation import Instrumentation
+from .stopping import early_stopping_rule
+
+
+# Experiment collections this process has already set up, see ExperimentRecorder._ensure_indexes
+_SET_UP_COLLECTIONS = set()
+
+
+@functools.lru_cache(maxsize=None)
+def load_name_pool():
+    '''Read the pool of experiment names shipped with the package, once per process.'''
+    import pkg_resources
+    path = '/names.csv'
+    filepath = pkg_resources.resource_filename(__name__, path)
+    with open(filepath, newline='') as f:
+        return tuple(row['name'] for row in csv.DictReader(f))
 
 
 class ExperimentNamer:
@@ -11,53 +28,98 @@ class ExperimentNamer:
     
     def __init__(self):
         '''Get a list of experiment names.'''
-        path = '/names.csv'
-        filepath = pkg_resources.resource_filename(__name__, path)
-        self.name_pool = list(pd.read_csv(filepath)['name'].values)
+        self.name_pool = load_name_pool()
+        self.used_names = set()
+        self.generation = 0
     
     
-    def get_used_names(self, df):
-        '''Get a list of all names in the field 'name' in a pandas dataframe.
+    def get_used_names(self, names):
+        '''Get the set of all experiment names that have already been used.
 
         Parameters:
         -----------
-        df (pd.DataFrame): dataframe where each row is an experiment
+        names (list): experiment names of the previous experiments
 
         '''
 
-        # There are no previous experiment names
-        if len(df) == 0:
-            self.used_names = []
-        else:
-            self.used_names = list(df.experiment_name.values)
+        self.used_names = set(names)
+        self.generation = 0
+
+
+    def generate_names(self, generation):
+        '''
+        Lazily generate the candidate names of one generation. Generation 0 is the name pool itself, 
+        each later generation adds the next suffix (_0, _1, ...) to the pool.
+        '''
+        
+        suffix = self._suffix(generation)
+        for name in self.name_pool:
+            yield name + suffix
+
+
+    def _suffix(self, generation):
+        ''' Suffix added to the pool's names in a generation.'''
+
+        return '' if generation == 0 else '_' + str(generation - 1)
 
     
     def get_unused_names(self):
         '''
-        Get a list a names from the name pool that aren't in the used names.
+        Move on to the first generation of candidate names that still has names that aren't used, without 
+        building any list of names.
         '''
         
-        self.unused_names = [name for name in self.name_pool if name not in self.used_names]
-        
-        # If all names are used, add a suffix to create an additional 1000 names
-        if len(self.unused_names) == 0:
-            for i in range(10):
-                suffix = '_' + str(i)
-                self.unused_names = [name + suffix for name in self.name_pool]
+        while all(name in self.used_names for name in self.generate_names(self.generation)):
+            self.generation += 1
+
+
+    def num_unused_names(self):
+        ''' Number of names of the current generation that aren't used yet.'''
+
+        return sum(name not in self.used_names for name in self.generate_names(self.generation))
 
 
     def get_random_unused_name(self):
-        ''' Draw a random name that isn't already used, and pop it from the list.'''
+        ''' Draw a random name of the current generation that isn't already used, and mark it as used.
+
+        Names are drawn from the pool until one is free, a name taken elsewhere in the meantime is rejected
+        by reserve_name.
+        '''
         
-        rand_idx = np.random.choice(len(self.unused_names), 1)[0]
-        random_name = self.unused_names.pop(rand_idx)
-        return random_name
+        self.get_unused_names()
+        suffix = self._suffix(self.generation)
+        while True:
+            random_name = self.name_pool[np.random.randint(len(self.name_pool))] + suffix
+            if random_name not in self.used_names:
+                self.used_names.add(random_name)
+                return random_name
+
+
+    def reserve_name(self, collection):
+        ''' Draw a random unused name and reserve it, so no other experiment can be given the same name.
+
+        The reservation is an insert keyed on the name itself, so two experiments drawing the same name at
+        the same time can't both succeed. The loser marks the name as used and draws again.
+
+        Parameters:
+        -----------
+        collection (pymongo.collection.Collection): collection holding one document per reserved name
+
+        '''
+
+        while True:
+            name = self.get_random_unused_name()
+            try:
+                collection.insert_one({'_id' : name, 'date_reserved' : datetime.datetime.utcnow()})
+                return name
+            except DuplicateKeyError:
+                continue
     
     
-class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection, Callback):
-    '''Class methods for recording experiments in mongo.'''
+class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection):
+    '''Class methods for recording experiments in mongo. Use KerasExperimentRecorder from ml_experiments.callbacks as a Keras callback.'''
         
-    def __init__(self, config_path, experiment=None):
+    def __init__(self, config_path, experiment=None, heartbeat=None):
         
         # Instantiate the experiment namer and name pool
         ExperimentNamer.__init__(self)
@@ -66,8 +128,12 @@ class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection, Callback):
         self.get_config(config_path)
         
         if experiment != None:
+            # Experiments from other sources belong to the study of this config unless they say otherwise
+            experiment.setdefault('trial_name', self.experiment['trial_name'])
             self.experiment = experiment
 
+        # Opt-in timing of the recording phases, see ml_experiments.instrumentation
+        self.instrumentation = Instrumentation.from_experiment('recorder', self.experiment)
 
         # Establish connection with mongoDB
         self.establish_db_connection('manager')
@@ -81,26 +147,70 @@ class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection, Callback):
             self.results[name] = []
             self.results['val_' + name] = []
 
+        # Number of epochs of results already written to mongo
+        self.num_recorded = 0
+
+        # Optional early stopping against the other experiments of this study, see ml_experiments.stopping
+        self.stopping_rule = early_stopping_rule(self.experiment)
+        self.stopping_metric = self.experiment.get('early_stopping_metric', 'val_' + self.experiment['train_metrics'][0])
+        assert self.stopping_metric in self.results, 'early_stopping_metric must be one of the recorded train_metrics or their val_ versions.'
+        self.stop_training = False
+        self.stopped_epoch = None
 
-        # Get any previous experiment names
-        previous_experiments = list(self.col.find())
-        df = pd.DataFrame(previous_experiments)
+        # Called at the end of every epoch to show the trial is alive, e.g. ExperimentController.heartbeat to renew its lease
+        self.heartbeat = heartbeat
+
+        # Results are either written on the training thread, or queued for a background writer
+        if self.experiment.get('async_recording', False):
+            self.writer = AsyncWriter(self.col, 
+                                      flush_interval=self.experiment.get('flush_interval', 5.),
+                                      max_queue_size=self.experiment.get('max_queue_size', 10000))
+        else:
+            self.writer = self.col
+
+
+        # Get the previous experiment names from the name reservations, one small document per name,
+        # without reading the experiments themselves
+        self.names_col = self.db[self.experiment['manager_collection'] + '_names']
+        self._ensure_indexes()
+        previous_names = self.names_col.distinct('_id')
 
         # Determine which names have been used
-        self.get_used_names(df)
+        self.get_used_names(previous_names)
         self.get_unused_names()
 
-        # Draw a random name to call this experiment
-        this_experiment_name = self.get_random_unused_name()
+        # Draw and reserve a random name to call this experiment
+        with self.instrumentation.phase('reserve_name'):
+            this_experiment_name = self.reserve_name(self.names_col)
         self.experiment['experiment_name'] = this_experiment_name
         print('{:12} {} {}'.format('', 'this experiment is called: ', this_experiment_name))
-        print('{:12} {} {} {}'.format('', 'WARNING', len(self.unused_names), 'experiment names remaining'))
+        print('{:12} {} {} {}'.format('', 'WARNING', self.num_unused_names(), 'experiment names remaining'))
 
         # Initalize empty lists for loss values
         self.loss = []
         self.val_loss = []
 
 
+    def _ensure_indexes(self):
+        ''' Set up the experiment collection once per process: index it for the early stopping peer query and the
+        names, and reserve the names of experiments
+        recorded before names were reserved, so the reservations hold every used name.
+        '''
+        key = tuple(self.experiment.get('manager_' + k) for k in ['backend', 'host', 'port', 'path', 'database', 'collection'])
+        if key in _SET_UP_COLLECTIONS:
+            return
+
+        self.col.create_index('experiment_name')
+        self.col.create_index('trial_name')
+        if self.names_col.estimated_document_count() == 0:
+            for name in self.col.distinct('experiment_name'):
+                try:
+                    self.names_col.insert_one({'_id' : name, 'date_reserved' : datetime.datetime.utcnow()})
+                except DuplicateKeyError:
+                    pass
+        _SET_UP_COLLECTIONS.add(key)
+
+
     def _merge_two_dicts(self, x, y):
         z = x.copy()
         z.update(y)
@@ -109,11 +219,25 @@ class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection, Callback):
     def create_experiment_entry(self):
         date = {'date_created' : datetime.datetime.utcnow()}
         experiment = self._merge_two_dicts(self.experiment, date)
-        self.entry_id = self.col.insert_one(experiment)
+        # The metrics start out empty and are filled in by epoch, see append_experiment_results
+        experiment = self._merge_two_dicts(experiment, {k : [] for k in self.results})
+        with self.instrumentation.phase('create_entry'):
+            self.entry_id = self.writer.insert_one(experiment)
         print('Created experiment entry: ', self.entry_id.inserted_id)
 
     def update_experiment_results(self, results):
-        self.col.update_one({'_id' : self.entry_id.inserted_id}, {'$set' : results})
+        with self.instrumentation.phase('write'):
+            self.writer.update_one({'_id' : self.entry_id.inserted_id}, {'$set' : results})
+        print('Experiment results succesfully recorded.')
+
+    def append_experiment_results(self, results):
+        ''' Append new values to the end of each recorded metric, without resending the values already recorded.
+
+        Each value is set at its epoch's index rather than pushed, so a write that is sent again doesn't repeat values.
+        '''
+        with self.instrumentation.phase('write'):
+            values = {'{}.{}'.format(k, self.num_recorded + i) : x for k, v in results.items() for i, x in enumerate(v)}
+            self.writer.update_one({'_id' : self.entry_id.inserted_id}, {'$set' : values})
         print('Experiment results succesfully recorded.')
 
         
@@ -127,4 +251,59 @@ class ExperimentRecorder(ExperimentNamer, BaseReader, BaseConnection, Callback):
             self.results[name].append(np.float64(logs[name]))
             self.results['val_'+name].append(np.float64(logs['val_'+name])) 
         if epoch >= self.start_recording:
-            self.update_experiment_results(self.results)
\ No newline at end of file
+            # Only send the epochs not recorded yet, the first write catches up on the epochs before start_recording
+            new_results = {k : v[self.num_recorded:] for k, v in self.results.items()}
+            self.append_experiment_results(new_results)
+            self.num_recorded = len(self.results[self.experiment['train_metrics'][0]])
+
+        if self.stopping_rule is not None and self.stopping_rule.checks(epoch) and self._should_stop(epoch):
+            self.stop(epoch)
+
+        if self.heartbeat is not None:
+            self.heartbeat()
+
+
+    def _should_stop(self, epoch):
+        ''' Compare this experiment's curve with the curves of the other experiments of the same study.
+
+        The peers are read on the training thread also with async_recording, with one query on the trial_name
+        index on the epochs the rule checks. Experiments without a study name aren't stopped.
+        '''
+        if self.experiment.get('trial_name') is None:
+            return False
+        with self.instrumentation.phase('early_stopping'):
+            peers = self.col.find({'trial_name' : self.experiment['trial_name'],
+                                   'experiment_name' : {'$ne' : self.experiment['experiment_name']}},
+                                  projection={self.stopping_metric : True})
+            peer_curves = [p[self.stopping_metric] for p in peers if self.stopping_metric in p]
+            return self.stopping_rule.should_stop(epoch, self.results[self.stopping_metric], peer_curves)
+
+
+    def stop(self, epoch):
+        ''' Stop training after this epoch, and mark the experiment as stopped early. '''
+        self.stop_training = True
+        self.stopped_epoch = epoch
+        print('Stopping early at epoch {}, {} is behind the other experiments'.format(epoch, self.stopping_metric))
+        if hasattr(self, 'entry_id'):
+            self.update_experiment_results({'stopped_early' : True, 'stopped_epoch' : epoch})
+
+
+    def get_objective(self):
+        ''' The result of this experiment to report with update_design, also for experiments that were stopped early.
+
+        Returns
+        -------
+        y_step : list
+            Best value of the early stopping metric so far, negated if higher values are better, since the
+            controller minimizes
+        '''
+        curve = self.results[self.stopping_metric]
+        if self.experiment.get('early_stopping_mode', 'min') == 'max':
+            return [-float(np.max(curve))]
+        return [float(np.min(curve))]
+
+    def on_train_end(self, logs=None):
+        if self.writer is not self.col:
+            # Write everything still queued and stop the writer thread, every recorder starts its own
+            with self.instrumentation.phase('flush'):
+                self.writer.close()
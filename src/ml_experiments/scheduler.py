@@ -0,0 +1,191 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+from .controller import ExperimentController
+
+
+# Candidate grids of the studies fit in this process, by study key. The copies of the controllers sent here
+# leave their grid behind, the surrogates are kept by the controller module's own cache
+_grids = {}
+
+
+def _suggest(controller, batch_size, pending_X):
+    ''' Fit a study's surrogate and suggest a batch, run in the study's fit process on a copy of the controller. '''
+    key = controller._study_key()
+    controller._grid = _grids.get(key)
+    try:
+        return controller._suggest_locations(batch_size, pending_X=pending_X)
+    finally:
+        if controller._grid is not None:
+            _grids[key] = controller._grid
+
+
+class StudyScheduler:
+    ''' Serves suggestions for many studies from one process.
+
+    Each study is an ExperimentController for its own yaml config. Controllers on the same server share one
+    client and connection pool, surrogate fits for different studies run side by side in fit processes, and
+    a fixed fleet of workers is apportioned across the studies that still have iterations left. A study is
+    always fit in the same process, which keeps its surrogate and candidate grid between fits.
+    '''
+
+    def __init__(self, config_paths, priorities=None, allocation='priority', num_processes=None, window=10):
+        '''
+        Parameters
+        ----------
+        config_paths : list
+            Paths to the yaml config of every study, a study is named by its config's file name
+        priorities : dict
+            Weight of each study by name in the fleet, studies left out have priority 1
+        allocation : str
+            priority to apportion the fleet by priority alone, expected_improvement to also weight each study
+            by how much its recent trials are expected to improve on its best result
+        num_processes : int
+            Number of fit processes, None uses one per cpu, 0 fits every study in this process
+        window : int
+            Number of recent observations the expected improvement of a study is estimated from
+        '''
+        assert allocation in ['priority', 'expected_improvement'], 'allocation must be either priority or expected_improvement'
+        self.studies = {}
+        for config_path in config_paths:
+            controller = ExperimentController(config_path)
+            name = controller.experiment['trial_name']
+            assert name not in self.studies, 'Two studies are named {}, study names come from the config file names'.format(name)
+            self.studies[name] = controller
+
+        priorities = {} if priorities is None else priorities
+        self.priorities = {name : priorities.get(name, 1.) for name in self.studies}
+        self.allocation = allocation
+        self.window = window
+        # One single process pool per fit process, so every study has a process of its own to come back to
+        num_processes = os.cpu_count() if num_processes is None else num_processes
+        self.pools = [ProcessPoolExecutor(max_workers=1) for _ in range(min(num_processes, len(self.studies)))]
+        self._fit_process = {name : i % len(self.pools) for i, name in enumerate(self.studies)} if self.pools else {}
+
+
+    def remaining(self, name):
+        ''' Number of iterations a study has left, including given back iterations and trials whose lease ran out. '''
+        controller = self.studies[name]
+        return (max(0, controller.max_iter - controller.next_iter) + len(controller.released)
+                + len(controller._expired(controller.pending)))
+
+
+    def expected_improvement(self, name):
+        ''' Expected improvement on a study's best result, estimated from its recent observations.
+
+        The recent objective values are treated as draws from a normal distribution, and the improvement
+        is measured in units of the spread of every objective value, so studies on different scales compare.
+        Studies without observations are given an expected improvement of 1.
+        '''
+        Y = np.array(self.studies[name].Y_steps, dtype=float).ravel()
+        if len(Y) < 2 or Y.std() == 0:
+            return 1.
+        recent = Y[-self.window:]
+        mu, sigma = recent.mean(), max(recent.std(), 1e-9)
+        z = (Y.min() - mu) / sigma
+        return float(((Y.min() - mu) * norm.cdf(z) + sigma * norm.pdf(z)) / Y.std())
+
+
+    def apportion(self, num_workers):
+        ''' Split a fleet of workers across the studies with iterations left, in proportion to their weights.
+
+        Parameters
+        ----------
+        num_workers : int
+            Number of workers to apportion
+
+        Returns
+        -------
+        allocation : dict
+            Number of workers for each study by name, no study is given more than its remaining iterations
+        '''
+        for controller in self.studies.values():
+            controller._get_design()
+        remaining = {name : self.remaining(name) for name in self.studies}
+        weights = {}
+        for name in self.studies:
+            if remaining[name] > 0:
+                weights[name] = self.priorities[name]
+                if self.allocation == 'expected_improvement':
+                    weights[name] *= self.expected_improvement(name)
+
+        allocation = {name : 0 for name in self.studies}
+        num_workers = min(num_workers, sum(remaining.values()))
+
+        # Largest remainder, studies that reach their remaining iterations drop out and the rest is split again
+        while num_workers > 0 and weights:
+            total = sum(weights.values())
+            if total <= 0:
+                weights = {name : 1. for name in weights}
+                total = len(weights)
+            shares = {name : num_workers * w / total for name, w in weights.items()}
+            counts = {name : int(np.floor(share)) for name, share in shares.items()}
+            for name in sorted(shares, key=lambda n: shares[n] - counts[n], reverse=True)[:num_workers - sum(counts.values())]:
+                counts[name] += 1
+
+            for name, count in counts.items():
+                count = min(count, remaining[name] - allocation[name])
+                allocation[name] += count
+                num_workers -= count
+                if allocation[name] >= remaining[name]:
+                    weights.pop(name)
+        return allocation
+
+
+    def get_next_suggestions(self, num_workers):
+        ''' Apportion a fleet of workers and get a trial for each, fitting the studies' surrogates in parallel.
+
+        Parameters
+        ----------
+        num_workers : int
+            Number of workers waiting for a trial
+
+        Returns
+        -------
+        next_trials : dict
+            2D array of trials for each study by name that was given workers
+        '''
+        claims, fits = {}, {}
+        for name, count in self.apportion(num_workers).items():
+            if count == 0:
+                continue
+            controller = self.studies[name]
+            claims[name] = controller._claim_suggestions(count)
+            num_bayesian = claims[name][2]
+            if num_bayesian > 0:
+                controller._get_design()
+                pending_X = controller._pending_X(controller.pending)
+                if self.pools:
+                    fits[name] = self.pools[self._fit_process[name]].submit(_suggest, controller, num_bayesian, pending_X)
+                else:
+                    fits[name] = (num_bayesian, pending_X)
+
+        # A study whose fit fails gives its claimed iterations back and gets no trials this time
+        next_trials = {}
+        for name, (claimed_iters, trials, num_bayesian) in claims.items():
+            controller = self.studies[name]
+            try:
+                if name in fits:
+                    trials.extend(fits[name].result() if self.pools else controller._suggest_locations(fits[name][0], pending_X=fits[name][1]))
+                next_trials[name] = controller._finish_suggestions(claimed_iters, trials)
+            except Exception as e:
+                print('Skipping study {}, its suggestions failed: {}'.format(name, e))
+                controller._release_iterations(claimed_iters)
+        return next_trials
+
+
+    def get_next_suggestion(self, name):
+        ''' Get the next trial of one study. '''
+        return self.studies[name].get_next_suggestion()
+
+
+    def update_design(self, name, x_step, y_step):
+        ''' Report the result of a trial of one study. '''
+        self.studies[name].update_design(x_step, y_step)
+
+
+    def close(self):
+        ''' Stop the fit processes. '''
+        for pool in self.pools:
+            pool.shutdown(wait=True)
@@ -0,0 +1,319 @@
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SuggestionServer:
+    ''' Long running service that owns an ExperimentController, its surrogate and its mongo connection.
+
+    Workers connect with a SuggestionClient over a local TCP or unix socket. Requests for suggestions
+    that arrive while a fit is running are queued, and served together by the next batch fit, so one
+    fit serves everyone waiting. With leases, each worker renews the leases of its own trials with
+    heartbeats, so the trials of a worker that dies are handed out again. Heartbeats and results are
+    answered on a thread of their own, so they never wait behind a fit. A worker that disconnects while
+    it waits for suggestions cancels them, and trials suggested for it are given back.
+    '''
+
+    def __init__(self, controller, host='127.0.0.1', port=0, path=None):
+        '''
+        Parameters
+        ----------
+        controller : ExperimentController
+            Controller whose state is served to the workers
+        host : str
+            Interface to listen on when serving over TCP
+        port : int
+            Port to listen on when serving over TCP, 0 lets the operating system choose
+        path : str
+            If set, serve over a unix socket at this path instead of TCP
+        '''
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.path = path
+
+        # A single thread runs the fits, and another the short calls that workers wait on while they train
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._update_executor = ThreadPoolExecutor(max_workers=1)
+        self._waiting = []
+        self._batch = None
+        self.server = None
+
+
+    async def start(self):
+        ''' Start listening for workers. '''
+        if self.path is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host=self.host, port=self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+
+    async def stop(self):
+        ''' Stop listening and release the controller thread. '''
+        self.server.close()
+        await self.server.wait_closed()
+        self._executor.shutdown(wait=True)
+        self._update_executor.shutdown(wait=True)
+
+
+    def serve_forever(self):
+        ''' Run the server on a new event loop until interrupted. '''
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.start())
+        print('Serving suggestions on {}'.format(self.path if self.path is not None else '{}:{}'.format(self.host, self.port)))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+
+    async def _handle_connection(self, reader, writer):
+        ''' Answer newline delimited json requests from one worker until it disconnects.
+
+        The next line is read while a request is answered, so a worker that disconnects is noticed while it waits.
+        '''
+        next_line = asyncio.ensure_future(reader.readline())
+        while True:
+            line = await next_line
+            if not line:
+                break
+            next_line = asyncio.ensure_future(reader.readline())
+
+            try:
+                request = json.loads(line.decode())
+                task = asyncio.ensure_future(self._dispatch(request))
+                await asyncio.wait([task, next_line], return_when=asyncio.FIRST_COMPLETED)
+                if not task.done() and not next_line.result():
+                    # The worker is gone, its queued suggestions are cancelled
+                    task.cancel()
+                    break
+                response = {'result' : await task}
+            except Exception as e:
+                response = {'error' : '{}: {}'.format(type(e).__name__, e)}
+            response['next_iter'] = self.controller.next_iter
+
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+        writer.close()
+
+
+    async def _dispatch(self, request):
+        ''' Route a request to the controller. '''
+        method = request['method']
+
+        if method == 'get_next_suggestion':
+            return (await self._queue_suggestions(1))[0]
+
+        elif method == 'get_next_suggestions':
+            return await self._queue_suggestions(request['num_suggestions'])
+
+        elif method == 'update_design':
+            x_step = np.array(request['x_step'])
+            return await self._run(self.controller.update_design, x_step, request['y_step'], executor=self._update_executor)
+
+        elif method == 'heartbeat':
+            return await self._run(self.controller.renew_leases, request['trials'], executor=self._update_executor)
+
+        elif method == 'status':
+            return {'max_iter' : self.controller.max_iter,
+                    'max_local_iter' : self.controller.max_local_iter,
+                    'hyperparameter_names' : self.controller.hyperparameter_names,
+                    'lease_duration' : self.controller.lease_duration}
+
+        else:
+            raise ValueError('Unknown method {}'.format(method))
+
+
+    async def _run(self, func, *args, executor=None):
+        ''' Run a blocking controller call on the fit thread, or on another executor. '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor if executor is None else executor, func, *args)
+
+
+    async def _queue_suggestions(self, num_suggestions):
+        ''' Wait for suggestions, coalescing with every other request waiting for some. '''
+        assert num_suggestions > 0, 'num_suggestions must be a positive integer'
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for _ in range(num_suggestions)]
+        self._waiting.extend(futures)
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._serve_batches())
+        return await asyncio.gather(*futures)
+
+
+    async def _serve_batches(self):
+        ''' Serve everyone waiting with one batch fit, repeating until nobody is left waiting. '''
+        try:
+            while self._waiting:
+                # Requests cancelled while they queued aren't suggested for
+                waiting, self._waiting = [f for f in self._waiting if not f.done()], []
+                if not waiting:
+                    continue
+                try:
+                    next_trials = await self._run(self.controller.get_next_suggestions, len(waiting))
+                except Exception as e:
+                    for future in waiting:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                # Requests cancelled while the fit ran, e.g. by a worker disconnecting, are already done and
+                # their trials are given back
+                unclaimed = []
+                for future, next_trial in zip(waiting, next_trials):
+                    if future.done():
+                        unclaimed.append(next_trial)
+                    else:
+                        future.set_result(np.asarray(next_trial).tolist())
+                if unclaimed:
+                    await self._run(self.controller.give_back, unclaimed)
+        finally:
+            self._batch = None
+
+
+class SuggestionClient:
+    ''' Thin client for a SuggestionServer, with the same surface as an ExperimentController. '''
+
+    def __init__(self, host='127.0.0.1', port=None, path=None, timeout=None):
+        '''
+        Parameters
+        ----------
+        host : str
+            Host of the suggestion server when connecting over TCP
+        port : int
+            Port of the suggestion server when connecting over TCP
+        path : str
+            Path of the suggestion server's unix socket, used instead of host and port if set
+        timeout : float
+            Socket timeout in seconds, None blocks until the server answers
+        '''
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile('rwb')
+
+        status = self._call('status')
+        self.max_iter = status['max_iter']
+        self.max_local_iter = status['max_local_iter']
+        self.hyperparameter_names = status['hyperparameter_names']
+        self.lease_duration = status['lease_duration']
+
+        # Trials handed to this worker and not reported yet, their leases are renewed by heartbeat
+        self._in_flight = []
+        self._last_heartbeat = 0.
+
+
+    def _call(self, method, **kwargs):
+        ''' Send one request and wait for its response. '''
+        request = dict(kwargs, method=method)
+        self.stream.write((json.dumps(request) + '\n').encode())
+        self.stream.flush()
+
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError('The suggestion server closed the connection.')
+        response = json.loads(line.decode())
+
+        self.next_iter = response['next_iter']
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+
+    def get_next_suggestion(self):
+        ''' Get the next hyperparameters from the suggestion server.
+
+        Returns
+        -------
+        next_trial : array
+            1D array giving the encoded hyperparamters for the next experiment
+        '''
+        self.next_trial = np.array(self._call('get_next_suggestion'))
+        self._in_flight.append(self.next_trial.tolist())
+        return self.next_trial
+
+
+    def get_next_suggestions(self, num_suggestions):
+        ''' Get a batch of hyperparameters from the suggestion server, served together with the other waiting workers.
+
+        Parameters
+        ----------
+        num_suggestions : int
+            Number of trials to get
+
+        Returns
+        -------
+        next_trials : array
+            2D array with one row of encoded hyperparameters per trial
+        '''
+        self.next_trials = np.array(self._call('get_next_suggestions', num_suggestions=num_suggestions))
+        self._in_flight.extend(self.next_trials.tolist())
+        return self.next_trials
+
+
+    def update_design(self, x_step, y_step):
+        ''' Send the result of a trial to the suggestion server.
+
+        Parameters
+        ----------
+        x_step : array
+            1D array of encoded hyperparameter combinations
+        y_step: list
+            value (loss) of objective function being optimzied over
+        '''
+        assert type(y_step) == list
+        assert type(x_step) == np.ndarray
+
+        self._call('update_design', x_step=x_step.tolist(), y_step=[float(y) for y in y_step])
+        if x_step.tolist() in self._in_flight:
+            self._in_flight.remove(x_step.tolist())
+
+
+    def heartbeat(self):
+        ''' Renew the leases of the trials this worker has been handed and not reported yet.
+
+        Call it while a trial trains, e.g. by passing it as the heartbeat of an ExperimentRecorder. Renewals
+        closer together than a quarter of lease_duration are skipped.
+        '''
+        now = time.time()
+        if self.lease_duration is None or not self._in_flight or now - self._last_heartbeat < self.lease_duration / 4:
+            return
+        self._call('heartbeat', trials=self._in_flight)
+        self._last_heartbeat = now
+
+
+    def close(self):
+        ''' Close the connection to the suggestion server. '''
+        self.stream.close()
+        self.sock.close()
+
+
+def main(argv=None):
+    ''' Run a suggestion server for a yaml config from the command line. '''
+    parser = argparse.ArgumentParser(description='Serve experiment suggestions to worker nodes.')
+    parser.add_argument('config', help='Path to the experiment yaml config')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--path', default=None, help='Serve over a unix socket at this path instead of TCP')
+    args = parser.parse_args(argv)
+
+    from .controller import ExperimentController
+    controller = ExperimentController(args.config)
+    SuggestionServer(controller, host=args.host, port=args.port, path=args.path).serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
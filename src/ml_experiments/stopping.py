@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class MedianStoppingRule:
+    ''' Stop a trial whose best value so far is worse than the median of its peers' best values at the same epoch. '''
+
+    def __init__(self, grace_period=5, min_peers=3, mode='min'):
+        '''
+        Parameters
+        ----------
+        grace_period : int
+            Epochs every trial trains before it can be stopped
+        min_peers : int
+            Number of peers that must have reached an epoch before trials are compared at it
+        mode : str
+            min if lower metric values are better, max otherwise
+        '''
+        self.grace_period = grace_period
+        self.min_peers = min_peers
+        self.mode = mode
+
+
+    def checks(self, epoch):
+        ''' Whether a decision is made at this epoch, peers are only read on these epochs. '''
+        return epoch >= self.grace_period
+
+
+    def should_stop(self, epoch, curve, peer_curves):
+        '''
+        Parameters
+        ----------
+        epoch : int
+            Epoch that has just ended, counted from 0
+        curve : list
+            Metric value of every epoch of this trial so far
+        peer_curves : list
+            Metric curves of the other trials of the study, finished or still running
+
+        Returns
+        -------
+        stop : bool
+            True if the trial should stop training
+        '''
+        if not self.checks(epoch):
+            return False
+        peers = best_so_far(peer_curves, epoch, self.mode)
+        if len(peers) < self.min_peers:
+            return False
+        return _worse(best_so_far([curve], epoch, self.mode)[0], np.median(peers), self.mode)
+
+
+class ASHA:
+    ''' Asynchronous successive halving, a trial only continues past a rung if it's in the top 1 / reduction_factor
+    of the trials that have reached that rung.
+
+    Rungs are at epochs grace_period * reduction_factor**k. Trials reach rungs at their own pace, so a decision
+    only waits for the peers that got there first.
+    '''
+
+    def __init__(self, grace_period=1, reduction_factor=3, min_peers=3, mode='min'):
+        '''
+        Parameters
+        ----------
+        grace_period : int
+            Epoch of the first rung
+        reduction_factor : int
+            Only the top 1 / reduction_factor of the trials at a rung continue
+        min_peers : int
+            Number of peers that must have reached a rung before trials are stopped at it
+        mode : str
+            min if lower metric values are better, max otherwise
+        '''
+        assert reduction_factor > 1, 'reduction_factor must be greater than 1'
+        self.grace_period = max(1, grace_period)
+        self.reduction_factor = reduction_factor
+        self.min_peers = min_peers
+        self.mode = mode
+
+
+    def checks(self, epoch):
+        ''' Whether this epoch is a rung, counting epochs from 1. '''
+        rung = self.grace_period
+        while rung < epoch + 1:
+            rung *= self.reduction_factor
+        return rung == epoch + 1
+
+
+    def should_stop(self, epoch, curve, peer_curves):
+        ''' Same parameters and return value as MedianStoppingRule.should_stop. '''
+        if not self.checks(epoch):
+            return False
+        peers = best_so_far(peer_curves, epoch, self.mode)
+        if len(peers) < self.min_peers:
+            return False
+
+        # Rank among everyone at the rung, the best max(1, n // reduction_factor) continue
+        value = best_so_far([curve], epoch, self.mode)[0]
+        num_better = sum(1 for p in peers if _worse(value, p, self.mode))
+        return num_better >= max(1, (len(peers) + 1) // self.reduction_factor)
+
+
+# Early stopping rules selected with the early_stopping key of the config
+EARLY_STOPPING = {'median' : MedianStoppingRule,
+                  'asha' : ASHA}
+
+
+def early_stopping_rule(experiment):
+    ''' Build the early stopping rule of an experiment config.
+
+    Parameters
+    ----------
+    experiment : dict
+        Experiment config, the rule is chosen with early_stopping and configured with grace_period,
+        reduction_factor, min_peers and early_stopping_mode
+
+    Returns
+    -------
+    rule : MedianStoppingRule or ASHA
+        None if early stopping is off
+    '''
+    name = experiment.get('early_stopping', None)
+    if name is None:
+        return None
+    assert name in EARLY_STOPPING, 'early_stopping must be one of {}'.format(list(EARLY_STOPPING.keys()))
+
+    kwargs = {'min_peers' : experiment.get('min_peers', 3),
+              'mode' : experiment.get('early_stopping_mode', 'min')}
+    if 'grace_period' in experiment:
+        kwargs['grace_period'] = experiment['grace_period']
+    if name == 'asha':
+        kwargs['reduction_factor'] = experiment.get('reduction_factor', 3)
+    return EARLY_STOPPING[name](**kwargs)
+
+
+def best_so_far(curves, epoch, mode='min'):
+    ''' Best value of every curve up to and including an epoch, leaving out curves that haven't reached it. '''
+    best = np.min if mode == 'min' else np.max
+    return [float(best(c[:epoch + 1])) for c in curves if len(c) > epoch]
+
+
+def _worse(value, other, mode):
+    return value > other if mode == 'min' else value < other
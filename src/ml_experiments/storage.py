@@ -0,0 +1,565 @@
+import copy
+import pickle
+import sqlite3
+import threading
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from pymongo.results import InsertOneResult, UpdateResult, DeleteResult, BulkWriteResult
+
+
+class LocalClient:
+    ''' Embedded, single machine stand-in for a MongoClient, backed by one SQLite file.
+
+    Every write runs in an immediate SQLite transaction, so read-modify-write updates such as $inc, $push
+    and find_one_and_update are atomic across threads and across processes sharing the file.
+    '''
+
+    def __init__(self, path, timeout=30.):
+        '''
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite file, ':memory:' keeps everything in this process
+        timeout : float
+            Seconds to wait for another process to release the file lock
+        '''
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+
+    def __getitem__(self, name):
+        return LocalDatabase(self, name)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class LocalDatabase:
+    ''' A namespace of collections in a LocalClient. '''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return LocalCollection(self, name)
+
+    def drop_collection(self, name):
+        self[name].drop()
+
+
+class LocalCollection:
+    ''' SQLite table of pickled documents, implementing the part of the pymongo Collection API used by the library.
+
+    Queries support equality on (dotted) fields and the $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+    $exists, $size, $elemMatch, $and and $or operators. Projections include or exclude fields and $slice arrays.
+    Updates support $set, $unset, $inc, $min, $max, $push (with $each), $addToSet, $pop, $pull and $setOnInsert,
+    and the positional $ for the array element matched by the query.
+    Indexes are accepted for compatibility, only _id is unique.
+
+    Each document is stored whole, so every update reads and rewrites the entire document and costs time in
+    proportion to its size, e.g. to the number of observations in a design. That's fine for the studies of one
+    machine, large studies belong on mongo.
+    '''
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database.name, name)
+        self._client = database.client
+        self._table = '"{}"'.format(self.full_name.replace('"', '""'))
+        with self._client.lock:
+            self._client.connection.execute('CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, doc BLOB)'.format(self._table))
+
+
+    def _execute(self, sql, params=()):
+        return self._client.connection.execute(sql.format(table=self._table), params)
+
+
+    def _transaction(self):
+        ''' Lock the collection within this process and the SQLite file across processes. '''
+        return _Transaction(self._client)
+
+
+    def _scan(self, filter):
+        ''' Yield the documents matching a filter, in insertion order. '''
+        for blob, doc in self._scan_blobs(filter):
+            yield doc
+
+
+    def _scan_blobs(self, filter):
+        ''' Yield the documents matching a filter along with their stored blobs, in insertion order. '''
+        filter = filter or {}
+        if set(filter.keys()) == {'_id'} and not _is_operator_dict(filter['_id']):
+            rows = self._execute('SELECT doc FROM {table} WHERE id = ?', (_key(filter['_id']),)).fetchall()
+        else:
+            rows = self._execute('SELECT doc FROM {table} ORDER BY rowid').fetchall()
+
+        for (blob,) in rows:
+            doc = pickle.loads(blob)
+            if _match(doc, filter):
+                yield blob, doc
+
+
+    def _store(self, doc, blob):
+        self._execute('UPDATE {table} SET doc = ? WHERE id = ?', (blob, _key(doc['_id'])))
+
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        try:
+            self._execute('INSERT INTO {table} (id, doc) VALUES (?, ?)', (_key(doc['_id']), pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)))
+        except sqlite3.IntegrityError:
+            raise DuplicateKeyError('E11000 duplicate key error collection: {} _id: {!r}'.format(self.full_name, doc['_id']))
+        return doc
+
+
+    def insert_one(self, document):
+        with self._transaction():
+            doc = self._insert(document)
+        document['_id'] = doc['_id']
+        return InsertOneResult(doc['_id'], True)
+
+
+    def insert_many(self, documents):
+        return [self.insert_one(d).inserted_id for d in documents]
+
+
+    def find(self, filter=None, projection=None):
+        with self._client.lock:
+            docs = list(self._scan(filter))
+        return iter([_project(d, projection) for d in docs])
+
+
+    def find_one(self, filter=None, projection=None):
+        with self._client.lock:
+            for doc in self._scan(filter):
+                return _project(doc, projection)
+        return None
+
+
+    def _update(self, filter, update, upsert, many=False):
+        ''' Apply an update inside the caller's transaction.
+
+        Returns the matched documents as (before, after) pairs, where before is the stored blob of the document
+        before the update, or None if it was upserted. A document is only written back if the update changed it.
+        '''
+        matched = []
+        for before, doc in self._scan_blobs(filter):
+            _apply_update(doc, update, filter)
+            after = pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+            if after != before:
+                self._store(doc, after)
+            matched.append((before, after, doc))
+            if not many:
+                break
+
+        if not matched and upsert:
+            doc = {k : v for k, v in filter.items() if not k.startswith('$') and '.' not in k and not _is_operator_dict(v)}
+            _apply_update(doc, update, filter, inserting=True)
+            doc = self._insert(doc)
+            matched.append((None, None, doc))
+        return matched
+
+
+    def update_one(self, filter, update, upsert=False):
+        with self._transaction():
+            matched = self._update(filter, update, upsert)
+        return _update_result(matched)
+
+
+    def update_many(self, filter, update, upsert=False):
+        with self._transaction():
+            matched = self._update(filter, update, upsert, many=True)
+        return _update_result(matched)
+
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=False, upsert=False):
+        ''' Atomically update a document and return it, before the update unless return_document is True (ReturnDocument.AFTER). '''
+        with self._transaction():
+            matched = self._update(filter, update, upsert)
+        if not matched:
+            return None
+        before, after, doc = matched[0]
+        if not return_document:
+            if before is None:
+                return None
+            doc = pickle.loads(before)
+        return _project(doc, projection)
+
+
+    def delete_one(self, filter):
+        return self._delete(filter, many=False)
+
+
+    def delete_many(self, filter):
+        return self._delete(filter, many=True)
+
+
+    def _delete(self, filter, many):
+        with self._transaction():
+            deleted = 0
+            for doc in self._scan(filter):
+                self._execute('DELETE FROM {table} WHERE id = ?', (_key(doc['_id']),))
+                deleted += 1
+                if not many:
+                    break
+        return DeleteResult({'n' : deleted}, True)
+
+
+    def bulk_write(self, requests, ordered=True):
+        ''' Apply ('insert_one', document) and ('update_one', filter, update[, upsert]) requests in a single transaction.
+
+        pymongo's own request classes don't expose their contents, use the module's bulk_write to write the
+        same requests to either backend. Like mongo, a request that fails stops an ordered bulk write, the
+        requests before it are kept, and a BulkWriteError gives the index of every failed request.
+        '''
+        inserted, matched, modified = 0, 0, 0
+        write_errors = []
+        with self._transaction():
+            for index, request in enumerate(requests):
+                try:
+                    if request[0] == 'update_one':
+                        result = self._update(request[1], request[2], request[3] if len(request) > 3 else False)
+                        matched += len([m for m in result if m[0] is not None])
+                        modified += len([m for m in result if m[0] is not None and m[0] != m[1]])
+                    elif request[0] == 'insert_one':
+                        self._insert(request[1])
+                        inserted += 1
+                    else:
+                        raise ValueError('Unknown bulk write request {}'.format(request[0]))
+                except WriteError as e:
+                    write_errors.append({'index' : index, 'code' : e.code, 'errmsg' : str(e), 'op' : request[1]})
+                    if ordered:
+                        break
+        results = {'nInserted' : inserted, 'nMatched' : matched, 'nModified' : modified,
+                   'nUpserted' : 0, 'nRemoved' : 0, 'upserted' : []}
+        if write_errors:
+            raise BulkWriteError(dict(results, writeErrors=write_errors, writeConcernErrors=[]))
+        return BulkWriteResult(results, True)
+
+
+    def count_documents(self, filter):
+        with self._client.lock:
+            return sum(1 for _ in self._scan(filter))
+
+
+    def estimated_document_count(self):
+        with self._client.lock:
+            return self._execute('SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+    def distinct(self, key, filter=None):
+        values = []
+        with self._client.lock:
+            for doc in self._scan(filter):
+                for v in _expand(_resolve(doc, key.split('.'))):
+                    if not isinstance(v, list) and v not in values:
+                        values.append(v)
+        return values
+
+
+    def create_index(self, keys, **kwargs):
+        ''' Accepted for compatibility with pymongo, lookups other than by _id scan the collection. '''
+        return keys if isinstance(keys, str) else '_'.join('{}_{}'.format(k, d) for k, d in keys)
+
+
+    def drop(self):
+        with self._transaction():
+            self._execute('DELETE FROM {table}')
+
+
+class _Transaction:
+    ''' Immediate SQLite transaction, holding the client's lock for its duration. '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        self.client.lock.acquire()
+        self.client.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.client.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.client.lock.release()
+
+
+def _key(_id):
+    ''' Primary key text of a document _id. '''
+    return repr(_id)
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and len(value) > 0 and all(k.startswith('$') for k in value)
+
+
+def _resolve(doc, path):
+    ''' Values found at a dotted path, traversing into arrays the way mongo does. '''
+    if not path:
+        return [doc]
+    head, rest = path[0], path[1:]
+    if isinstance(doc, dict):
+        return _resolve(doc[head], rest) if head in doc else []
+    if isinstance(doc, list):
+        if head.isdigit():
+            return _resolve(doc[int(head)], rest) if int(head) < len(doc) else []
+        return [v for element in doc for v in _resolve(element, path)]
+    return []
+
+
+def _expand(values):
+    ''' Values together with the elements of any array values, which mongo matches individually. '''
+    expanded = list(values)
+    for v in values:
+        if isinstance(v, list):
+            expanded.extend(v)
+    return expanded
+
+
+def _match(doc, filter):
+    ''' Whether a document matches a query filter. '''
+    for key, condition in filter.items():
+        if key == '$and':
+            matched = all(_match(doc, f) for f in condition)
+        elif key == '$or':
+            matched = any(_match(doc, f) for f in condition)
+        else:
+            matched = _match_values(_resolve(doc, key.split('.')), condition)
+        if not matched:
+            return False
+    return True
+
+
+def _match_values(values, condition):
+    ''' Whether the values found at a path satisfy a condition. '''
+    if _is_operator_dict(condition):
+        return all(_match_operator(values, op, arg) for op, arg in condition.items())
+    return any(v == condition for v in _expand(values))
+
+
+def _compare(values, test):
+    matched = False
+    for v in _expand(values):
+        try:
+            matched = matched or test(v)
+        except TypeError:
+            pass
+    return matched
+
+
+def _match_operator(values, op, arg):
+    if op == '$eq':
+        return _match_values(values, arg) if not _is_operator_dict(arg) else False
+    if op == '$ne':
+        return not any(v == arg for v in _expand(values))
+    if op == '$gt':
+        return _compare(values, lambda v: v > arg)
+    if op == '$gte':
+        return _compare(values, lambda v: v >= arg)
+    if op == '$lt':
+        return _compare(values, lambda v: v < arg)
+    if op == '$lte':
+        return _compare(values, lambda v: v <= arg)
+    if op == '$in':
+        return any(v in arg for v in _expand(values))
+    if op == '$nin':
+        return not any(v in arg for v in _expand(values))
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    if op == '$elemMatch':
+        return any(_element_index(v, arg) is not None for v in values if isinstance(v, list))
+    raise NotImplementedError('Query operator {} is not supported by the local backend'.format(op))
+
+
+def _element_index(array, condition):
+    ''' Index of the first array element matching a condition, or None. '''
+    for i, element in enumerate(array):
+        if _is_operator_dict(condition):
+            matched = _match_values([element], condition)
+        elif isinstance(condition, dict):
+            matched = isinstance(element, dict) and _match(element, condition)
+        else:
+            matched = element == condition
+        if matched:
+            return i
+    return None
+
+
+def _parent(doc, path, create=True):
+    ''' The container holding the last part of a dotted path, and that last part. '''
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+        else:
+            if part not in doc:
+                if not create:
+                    return None, parts[-1]
+                doc[part] = {}
+            doc = doc[part]
+    return doc, parts[-1]
+
+
+def _get(container, key, default=None):
+    if isinstance(container, list):
+        return container[int(key)] if int(key) < len(container) else default
+    return container.get(key, default)
+
+
+def _put(container, key, value):
+    if isinstance(container, list):
+        # Like mongo, setting past the end pads the array with nulls
+        container.extend([None] * (int(key) + 1 - len(container)))
+        container[int(key)] = value
+    else:
+        container[key] = value
+
+
+def _apply_update(doc, update, filter, inserting=False):
+    ''' Apply update operators to a document in place. '''
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.items():
+            if '$' in path.split('.'):
+                path = _positional(doc, path, filter)
+            container, key = _parent(doc, path, create=op != '$unset')
+            if container is None:
+                continue
+
+            if op in ('$set', '$setOnInsert'):
+                _put(container, key, copy.deepcopy(arg))
+            elif op == '$unset':
+                if isinstance(container, dict):
+                    container.pop(key, None)
+            elif op == '$inc':
+                _put(container, key, _get(container, key, 0) + arg)
+            elif op == '$min':
+                current = _get(container, key)
+                _put(container, key, arg if current is None else min(current, arg))
+            elif op == '$max':
+                current = _get(container, key)
+                _put(container, key, arg if current is None else max(current, arg))
+            elif op in ('$push', '$addToSet'):
+                array = _get(container, key)
+                if array is None:
+                    array = []
+                    _put(container, key, array)
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                for item in copy.deepcopy(items):
+                    if op == '$push' or item not in array:
+                        array.append(item)
+            elif op == '$pop':
+                array = _get(container, key)
+                if isinstance(array, list) and array:
+                    array.pop(0 if arg == -1 else -1)
+            elif op == '$pull':
+                array = _get(container, key)
+                if isinstance(array, list):
+                    array[:] = [e for e in array if _element_index([e], arg) is None]
+            else:
+                raise NotImplementedError('Update operator {} is not supported by the local backend'.format(op))
+
+
+def _positional(doc, path, filter):
+    ''' Replace the positional $ of an update path with the index of the array element the filter matched. '''
+    parts = path.split('.')
+    i = parts.index('$')
+    array_path = '.'.join(parts[:i])
+    array = _resolve(doc, parts[:i])
+    array = array[0] if array and isinstance(array[0], list) else []
+
+    for field, condition in filter.items():
+        if field == array_path:
+            if isinstance(condition, dict) and '$elemMatch' in condition:
+                condition = condition['$elemMatch']
+            index = _element_index(array, condition)
+        elif field.startswith(array_path + '.'):
+            index = _element_index(array, {field[len(array_path) + 1:] : condition})
+        else:
+            continue
+        if index is not None:
+            return '.'.join(parts[:i] + [str(index)] + parts[i + 1:])
+    raise WriteError('The positional operator did not find the match needed from the query.', 2)
+
+
+def _project(doc, projection):
+    ''' Apply an inclusion or exclusion projection to a document, with $slice on array fields. '''
+    if not projection:
+        return doc
+    fields = {k : v for k, v in projection.items() if k != '_id'}
+    slices = {k : v['$slice'] for k, v in fields.items() if isinstance(v, dict) and '$slice' in v}
+    fields = {k : v for k, v in fields.items() if k not in slices}
+
+    if any(fields.values()) or (not fields and not slices and projection.get('_id', 1)):
+        projected = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            projected['_id'] = doc['_id']
+        for path, include in list(fields.items()) + [(path, True) for path in slices]:
+            if include:
+                values = _resolve(doc, path.split('.'))
+                if values:
+                    container, key = _parent(projected, path)
+                    container[key] = values[0]
+    else:
+        projected = copy.deepcopy(doc)
+        for path in fields:
+            container, key = _parent(projected, path, create=False)
+            if isinstance(container, dict):
+                container.pop(key, None)
+        if not projection.get('_id', 1):
+            projected.pop('_id', None)
+
+    for path, arg in slices.items():
+        container, key = _parent(projected, path, create=False)
+        if isinstance(container, dict) and isinstance(container.get(key), list):
+            container[key] = _slice(container[key], arg)
+    return projected
+
+
+def _slice(array, arg):
+    ''' The elements of an array selected by a $slice projection, n or -n elements or [skip, limit]. '''
+    if isinstance(arg, (list, tuple)):
+        skip, limit = arg
+        start = skip if skip >= 0 else max(0, len(array) + skip)
+        return array[start:start + limit]
+    return array[:arg] if arg >= 0 else array[arg:]
+
+
+def _update_result(matched):
+    modified = [m for m in matched if m[0] is not None and m[0] != m[1]]
+    raw = {'n' : len(matched), 'nModified' : len(modified)}
+    upserted = [m[2]['_id'] for m in matched if m[0] is None]
+    if upserted:
+        raw['upserted'] = upserted[0]
+    return UpdateResult(raw, True)
+
+
+def bulk_write(collection, requests, ordered=True):
+    ''' Write ('insert_one', document) and ('update_one', filter, update[, upsert]) requests in one bulk write.
+
+    Parameters
+    ----------
+    collection : Collection or LocalCollection
+        Collection to write to, mongo collections are sent the equivalent pymongo requests
+    requests : list
+        Request tuples
+    ordered : bool
+        Stop at the first failed request, otherwise the requests after it are still applied
+
+    Returns
+    -------
+    result : BulkWriteResult
+    '''
+    if isinstance(collection, Collection):
+        from pymongo import InsertOne, UpdateOne
+        requests = [InsertOne(r[1]) if r[0] == 'insert_one' else UpdateOne(*r[1:]) for r in requests]
+    return collection.bulk_write(requests, ordered=ordered)
@@ -0,0 +1,145 @@
+import numpy as np
+from GPyOpt.models.base import BOModel
+
+
+# Surrogates selected with the surrogate key of the controller config
+GP_SURROGATES = ['gp', 'sparse_gp', 'window', 'trust_region']
+TREE_SURROGATES = ['random_forest', 'extra_trees']
+SURROGATES = GP_SURROGATES + TREE_SURROGATES
+
+
+class TreeModel(BOModel):
+    ''' Random forest or extra trees surrogate for GPyOpt, the prediction is the mean and spread over the trees.
+
+    Fitting is O(n log n) in the number of observations, so it suits studies too large for an exact GP.
+    Unlike GPyOpt's RFModel, every tree predicts all locations at once.
+    '''
+
+    analytical_gradient_prediction = False
+
+    def __init__(self, ensemble='random_forest', num_trees=100, min_samples_leaf=1, random_state=None):
+        '''
+        Parameters
+        ----------
+        ensemble : str
+            Either random_forest or extra_trees
+        num_trees : int
+            Number of trees in the ensemble
+        min_samples_leaf : int
+            Minimum number of observations in a leaf
+        random_state : int
+            Seed for the ensemble
+        '''
+        self.ensemble = ensemble
+        self.num_trees = num_trees
+        self.min_samples_leaf = min_samples_leaf
+        self.random_state = random_state
+        self.model = None
+
+
+    def _create_model(self):
+        # scikit-learn is only needed for the tree surrogates
+        from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+        regressor = ExtraTreesRegressor if self.ensemble == 'extra_trees' else RandomForestRegressor
+        self.model = regressor(n_estimators=self.num_trees,
+                               min_samples_leaf=self.min_samples_leaf,
+                               random_state=self.random_state)
+
+
+    def updateModel(self, X_all, Y_all, X_new, Y_new):
+        ''' Refit the ensemble on every observation. '''
+        self.X = X_all
+        self.Y = Y_all
+        if self.model is None:
+            self._create_model()
+        self.model.fit(X_all, Y_all.ravel())
+
+
+    def predict(self, X):
+        ''' Mean and standard deviation over the trees at X, as column vectors. '''
+        X = np.atleast_2d(X)
+        predictions = np.stack([tree.predict(X) for tree in self.model.estimators_])
+        return predictions.mean(axis=0)[:, None], predictions.std(axis=0)[:, None]
+
+
+    def get_fmin(self):
+        return self.predict(self.X)[0].min()
+
+
+    def get_model_parameters(self):
+        return np.zeros((1, 0))
+
+
+    def get_model_parameters_names(self):
+        return []
+
+
+def select_observations(X, Y, surrogate, window, bounds):
+    ''' Choose the observations a surrogate is fit on.
+
+    window keeps the most recent observations, and trust_region keeps those nearest to the best observation,
+    with distances measured relative to the size of each hyperparameter's domain. Every other surrogate uses
+    all of them.
+
+    Parameters
+    ----------
+    X : array
+        2D array of encoded hyperparameter combinations
+    Y : array
+        2D array of objective values, one row per observation
+    surrogate : str
+        One of SURROGATES
+    window : int
+        Number of observations to keep for window and trust_region
+    bounds : list
+        Hyperparameter dictionaries in the format required by GPyOpt
+
+    Returns
+    -------
+    X, Y : array
+        The selected observations
+    '''
+    if surrogate not in ['window', 'trust_region'] or len(X) <= window:
+        return X, Y
+
+    if surrogate == 'window':
+        return X[-window:], Y[-window:]
+
+    low = np.array([min(b['domain']) for b in bounds], dtype=float)
+    scale = np.array([max(b['domain']) for b in bounds], dtype=float) - low
+    scale[scale == 0] = 1.
+    distances = np.sum(((X - X[np.argmin(Y[:, 0])]) / scale)**2, axis=1)
+    nearest = np.sort(np.argpartition(distances, window - 1)[:window])
+    return X[nearest], Y[nearest]
+
+
+def optimizer_options(surrogate, batch_size, num_inducing=100, num_trees=100):
+    ''' Keyword arguments for GPyOpt.methods.BayesianOptimization that select a surrogate.
+
+    Local penalization needs the gradients of a GP to space out a batch, so batches from the tree
+    surrogates are completed with random locations instead.
+
+    Parameters
+    ----------
+    surrogate : str
+        One of SURROGATES
+    batch_size : int
+        Number of locations to suggest
+    num_inducing : int
+        Number of inducing points of the sparse GP
+    num_trees : int
+        Number of trees of the tree surrogates
+
+    Returns
+    -------
+    options : dict
+        model_type, model, num_inducing and evaluator_type arguments
+    '''
+    assert surrogate in SURROGATES, 'surrogate must be one of {}'.format(SURROGATES)
+
+    if surrogate in TREE_SURROGATES:
+        return {'model' : TreeModel(surrogate, num_trees=num_trees),
+                'evaluator_type' : 'sequential' if batch_size == 1 else 'random'}
+    if surrogate == 'sparse_gp':
+        return {'model_type' : 'sparseGP', 'num_inducing' : num_inducing, 'evaluator_type' : 'local_penalization'}
+    return {'model_type' : 'GP', 'evaluator_type' : 'local_penalization'}
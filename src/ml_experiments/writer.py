@@ -0,0 +1,208 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout
+from pymongo.results import InsertOneResult
+from .storage import bulk_write
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class AsyncWriter:
+    ''' Writes to a mongo or local collection from a background thread, so the caller never waits on the database.
+
+    Writes are put on a bounded queue, and every flush_interval seconds the writer thread coalesces
+    everything queued into one ordered bulk write. Bulk writes that fail on the connection are retried with
+    exponential backoff, a write the database rejects is dropped on its own and the writes after it go ahead.
+    Retries may resend writes that were already applied, so the queued writes must be idempotent, e.g. $set
+    rather than $push. Inserts are, as a repeated insert is rejected as a duplicate and dropped.
+    Dropped writes are logged to the ml_experiments.writer logger. The queue is flushed on flush(), close()
+    and at interpreter exit. insert_one and update_one mirror the pymongo collection methods, so the writer
+    can stand in for a collection.
+    '''
+
+    def __init__(self, collection, flush_interval=5., max_queue_size=10000, max_retries=5, backoff=0.5):
+        '''
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection or LocalCollection
+            Collection to write to
+        flush_interval : float
+            Seconds between bulk writes
+        max_queue_size : int
+            Maximum number of queued writes, further writes wait for space rather than growing memory without bound
+        max_retries : int
+            Number of attempts for each bulk write that fails on the connection, before its writes are dropped
+        backoff : float
+            Seconds to wait before the first retry, doubled for every retry after it
+        '''
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    def insert_one(self, document):
+        ''' Queue an insert, the _id is assigned here so the caller can refer to the document right away. '''
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self._queue.put(('insert', document))
+        return InsertOneResult(document['_id'], acknowledged=False)
+
+
+    def update_one(self, filter, update):
+        ''' Queue an update. '''
+        self._queue.put(('update', filter, update))
+
+
+    def flush(self, timeout=None):
+        ''' Write everything queued so far, and wait until it has been written.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for the write, None waits until it's done
+
+        Returns
+        -------
+        flushed : bool
+            False if the timeout passed first
+        '''
+        if not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+
+    def close(self):
+        ''' Write everything queued and stop the writer thread. '''
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        atexit.unregister(self.close)
+
+
+    def _run(self):
+        ''' Collect queued writes, and bulk write them every flush_interval, on flush requests or when stopping. '''
+        writes, waiting = [], []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            # Take everything else that's already queued
+            items = [] if item is None else [item]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    writes.append(item)
+
+            if time.monotonic() >= deadline or waiting or stopping:
+                if writes:
+                    self._write(coalesce(writes))
+                writes = []
+                for done in waiting:
+                    done.set()
+                waiting = []
+                deadline = time.monotonic() + self.flush_interval
+
+            if stopping:
+                return
+
+
+    def _write(self, writes):
+        ''' Bulk write, retrying connection errors with backoff and dropping only the writes that are rejected. '''
+        requests = [('insert_one', w[1]) if w[0] == 'insert' else ('update_one', w[1], w[2]) for w in writes]
+
+        attempt = 0
+        while requests:
+            try:
+                bulk_write(self.collection, requests, ordered=True)
+                return
+            except BulkWriteError as e:
+                # Ordered bulk writes stop at the first error, everything before it was applied. The rejected
+                # write would be rejected again, so only it is dropped and the writes after it are sent
+                error = e.details['writeErrors'][0]
+                logger.warning('Dropping a write that failed: %s', error.get('errmsg'))
+                writes, requests = writes[error['index'] + 1:], requests[error['index'] + 1:]
+            except (AutoReconnect, NetworkTimeout) as e:
+                # Transient, the writes are sent again after a backoff
+                attempt += 1
+                if attempt == self.max_retries:
+                    logger.error('Dropping %d writes after %d failed attempts: %s', len(requests), self.max_retries, e)
+                    return
+                time.sleep(self.backoff * 2**(attempt - 1))
+            except Exception as e:
+                # Any other error isn't tied to one write, so they're sent one at a time to drop only the failing ones.
+                # The writer thread must outlive a bad write
+                if len(writes) == 1:
+                    logger.warning('Dropping a write that failed: %s', e)
+                    return
+                for w in writes:
+                    self._write([w])
+                return
+
+
+def coalesce(writes):
+    ''' Merge consecutive updates to the same document that only $push with $each, or only $set.
+
+    Parameters
+    ----------
+    writes : list
+        Queued writes, ('insert', document) or ('update', filter, update) tuples
+
+    Returns
+    -------
+    writes : list
+        Equivalent writes, with fewer updates
+    '''
+    merged = []
+    for w in writes:
+        if merged and w[0] == 'update' and merged[-1][0] == 'update' and merged[-1][1] == w[1]:
+            previous = merged[-1][2]
+            if list(previous.keys()) == list(w[2].keys()) == ['$set'] and not _has_nested_keys(previous, w[2]):
+                merged[-1] = ('update', w[1], {'$set' : dict(previous['$set'], **w[2]['$set'])})
+                continue
+            if list(previous.keys()) == list(w[2].keys()) == ['$push'] and _is_push_each(previous) and _is_push_each(w[2]):
+                push = {k : {'$each' : list(v['$each'])} for k, v in previous['$push'].items()}
+                for k, v in w[2]['$push'].items():
+                    push.setdefault(k, {'$each' : []})['$each'].extend(v['$each'])
+                merged[-1] = ('update', w[1], {'$push' : push})
+                continue
+        merged.append(w)
+    return merged
+
+
+def _is_push_each(update):
+    ''' Whether every field of a $push update appends with $each. '''
+    return all(isinstance(v, dict) and list(v.keys()) == ['$each'] for v in update['$push'].values())
+
+
+def _has_nested_keys(previous, update):
+    ''' Whether a $set field of one update is nested in a field of the other, e.g. loss and loss.3, these conflict once merged. '''
+    return any(k.startswith(j + '.') for a, b in [(previous, update), (update, previous)] for k in a['$set'] for j in b['$set'])
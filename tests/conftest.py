@@ -0,0 +1,73 @@
+import os
+import yaml
+import pytest
+import functools
+
+DEMO_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'demo', 'demo_config.yaml')
+
+
+def write_config(directory, name='study', hyperparameters=None, **settings):
+    ''' Write a copy of the demo config that keeps the design and the experiment records in a SQLite file.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the config and the store, every config written to the same directory shares one store
+    name : str
+        Name of the config file, which is also the name of the study. The study's design and experiments
+        are kept in the collections name_design and name_trial unless the settings say otherwise
+    hyperparameters : dict
+        Replaces the hyperparameters of the demo config, and drops its architecture section
+    settings : dict
+        Config values to set, in the section that already has the key or else under controller
+
+    Returns
+    -------
+    config_path : str
+        Path to the written config
+    '''
+    with open(DEMO_CONFIG, 'r') as f:
+        config = yaml.safe_load(f)
+    path = os.path.join(str(directory), 'studies.db')
+
+    for prefix in ['controller', 'manager']:
+        for key in ['host', 'port', 'ssl_certfile', 'ssl_ca_file', 'max_pool_size', 'server_selection_timeout_ms']:
+            config[prefix].pop(prefix + '_' + key, None)
+        config[prefix][prefix + '_backend'] = 'local'
+        config[prefix][prefix + '_path'] = path
+    config['controller']['controller_collection'] = name + '_design'
+    config['manager']['manager_collection'] = name + '_trial'
+
+    if hyperparameters is not None:
+        config['hyperparameters'] = hyperparameters
+        config.pop('architecture', None)
+    for key, value in settings.items():
+        section = next((s for s, values in config.items() if isinstance(values, dict) and key in values), 'controller')
+        config[section][key] = value
+
+    config_path = os.path.join(str(directory), name + '.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+@pytest.fixture(scope='session', autouse=True)
+def spec_cache(tmp_path_factory):
+    ''' Cache the compiled specs of the tests' configs in a temporary directory rather than in ~/.cache. '''
+    with pytest.MonkeyPatch.context() as mp:
+        path = tmp_path_factory.mktemp('specs')
+        mp.setenv('ML_EXPERIMENTS_CACHE', str(path))
+        yield path
+
+
+@pytest.fixture
+def study_config(tmp_path):
+    ''' Write configs backed by a SQLite store in the test's tmp_path, with the arguments of write_config. '''
+    return functools.partial(write_config, tmp_path)
+
+
+@pytest.fixture(scope='module')
+def demo_config(tmp_path_factory):
+    ''' The demo config on the local backend, with one store shared by the tests of a module. '''
+    return write_config(tmp_path_factory.mktemp('demo'), 'demo_config',
+                        controller_collection='test_design', manager_collection='test_trial')
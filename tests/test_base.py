@@ -80,3 +80,66 @@ def test_bundle_experiments():
 
     # Check that all hyperparameters are included in the experiment bounds
     assert len(br.hyperparameter_names) == len(br.bounds), 'Invalid experiment'
+
+
+def test_shared_client(monkeypatch):
+    # Check that connections to the same server share one client, and the registry closes them
+    from ml_experiments import base
+    monkeypatch.setattr(base, '_clients', {})
+    prefix = 'controller'
+    experiment = {prefix + '_host' : 'd7920-12.ccds.io', 
+    prefix + '_ssl_ca_file' : './pki/rootCA.pem',
+    prefix + '_ssl_certfile' : './pki/client.pem',
+    prefix + '_database' : 'test_databases', 
+    prefix + '_collection' : 'test_collection',
+    prefix + '_port' : 27024,
+    prefix + '_max_pool_size' : 4}
+
+    bc_1 = BaseConnection()
+    bc_1.experiment = experiment
+    bc_1.establish_db_connection(prefix=prefix)
+    bc_2 = BaseConnection()
+    bc_2.experiment = experiment
+    bc_2.establish_db_connection(prefix=prefix)
+    assert bc_1.db.client is bc_2.db.client
+    assert len(base._clients) == 1
+
+    base.close_clients()
+    assert len(base._clients) == 0
+
+
+def test_spec_cache(tmp_path, monkeypatch):
+    # Check that a config is compiled once, cached on disk, and compiled again when it changes
+    from ml_experiments import base
+    monkeypatch.setenv('ML_EXPERIMENTS_CACHE', str(tmp_path / 'specs'))
+    monkeypatch.setattr(base, '_specs', {})
+    config = tmp_path / 'study.yaml'
+    with open('./demo/demo_config.yaml', 'r') as f:
+        config.write_text(f.read())
+
+    br = BaseReader()
+    br.get_config(str(config))
+    assert br.experiment['trial_name'] == 'study'
+    assert len(list((tmp_path / 'specs').iterdir())) == 1
+    assert br.spec.domains[0].flags.writeable == False
+
+    # A cached spec is read back the same, tuples and read only domains included
+    monkeypatch.setattr(base, '_specs', {})
+    cached = base.load_spec(str(config))
+    assert cached == br.spec[:4] + (cached.domains,)
+    assert isinstance(cached.bounds[0]['domain'], tuple)
+    assert cached.domains[0].flags.writeable == False
+
+    # Readers get their own copy of the spec
+    br.experiment['max_iter'] = -1
+    br.bounds[0]['domain'] = ()
+    monkeypatch.setattr(base, '_specs', {})
+    br_2 = BaseReader()
+    br_2.get_config(str(config))
+    assert br_2.experiment['max_iter'] != -1
+    assert br_2.bounds == br.spec.bounds
+
+    config.write_text(config.read_text().replace('max_iter: 75', 'max_iter: 80'))
+    br_2.get_config(str(config))
+    assert br_2.experiment['max_iter'] == 80
+    assert len(list((tmp_path / 'specs').iterdir())) == 2
@@ -1,93 +1,395 @@
-import pytest
-import numpy as np
-from ml_experiments.controller import ExperimentController
-
-config_path='./demo/demo_config.yaml'
-ec = ExperimentController(config_path)
-
-def test_get_design():
-    # Delete the collection in the config
-    ec.col.drop()
-    print(ec.col.estimated_document_count())
-    assert ec.col.estimated_document_count() == 0
-
-    # Test creating a new design
-    ec._get_design()
-    assert ec.col.estimated_document_count() == 1
-
-    # Test that two designs aren't created
-    ec._get_design()
-    assert ec.col.estimated_document_count() == 1
-
-
-def test_create_design_entry():
-    # Check the warm up array is the correct shape
-    assert np.shape(ec.warm_up_list) == (ec.num_warm_up, len(ec.bounds))
-
-    # Check the document actually exists in mongo and the values are correct
-    experiment = ec.col.find_one()
-    assert experiment['_id'] == ec.raster_id
-    assert experiment['next_iter'] == ec.next_iter
-    assert experiment['num_warm_up'] == ec.num_warm_up
-    assert experiment['warm_up_list'] == ec.warm_up_list
-
-def test_tally_an_iteration():
-    # Test that the tally actually increases
-    cur_iter = ec.next_iter
-    ec._tally_an_iteration()
-    assert cur_iter + 1 == ec.next_iter
-    experiment = ec.col.find_one()
-    assert experiment['next_iter'] == ec.next_iter
-
-
-def test_do_bayesian_optimization():
-    # Check the shapes of bayesian optimzation
-    # Because the inference values are sampled, a deterministic sample can't be tested
-    num_hyperparameters = len(ec.bounds)
-    ec.X_steps = [[0.1]*num_hyperparameters]*ec.num_warm_up
-    ec.Y_steps = [[0.2]]*ec.num_warm_up
-    next_trial = ec._do_bayesian_optimization()
-    assert np.shape(next_trial) == (num_hyperparameters,)
-
-
-def update_design():
-    # Test that a specific value is actually being changed
-    num_hyperparameters = len(ec.bounds)
-    x_step = [0.1]*num_hyperparameters
-    y_step = 0.2
-
-    # Test that input fails without y_step being a list
-    with pytest.raises(AssertionError):
-        ec.update_design(x_step, y_step)
-
-    # Test that values are 
-    y_step = [0.2]
-    X_steps = ec.X_steps
-    Y_steps = ec.Y_steps
-    ec.update_design(x_step, y_step)
-    ec._get_design()
-    assert ec.X_steps[-1] == x_step
-    assert ec.Y_steps[-1] == y_step
-
-
-def test_get_next_suggestion():
-
-    # Set the next steps
-    num_hyperparameters = len(ec.bounds)
-    ec.X_steps = [[0.1]*num_hyperparameters]*ec.num_warm_up
-    ec.Y_steps = [[0.2]]*ec.num_warm_up
-    ec._set_val('X_steps', ec.X_steps)
-    ec._set_val('Y_steps', ec.Y_steps)	
-
-    # Check that the next trial comes off the warm up list
-    ec._set_val('next_iter', 5)
-    next_trial = ec.get_next_suggestion()
-    assert next_trial == ec.warm_up_list[5]
-
-    # Check that the next trial is not on the warm up list
-    ec._set_val('next_iter', ec.num_warm_up + 1)
-    next_trial = ec.get_next_suggestion()
-    for warm_up in ec.warm_up_list:
-        assert (next_trial == warm_up).all() == False
-
-
+import pytest
+import numpy as np
+from ml_experiments.controller import ExperimentController
+
+@pytest.fixture(scope='module')
+def ec(demo_config):
+    return ExperimentController(demo_config)
+
+
+def test_get_design(ec):
+    # Delete the collection in the config
+    ec.col.drop()
+    print(ec.col.estimated_document_count())
+    assert ec.col.estimated_document_count() == 0
+
+    # Test creating a new design
+    ec._get_design()
+    assert ec.col.estimated_document_count() == 1
+
+    # Test that two designs aren't created
+    ec._get_design()
+    assert ec.col.estimated_document_count() == 1
+
+
+def test_create_design_entry(ec):
+    # Check the warm up array is the correct shape
+    assert np.shape(ec.warm_up_list) == (ec.num_warm_up, len(ec.bounds))
+
+    # Check the document actually exists in mongo and the values are correct
+    experiment = ec.col.find_one()
+    assert experiment['_id'] == ec.raster_id
+    assert experiment['next_iter'] == ec.next_iter
+    assert experiment['num_warm_up'] == ec.num_warm_up
+    assert experiment['warm_up_list'] == ec.warm_up_list
+
+def test_tally_an_iteration(ec):
+    # Test that the tally actually increases
+    cur_iter = ec.next_iter
+    ec._tally_an_iteration()
+    assert cur_iter + 1 == ec.next_iter
+    experiment = ec.col.find_one()
+    assert experiment['next_iter'] == ec.next_iter
+
+
+def test_do_bayesian_optimization(ec):
+    # Check the shapes of bayesian optimzation
+    # Because the inference values are sampled, a deterministic sample can't be tested
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [[0.1]*num_hyperparameters]*ec.num_warm_up
+    ec.Y_steps = [[0.2]]*ec.num_warm_up
+    next_trial = ec._do_bayesian_optimization()
+    assert np.shape(next_trial) == (num_hyperparameters,)
+
+
+def update_design():
+    # Test that a specific value is actually being changed
+    num_hyperparameters = len(ec.bounds)
+    x_step = [0.1]*num_hyperparameters
+    y_step = 0.2
+
+    # Test that input fails without y_step being a list
+    with pytest.raises(AssertionError):
+        ec.update_design(x_step, y_step)
+
+    # Test that values are 
+    y_step = [0.2]
+    X_steps = ec.X_steps
+    Y_steps = ec.Y_steps
+    ec.update_design(x_step, y_step)
+    ec._get_design()
+    assert ec.X_steps[-1] == x_step
+    assert ec.Y_steps[-1] == y_step
+
+
+def test_get_next_suggestion(ec):
+
+    # Set the next steps
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [[0.1]*num_hyperparameters]*ec.num_warm_up
+    ec.Y_steps = [[0.2]]*ec.num_warm_up
+    ec._set_val('X_steps', ec.X_steps)
+    ec._set_val('Y_steps', ec.Y_steps)	
+
+    # Check that the next trial comes off the warm up list
+    ec._set_val('next_iter', 5)
+    next_trial = ec.get_next_suggestion()
+    assert next_trial == ec.warm_up_list[5]
+
+    # Check that the next trial is not on the warm up list
+    ec._set_val('next_iter', ec.num_warm_up + 1)
+    next_trial = ec.get_next_suggestion()
+    for warm_up in ec.warm_up_list:
+        assert (next_trial == warm_up).all() == False
+
+
+
+
+def test_tally_an_iteration_is_atomic(ec):
+    # Test that concurrent claims never hand out the same iteration
+    from concurrent.futures import ThreadPoolExecutor
+    ec._set_val('next_iter', 0)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        claimed = list(pool.map(lambda _: ec._tally_an_iteration(), range(32)))
+    assert sorted(claimed) == list(range(32))
+    assert ec.col.find_one()['next_iter'] == 32
+
+
+def test_update_design_appends(ec):
+    # Test that updates are appended to the stored design rather than overwriting it
+    num_hyperparameters = len(ec.bounds)
+    ec._set_val('X_steps', [])
+    ec._set_val('Y_steps', [])
+    ec.update_design(np.array([0.1]*num_hyperparameters), [0.2])
+    ec.update_design(np.array([0.3]*num_hyperparameters), [0.4])
+    experiment = ec.col.find_one()
+    assert experiment['X_steps'] == [[0.1]*num_hyperparameters, [0.3]*num_hyperparameters]
+    assert experiment['Y_steps'] == [[0.2], [0.4]]
+
+
+def test_surrogate_cache(ec):
+    # Test that the fitted surrogate is cached and warm started on the next suggestion
+    from ml_experiments.controller import _surrogate_cache
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [list(np.random.rand(num_hyperparameters)) for _ in range(ec.num_warm_up)]
+    ec.Y_steps = [[y] for y in np.random.rand(ec.num_warm_up)]
+    _surrogate_cache.clear()
+    ec._do_bayesian_optimization()
+    cached = _surrogate_cache[ec._study_key()]
+    assert cached['num_observations'] == ec.num_warm_up
+    assert cached['last_refit'] == ec.num_warm_up
+
+    # One more observation should warm start rather than refit
+    ec.X_steps.append(list(np.random.rand(num_hyperparameters)))
+    ec.Y_steps.append([0.5])
+    ec._do_bayesian_optimization()
+    cached = _surrogate_cache[ec._study_key()]
+    assert cached['num_observations'] == ec.num_warm_up + 1
+    assert cached['last_refit'] == ec.num_warm_up
+
+    # An entry evicted since the warm start is stored as if fully refit
+    from types import SimpleNamespace
+    _surrogate_cache.clear()
+    ec._store_surrogate(SimpleNamespace(model=SimpleNamespace(model=cached['model'])), ec.num_warm_up + 2, warm_started=True)
+    assert _surrogate_cache[ec._study_key()]['last_refit'] == ec.num_warm_up + 2
+
+
+def test_get_next_suggestions(ec):
+    # Set the next steps
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [list(np.random.rand(num_hyperparameters)) for _ in range(ec.num_warm_up)]
+    ec.Y_steps = [[y] for y in np.random.rand(ec.num_warm_up)]
+    ec._set_val('X_steps', ec.X_steps)
+    ec._set_val('Y_steps', ec.Y_steps)
+
+    # A batch straddling the end of the warm up mixes warm up rows and bayesian suggestions
+    ec._set_val('next_iter', ec.num_warm_up - 2)
+    next_trials = ec.get_next_suggestions(4)
+    assert np.shape(next_trials) == (4, num_hyperparameters)
+    assert list(next_trials[0]) == ec.warm_up_list[ec.num_warm_up - 2]
+    assert list(next_trials[1]) == ec.warm_up_list[ec.num_warm_up - 1]
+    assert ec.col.find_one()['next_iter'] == ec.num_warm_up + 2
+
+
+def test_prefetch(ec):
+    # Set the next steps
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [list(np.random.rand(num_hyperparameters)) for _ in range(ec.num_warm_up)]
+    ec.Y_steps = [[y] for y in np.random.rand(ec.num_warm_up)]
+    ec._set_val('X_steps', ec.X_steps)
+    ec._set_val('Y_steps', ec.Y_steps)
+    ec._set_val('next_iter', ec.num_warm_up)
+
+    # Test that a suggestion starts prefetching the next one, and the next suggestion takes it
+    ec.prefetch = True
+    first_trial = ec.get_next_suggestion()
+    assert ec._prefetch_thread is not None
+    ec._prefetch_thread.join()
+    prefetched_trial = ec._prefetched['next_trial']
+    assert (prefetched_trial == first_trial).all() == False
+
+    second_trial = ec.get_next_suggestion()
+    assert (second_trial == prefetched_trial).all()
+
+    # Test that a prefetched trial is discarded once too many observations have arrived
+    ec._prefetch_thread.join()
+    for _ in range(ec.prefetch_max_staleness + 1):
+        ec.update_design(np.random.rand(num_hyperparameters), [0.5])
+    ec._get_design()
+    assert ec._take_prefetched() is None
+
+    # Test that a prefetched trial another worker was handed since is discarded
+    ec._start_prefetch(second_trial)
+    ec._prefetch_thread.join()
+    taken = ec._prefetched['next_trial']
+    ec._mark_pending([ec.max_iter], [taken])
+    ec._get_design()
+    assert ec._take_prefetched() is None
+    ec.col.update_one({'_id' : ec.raster_id}, {'$pull' : {'pending' : {'iter' : ec.max_iter}}})
+    ec._in_flight.pop(tuple(np.asarray(taken, dtype=float).tolist()))
+    ec.prefetch = False
+
+
+def test_pending_trials(ec):
+    # Set the next steps
+    num_hyperparameters = len(ec.bounds)
+    ec.X_steps = [list(np.random.rand(num_hyperparameters)) for _ in range(ec.num_warm_up)]
+    ec.Y_steps = [[y] for y in np.random.rand(ec.num_warm_up)]
+    ec._set_val('X_steps', ec.X_steps)
+    ec._set_val('Y_steps', ec.Y_steps)
+    ec._set_val('pending', [])
+    ec._set_val('next_iter', ec.num_warm_up)
+
+    # Test that a suggestion is recorded as pending in the design store
+    next_trial = ec.get_next_suggestion()
+    pending = ec.col.find_one()['pending']
+    assert len(pending) == 1
+    assert pending[0]['iter'] == ec.num_warm_up
+    assert pending[0]['x'] == list(next_trial)
+
+    # Test that the pending trial isn't suggested to the next worker
+    ec._get_design()
+    assert (ec._do_bayesian_optimization() == next_trial).all() == False
+
+    # Test that reporting the trial retires it from the pending list
+    ec.update_design(next_trial, [0.5])
+    assert ec.col.find_one()['pending'] == []
+
+
+def test_instrumentation(ec):
+    # Test that every phase of a bayesian suggestion is timed once a hook is added
+    phases = []
+    ec.instrumentation.add_hook(lambda component, phase, seconds: phases.append(phase))
+    ec.get_next_suggestion()
+    ec.instrumentation.hooks = []
+    ec.instrumentation.enabled = False
+    for phase in ['claim', 'get_design', 'setup', 'fit', 'acquisition', 'write', 'suggestion']:
+        assert phase in phases
+
+
+def test_surrogates(ec):
+    # Test that every surrogate suggests a trial, and only the gp surrogates are cached
+    from ml_experiments import controller
+    ec._get_design()
+    for surrogate in ['sparse_gp', 'window', 'trust_region', 'random_forest', 'extra_trees']:
+        controller._surrogate_cache.clear()
+        ec.surrogate = surrogate
+        ec.num_inducing = 5
+        ec.surrogate_window = 5
+        next_trial = ec._do_bayesian_optimization()
+        assert np.shape(next_trial) == (len(ec.bounds),)
+        assert (len(controller._surrogate_cache) == 1) == (surrogate in ['sparse_gp', 'window', 'trust_region'])
+    ec.surrogate = 'gp'
+
+
+def test_discrete_fast_path(ec):
+    # Test that suggestions for the fully discrete demo come from the candidate grid, and aren't observed or repeated
+    ec._get_design()
+    grid = ec._candidate_grid()
+    assert grid is not None and grid.size == np.prod([len(b['domain']) for b in ec.bounds])
+    next_trials = ec._suggest_locations(3)
+    assert len(grid.flat_indices(next_trials)) == 3
+    assert len(np.unique(next_trials, axis=0)) == 3
+    for next_trial in next_trials:
+        assert list(next_trial) not in ec.X_steps
+
+
+def test_grid_ties(ec):
+    # Test that tied candidates are picked at random, and a unique best that isn't excluded always wins
+    grid = ec._candidate_grid()
+    nothing = np.zeros(0, dtype=np.int64)
+    assert len({ec._grid_argmin(grid, lambda rows: np.zeros(len(rows)), nothing) for _ in range(20)}) > 1
+
+    target = grid.take([5])[0]
+    distance = lambda rows: np.abs(rows - target).sum(1)
+    assert ec._grid_argmin(grid, distance, nothing) == 5
+    assert ec._grid_argmin(grid, distance, np.array([5])) != 5
+
+
+def test_incremental_design_sync(ec, demo_config):
+    # Test that the replica only reads new observations, and follows the stored order when controllers interleave
+    num_hyperparameters = len(ec.bounds)
+    ec._set_val('X_steps', [[0.1]*num_hyperparameters])
+    ec._set_val('Y_steps', [[0.1]])
+    ec._get_design()
+    assert ec._num_synced == 1
+
+    other = ExperimentController(demo_config)
+    other.update_design(np.array([0.2]*num_hyperparameters), [0.2])
+    ec.update_design(np.array([0.3]*num_hyperparameters), [0.3])
+    assert ec._num_synced == 1
+
+    projections = []
+    find_one = ec.col.find_one
+    ec.col.find_one = lambda *args, **kwargs: projections.append(kwargs.get('projection')) or find_one(*args, **kwargs)
+    try:
+        ec._get_design()
+    finally:
+        del ec.col.find_one
+    assert projections[0]['X_steps'] == {'$slice' : [1, 2**31 - 1]}
+    assert ec.X_steps == ec.col.find_one()['X_steps']
+    assert ec.Y_steps == [[0.1], [0.2], [0.3]]
+    assert ec._num_synced == ec.col.find_one()['num_observations'] == 3
+
+
+def test_trial_leases(ec, demo_config):
+    # Test that a trial whose lease ran out is handed out again before a new iteration is claimed
+    import time
+    ec.lease_duration = 60
+    ec._set_val('pending', [])
+    ec._set_val('next_iter', 0)
+    trial = ec.get_next_suggestion()
+    assert ec.col.find_one()['pending'][0]['lease'] > time.time()
+
+    # Renewed by the heartbeat while the worker is alive
+    ec.col.update_one({'pending.iter' : 0}, {'$set' : {'pending.$.lease' : time.time() + 1}})
+    ec._last_heartbeat = 0.
+    ec.heartbeat()
+    assert ec.col.find_one()['pending'][0]['lease'] > time.time() + 30
+
+    # Taken over once the lease runs out, the original iteration is kept
+    ec.col.update_one({'pending.iter' : 0}, {'$set' : {'pending.$.lease' : time.time() - 1}})
+    other = ExperimentController(demo_config)
+    other.lease_duration = 60
+    assert list(other.get_next_suggestion()) == list(trial)
+    assert ec.col.find_one()['next_iter'] == 1
+    assert len(ec.col.find_one()['pending']) == 1
+    assert list(other.get_next_suggestions(2)[0]) == ec.warm_up_list[1]
+
+    # The pending trials aren't read again until the earliest lease could have run out
+    assert time.time() < other._next_lease_check <= time.time() + 60
+    ec.col.update_one({'pending.iter' : 0}, {'$set' : {'pending.$.lease' : time.time() - 1}})
+    assert other._reclaim_trials(1) == ([], [])
+    other._next_lease_check = 0.
+    assert other._reclaim_trials(1)[0] == [0]
+    ec.lease_duration = None
+
+
+def test_failed_suggestion_gives_back_iteration(ec):
+    # Test that a bayesian slot claimed before any result is reported is given back, and claimed again first
+    ec._set_val('X_steps', [])
+    ec._set_val('Y_steps', [])
+    ec._set_val('num_observations', 0)
+    ec._set_val('pending', [])
+    ec._set_val('next_iter', ec.num_warm_up)
+    with pytest.raises(AssertionError):
+        ec.get_next_suggestion()
+    raster = ec.col.find_one()
+    assert raster['released'] == [ec.num_warm_up]
+    assert raster['pending'] == []
+
+    for x in ec.warm_up_list[:ec.num_warm_up]:
+        ec.update_design(np.asarray(x), [float(np.random.rand())])
+    ec.get_next_suggestion()
+    raster = ec.col.find_one()
+    assert raster['released'] == []
+    assert raster['pending'][0]['iter'] == ec.num_warm_up
+    assert raster['next_iter'] == ec.num_warm_up + 1
+
+
+def run_worker(config_path):
+    # The loop of the README, returning the trials this worker was handed
+    ec = ExperimentController(config_path)
+    trials = []
+    for _ in range(ec.max_local_iter):
+        if ec.next_iter >= ec.max_iter:
+            break
+        next_trial = ec.get_next_suggestion()
+        trials.append(np.asarray(next_trial).tolist())
+        ec.update_design(np.asarray(next_trial), [float(np.random.rand())])
+    return trials
+
+
+@pytest.mark.parametrize('discrete_fast_path', [True, False])
+def test_concurrent_workers_get_distinct_trials(study_config, discrete_fast_path):
+    # Test that workers whose fits overlap are never handed the same trial
+    import multiprocessing
+    config_path = study_config('study', num_warm_up=8, max_iter=14, max_local_iter=5, discrete_fast_path=discrete_fast_path)
+    ExperimentController(config_path)
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        trials = sum(pool.map(run_worker, [config_path] * 4), [])
+    assert len(trials) >= 14
+    assert len(set(map(tuple, trials))) == len(trials)
+
+
+def test_give_back(ec):
+    # Test that a trial given back leaves the pending list, and its iteration is handed out again
+    ec._set_val('pending', [])
+    ec._set_val('released', [])
+    ec._set_val('next_iter', 0)
+    trial = ec.get_next_suggestion()
+    ec.give_back([trial])
+    raster = ec.col.find_one()
+    assert raster['pending'] == [] and raster['released'] == [0]
+    assert list(ec.get_next_suggestion()) == list(trial)
+    assert ec.col.find_one()['next_iter'] == 1
@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+from ml_experiments.base import BaseReader
+from ml_experiments.designs import warm_up_design, WARM_UP_DESIGNS
+
+
+@pytest.fixture(scope='module')
+def bounds():
+    br = BaseReader()
+    br.get_config('./demo/demo_config.yaml')
+    return br.bounds
+
+
+@pytest.mark.parametrize('strategy', list(WARM_UP_DESIGNS.keys()) + ['unique'])
+def test_warm_up_design(bounds, strategy):
+    # Check the shape, that every value is in its domain, and that no row repeats
+    warm_up_array = warm_up_design(bounds, 50, strategy, seed=0)
+    assert np.shape(warm_up_array) == (50, len(bounds))
+    for j, b in enumerate(bounds):
+        assert set(warm_up_array[:, j]) <= set(b['domain'])
+    assert len(np.unique(warm_up_array, axis=0)) == 50
+
+
+@pytest.mark.parametrize('strategy', ['random', 'unique'])
+def test_warm_up_design_exhausts_domain(bounds, strategy):
+    # Check that a table as large as the domain covers every combination exactly once
+    num_combinations = int(np.prod([len(b['domain']) for b in bounds]))
+    warm_up_array = warm_up_design(bounds, num_combinations, strategy, seed=0)
+    assert len(np.unique(warm_up_array, axis=0)) == num_combinations
+
+    # A table larger than the domain still covers every combination
+    warm_up_array = warm_up_design(bounds, num_combinations + 10, strategy, seed=0)
+    assert len(np.unique(warm_up_array, axis=0)) == num_combinations
+
+
+def test_warm_up_design_continuous(bounds):
+    # Check that continuous hyperparameters are sampled within their range
+    bounds = bounds[:2] + [{'name' : 'momentum', 'type' : 'continuous', 'domain' : (0.5, 0.9)}]
+    warm_up_array = warm_up_design(bounds, 20, 'latin', seed=0)
+    assert np.all((warm_up_array[:, 2] >= 0.5) & (warm_up_array[:, 2] <= 0.9))
+    assert len(np.unique(warm_up_array[:, 2])) == 20
+
+
+def test_sobol_any_size():
+    # Check that Sobol tables of any size are drawn without scipy's balance warning
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for num_samples in [1, 7, 50]:
+            assert np.shape(WARM_UP_DESIGNS['sobol'](num_samples, 3, np.random.default_rng(0))) == (num_samples, 3)
+
+
+def test_candidate_grid():
+    from ml_experiments.designs import CandidateGrid
+    bounds = [{'name' : 'a', 'type' : 'discrete', 'domain' : (0.005, 0.001)},
+              {'name' : 'b', 'type' : 'discrete', 'domain' : (1, 2, 3)},
+              {'name' : 'c', 'type' : 'discrete', 'domain' : (0, 0.1, 0.2, 0.3)}]
+    grid = CandidateGrid(bounds)
+    assert grid.size == 24
+    rows = grid.rows(0, grid.size)
+    assert len(np.unique(rows, axis=0)) == 24
+
+    # Test that rows map back to their flat indices, and rows off the grid are left out
+    assert (grid.flat_indices(rows[[3, 17]]) == [3, 17]).all()
+    assert len(grid.flat_indices([[0.5, 1, 0]])) == 0
+    assert (grid.take([3, 17]) == rows[[3, 17]]).all()
+
+    # Test that an uncached grid is built chunk by chunk with the same rows
+    uncached = CandidateGrid(bounds, max_cached=0)
+    chunks = np.concatenate([r for start, r in uncached.chunks(5)])
+    assert (chunks == rows).all()
@@ -0,0 +1,46 @@
+import numpy as np
+from ml_experiments.encoding import encode_row, decode_rows, encode_matrix, decode_matrix
+
+# Both configs share one design, so the binary controller migrates the design written by the list one
+SETTINGS = {'controller_collection' : 'test_design', 'num_warm_up' : 3, 'max_iter' : 20, 'max_local_iter' : 5}
+
+
+def test_round_trip():
+    rows = [encode_row([0.1, 0.2, 0.3], 'binary'), [0.4, 0.5, 0.6]]
+    assert isinstance(rows[0], bytes) and len(rows[0]) == 24
+    decoded = decode_rows(rows)
+    assert np.array(decoded).tolist() == [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]
+    assert decoded[0].flags.writeable == False
+
+    warm_up = np.random.rand(4, 3)
+    assert (decode_matrix(encode_matrix(warm_up, 'binary')) == warm_up).all()
+    assert decode_matrix(encode_matrix(warm_up, 'list')) == warm_up.tolist()
+
+
+def test_migrate_design(study_config):
+    # Test that a design written as lists is migrated in place, and reads the same from either encoding
+    from ml_experiments.controller import ExperimentController
+    ec = ExperimentController(study_config('study_list', design_encoding='list', **SETTINGS))
+    num_hyperparameters = len(ec.bounds)
+    for _ in range(ec.num_warm_up):
+        ec.update_design(np.random.rand(num_hyperparameters), [float(np.random.rand())])
+    ec._set_val('next_iter', ec.num_warm_up)
+
+    # A controller configured for another encoding follows the stored one, unless it's asked to migrate
+    other = ExperimentController(study_config('study_other', design_encoding='binary', **SETTINGS))
+    assert other.design_encoding == 'list' and other.col.find_one()['encoding'] == 'list'
+    binary = ExperimentController(study_config('study_binary', design_encoding='binary', migrate_design=True, **SETTINGS))
+    raster = binary.col.find_one()
+    assert raster['encoding'] == 'binary'
+    assert all(isinstance(x, bytes) for x in raster['X_steps'])
+    assert np.array(binary.X_steps).tolist() == ec.X_steps
+    assert (binary.warm_up_list == np.array(ec.warm_up_list)).all()
+
+    # Controllers on the old encoding switch to the migrated one, and nothing migrates it back
+    binary.update_design(np.random.rand(num_hyperparameters), [0.5])
+    ec._get_design()
+    assert len(ec.X_steps) == ec.num_warm_up + 1
+    assert ec.design_encoding == 'binary'
+    ExperimentController(study_config('study_list_again', design_encoding='list', **SETTINGS))
+    assert binary.col.find_one()['encoding'] == 'binary'
+    assert np.shape(binary.get_next_suggestion()) == (num_hyperparameters,)
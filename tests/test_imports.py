@@ -0,0 +1,22 @@
+import sys
+import json
+import subprocess
+
+
+def imported_heavy_modules(statement):
+    script = '{}\nimport sys, json\nprint(json.dumps([m for m in ["tensorflow", "GPy", "GPyOpt"] if m in sys.modules]))'.format(statement)
+    output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_lazy_package():
+    # Importing the package and its framework free classes doesn't pull in tensorflow or GPy
+    assert imported_heavy_modules('import ml_experiments') == []
+    assert imported_heavy_modules('from ml_experiments import BaseReader, ExperimentController, ExperimentRecorder') == []
+
+
+def test_lazy_exports():
+    import ml_experiments
+    from ml_experiments.controller import ExperimentController
+    assert ml_experiments.ExperimentController is ExperimentController
+    assert 'ExperimentController' in dir(ml_experiments)
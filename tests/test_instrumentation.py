@@ -0,0 +1,29 @@
+import logging
+from ml_experiments.instrumentation import Instrumentation
+
+
+def test_disabled():
+    # Test that nothing is timed or reported while instrumentation is off
+    instrumentation = Instrumentation('controller')
+    with instrumentation.phase('fit'):
+        pass
+    assert instrumentation.metrics is None
+    assert instrumentation.phase('fit') is instrumentation.phase('acquisition')
+
+
+def test_hooks_and_metrics(caplog):
+    instrumentation = Instrumentation('controller', metrics=True)
+    timings = []
+    instrumentation.add_hook(lambda component, phase, seconds: timings.append((component, phase)))
+
+    with caplog.at_level(logging.DEBUG, logger='ml_experiments.timing'):
+        for _ in range(3):
+            with instrumentation.phase('fit'):
+                pass
+    assert timings == [('controller', 'fit')] * 3
+    assert 'controller fit' in caplog.text
+
+    metrics = instrumentation.metrics.snapshot()
+    assert metrics['fit']['count'] == 3
+    assert sum(count for bound, count in metrics['fit']['histogram']) == 3
+    assert 'ml_experiments_phase_seconds_count{component="controller",phase="fit"} 3' in instrumentation.metrics.prometheus('controller')
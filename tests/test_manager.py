@@ -1,86 +1,190 @@
-import pytest
-import numpy as np
-import pandas as pd
-import pkg_resources
-from ml_experiments.manager import ExperimentNamer, ExperimentRecorder
-
-en = ExperimentNamer()
-
-def test_get_used_names():
-    test_df = pd.DataFrame()
-    en.get_used_names(test_df)
-    assert en.used_names == [], 'Used names initalized incorrectly'
-
-    test_df = pd.DataFrame({'experiment_name' : ['einstein', 'hooke'], 'random_experiment_value' : [123, 456]})
-    en.get_used_names(test_df)
-    assert len(en.used_names) == 2, 'Used names initalized incorrectly'
-
-
-def test_get_unused_names():
-    test_df = pd.DataFrame({'experiment_name' : ['einstein', 'hooke'], 'random_experiment_value' : [123, 456]})
-    en.get_used_names(test_df)
-    en.get_unused_names()
-    assert len(en.unused_names) == len(en.name_pool) - 2
-
-
-def test_get_random_unused_name():
-    test_df = pd.DataFrame({'experiment_name' : ['einstein', 'hooke'], 'random_experiment_value' : [123, 456]})
-    en.get_used_names(test_df)
-    en.get_unused_names()
-    random_name = en.get_random_unused_name()
-    assert random_name not in en.unused_names
-    assert len(en.unused_names) == len(en.name_pool) - 3
-
-
-
-filepath = './demo/demo_config.yaml'
-er = ExperimentRecorder(filepath)
-
-def test_init():
-    assert er.experiment['experiment_name'] in er.name_pool
-    assert er.record_metrics == True, 'train_metric_name did not evaluate correctly'
-    assert er.train_metric_name == er.experiment['train_metric_name']
-    
-def test_on_epoch_begin():
-    # Test that there is no database record
-    er.on_epoch_begin(epoch=1)
-    with pytest.raises(AssertionError):
-        assert hasattr(er, 'entry_id')
-    
-    # Test that there is a database record
-    er.on_epoch_begin(epoch=er.start_recording)
-    assert hasattr(er, 'entry_id')
-    
-def test_create_experiment_entry():
-    er.create_experiment_entry()
-    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
-    assert entry['experiment_name'] == er.experiment['experiment_name']
-
-
-def test_update_experiment_results():
-    results = {'loss' : [0.6, 0.5, 0.4], 'val_loss' : [0.7, 0.6, 0.5]}
-    
-    # Check that the results don't exist in the database entry
-    with pytest.raises(AssertionError):
-        entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
-        assert 'loss' in list(entry.keys())
-    
-    # Insert the results
-    er.update_experiment_results(results)
-    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
-    
-    # Check that the results now exist in the database entry
-    assert entry['loss'] == [0.6, 0.5, 0.4]
-    assert entry['val_loss'] == [0.7, 0.6, 0.5]
-
-
-def test_on_epoch_end():
-    logs = {'loss' : 0.5, 'val_loss' : 0.6}
-    er.on_epoch_end(1, logs)
-    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
-    assert entry['loss'] ==  [0.6, 0.5, 0.4]
-
-    er.loss = [0.6, 0.5, 0.4]
-    er.on_epoch_end(er.start_recording, logs)
-    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
-    assert entry['loss'] ==  [0.6, 0.5, 0.4, 0.5]
\ No newline at end of file
+import pytest
+import numpy as np
+import pandas as pd
+import pkg_resources
+from ml_experiments.manager import ExperimentNamer, ExperimentRecorder
+
+en = ExperimentNamer()
+
+def test_get_used_names():
+    en.get_used_names([])
+    assert en.used_names == set(), 'Used names initalized incorrectly'
+
+    en.get_used_names(['einstein', 'hooke'])
+    assert len(en.used_names) == 2, 'Used names initalized incorrectly'
+
+
+def test_get_unused_names():
+    en.get_used_names(['einstein', 'hooke'])
+    en.get_unused_names()
+    assert en.generation == 0
+    assert en.num_unused_names() == len(en.name_pool) - 2
+
+
+def test_get_random_unused_name():
+    en.get_used_names(['einstein', 'hooke'])
+    en.get_unused_names()
+    random_name = en.get_random_unused_name()
+    assert random_name in en.name_pool and random_name in en.used_names
+    assert en.num_unused_names() == len(en.name_pool) - 3
+
+
+
+@pytest.fixture(scope='module')
+def er(demo_config):
+    return ExperimentRecorder(demo_config)
+
+
+def test_init(er):
+    assert er.experiment['experiment_name'] in er.name_pool
+    assert er.record_metrics == True, 'train_metric_name did not evaluate correctly'
+    assert er.train_metric_name == er.experiment['train_metric_name']
+    
+def test_on_epoch_begin(er):
+    # Test that there is no database record
+    er.on_epoch_begin(epoch=1)
+    with pytest.raises(AssertionError):
+        assert hasattr(er, 'entry_id')
+    
+    # Test that there is a database record
+    er.on_epoch_begin(epoch=er.start_recording)
+    assert hasattr(er, 'entry_id')
+    
+def test_create_experiment_entry(er):
+    er.create_experiment_entry()
+    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
+    assert entry['experiment_name'] == er.experiment['experiment_name']
+
+
+def test_update_experiment_results(er):
+    results = {'loss' : [0.6, 0.5, 0.4], 'val_loss' : [0.7, 0.6, 0.5]}
+    
+    # Check that the results don't exist in the database entry
+    with pytest.raises(AssertionError):
+        entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
+        assert 'loss' in list(entry.keys())
+    
+    # Insert the results
+    er.update_experiment_results(results)
+    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
+    
+    # Check that the results now exist in the database entry
+    assert entry['loss'] == [0.6, 0.5, 0.4]
+    assert entry['val_loss'] == [0.7, 0.6, 0.5]
+
+
+def test_on_epoch_end(er):
+    logs = {'loss' : 0.5, 'val_loss' : 0.6}
+    er.on_epoch_end(1, logs)
+    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
+    assert entry['loss'] ==  [0.6, 0.5, 0.4]
+
+    er.loss = [0.6, 0.5, 0.4]
+    er.on_epoch_end(er.start_recording, logs)
+    entry = er.db.col.find_one({'_id' : er.entry_id.inserted_id})
+    assert entry['loss'] ==  [0.6, 0.5, 0.4, 0.5]
+
+def test_previous_names(er, demo_config):
+    # Test that names reserved by previous experiments are discovered on construction
+    er.names_col.insert_one({'_id' : 'curie_9'})
+    recorder = ExperimentRecorder(demo_config)
+    assert 'curie_9' in recorder.used_names
+    assert recorder.experiment['experiment_name'] != 'curie_9'
+
+
+def test_unreserved_names(study_config):
+    # Test that the names of experiments recorded before names were reserved are reserved once
+    from ml_experiments import manager
+    config = study_config()
+    recorder = ExperimentRecorder(config)
+    recorder.names_col.drop()
+    recorder.col.insert_one({'experiment_name' : 'curie_9', 'loss' : [0.1]*1000})
+    manager._SET_UP_COLLECTIONS.clear()
+    recorder = ExperimentRecorder(config)
+    assert 'curie_9' in recorder.used_names
+    assert recorder.names_col.count_documents({}) == 2
+
+
+def test_unused_names_generations():
+    # Test that once the pool is used up, the next suffix generation is offered in full
+    en.get_used_names(list(en.name_pool))
+    en.get_unused_names()
+    assert en.num_unused_names() == len(en.name_pool)
+    assert en.get_random_unused_name().endswith('_0')
+
+    en.get_used_names(list(en.name_pool) + [name + '_0' for name in en.name_pool] + ['einstein_1'])
+    en.get_unused_names()
+    assert en.num_unused_names() == len(en.name_pool) - 1
+    assert all(en.get_random_unused_name().endswith('_1') for _ in range(len(en.name_pool) - 1))
+    assert en.get_random_unused_name().endswith('_2')
+
+
+def test_reserve_name(er):
+    # Test that a name reserved elsewhere is never handed out again
+    en.get_used_names([])
+    en.get_unused_names()
+    er.names_col.drop()
+    for name in en.name_pool[1:]:
+        er.names_col.insert_one({'_id' : name})
+    assert en.reserve_name(er.names_col) == en.name_pool[0]
+    assert er.names_col.count_documents({}) == len(en.name_pool)
+
+
+def test_on_epoch_end_appends(demo_config):
+    # Test that each epoch only appends its own values, and the first recorded epoch catches up on the earlier ones
+    recorder = ExperimentRecorder(demo_config)
+    losses = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2]
+    for epoch, loss in enumerate(losses):
+        recorder.on_epoch_begin(epoch)
+        recorder.on_epoch_end(epoch, {'loss' : loss, 'val_loss' : loss + 0.1})
+        if epoch >= recorder.start_recording:
+            entry = recorder.col.find_one({'_id' : recorder.entry_id.inserted_id})
+            assert entry['loss'] == losses[:epoch + 1]
+            assert recorder.num_recorded == epoch + 1
+
+
+def test_async_recording(demo_config):
+    # Test that queued results reach mongo once training ends
+    from ml_experiments.writer import AsyncWriter
+    recorder = ExperimentRecorder(demo_config)
+    recorder.writer = AsyncWriter(recorder.col, flush_interval=60)
+    losses = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2]
+    for epoch, loss in enumerate(losses):
+        recorder.on_epoch_begin(epoch)
+        recorder.on_epoch_end(epoch, {'loss' : loss, 'val_loss' : loss + 0.1})
+    recorder.on_train_end()
+    entry = recorder.col.find_one({'_id' : recorder.entry_id.inserted_id})
+    assert entry['loss'] == losses
+    # The writer thread doesn't outlive the training
+    assert not recorder.writer._thread.is_alive()
+
+
+def test_early_stopping(demo_config):
+    # Test that an experiment behind its peers is stopped, and still reports its best value so far
+    from ml_experiments.stopping import MedianStoppingRule
+    recorder = ExperimentRecorder(demo_config)
+    recorder.stopping_rule = MedianStoppingRule(grace_period=2, min_peers=1)
+    recorder.experiment['trial_name'] = 'early_stopping'
+    recorder.col.insert_one({'trial_name' : recorder.experiment['trial_name'],
+                             'experiment_name' : 'peer',
+                             'val_loss' : [0.5, 0.3, 0.2, 0.1]})
+    losses = [0.9, 0.8, 0.7, 0.6]
+    for epoch, loss in enumerate(losses):
+        recorder.on_epoch_begin(epoch)
+        recorder.on_epoch_end(epoch, {'loss' : loss, 'val_loss' : loss})
+        if recorder.stop_training:
+            break
+    assert recorder.stopped_epoch == 2
+    assert recorder.get_objective() == [0.7]
+
+
+def test_early_stopping_without_study(demo_config):
+    # Test that an experiment that isn't part of a named study trains on
+    from ml_experiments.stopping import MedianStoppingRule
+    recorder = ExperimentRecorder(demo_config)
+    recorder.stopping_rule = MedianStoppingRule(grace_period=0, min_peers=0)
+    recorder.experiment.pop('trial_name')
+    for epoch in range(3):
+        recorder.on_epoch_begin(epoch)
+        recorder.on_epoch_end(epoch, {'loss' : 1., 'val_loss' : 1.})
+    assert not recorder.stop_training
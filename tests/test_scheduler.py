@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+from ml_experiments.scheduler import StudyScheduler
+
+SETTINGS = {'num_warm_up' : 3, 'max_iter' : 20, 'max_local_iter' : 5}
+
+
+def cached(key):
+    ''' Whether the fit process this runs in holds the surrogate of a study. '''
+    from ml_experiments.controller import _surrogate_cache
+    return key in _surrogate_cache
+
+
+def test_apportion(study_config):
+    scheduler = StudyScheduler([study_config('study_a', **SETTINGS), study_config('study_b', **SETTINGS), study_config('study_c', **dict(SETTINGS, max_iter=1))],
+                               priorities={'study_a' : 3}, num_processes=0)
+    # Shares follow the priorities, but no study is given more than its remaining iterations
+    assert scheduler.apportion(9) == {'study_a' : 6, 'study_b' : 2, 'study_c' : 1}
+    assert scheduler.apportion(100) == {'study_a' : 20, 'study_b' : 20, 'study_c' : 1}
+
+    # Test that the studies share one client
+    assert scheduler.studies['study_a'].db.client is scheduler.studies['study_b'].db.client
+
+
+@pytest.mark.parametrize('num_processes', [0, 2])
+def test_get_next_suggestions(study_config, num_processes):
+    scheduler = StudyScheduler([study_config('study_a', **SETTINGS), study_config('study_b', **SETTINGS)], num_processes=num_processes)
+
+    # Finish the warm up of both studies
+    for name, next_trials in scheduler.get_next_suggestions(6).items():
+        for next_trial in next_trials:
+            scheduler.update_design(name, next_trial, [float(np.random.rand())])
+
+    # Test that the bayesian trials of both studies are fit, and recorded as pending in their own design
+    next_trials = scheduler.get_next_suggestions(4)
+    assert sorted(next_trials.keys()) == ['study_a', 'study_b']
+    for name, trials in next_trials.items():
+        assert np.shape(trials) == (2, len(scheduler.studies[name].bounds))
+        assert len(scheduler.studies[name].col.find_one()['pending']) == 2
+
+    # Test that each study's surrogate stays in its own fit process for the next fit
+    for name, controller in scheduler.studies.items():
+        if num_processes > 0:
+            assert scheduler.pools[scheduler._fit_process[name]].submit(cached, controller._study_key()).result()
+    assert scheduler._fit_process in [{}, {'study_a' : 0, 'study_b' : 1}]
+    scheduler.close()
+
+
+def test_failed_fit(study_config):
+    # Test that a study whose fit fails gives its iterations back, and the other studies are still served
+    scheduler = StudyScheduler([study_config('study_a', **SETTINGS), study_config('study_b', **SETTINGS)], num_processes=0)
+    for name, next_trials in scheduler.get_next_suggestions(6).items():
+        for next_trial in next_trials:
+            scheduler.update_design(name, next_trial, [float(np.random.rand())])
+
+    def fail(*args, **kwargs):
+        raise ValueError('fit failed')
+    scheduler.studies['study_b']._suggest_locations = fail
+    next_trials = scheduler.get_next_suggestions(4)
+    assert list(next_trials.keys()) == ['study_a']
+    assert scheduler.studies['study_b'].col.find_one()['released'] == [3, 4]
+    assert scheduler.apportion(100)['study_b'] == SETTINGS['max_iter'] - 3
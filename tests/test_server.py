@@ -0,0 +1,219 @@
+import time
+import asyncio
+import threading
+import pytest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from ml_experiments.server import SuggestionServer, SuggestionClient
+
+
+class StubController:
+    ''' Stands in for an ExperimentController, records how suggestions were batched. '''
+
+    def __init__(self):
+        self.max_iter = 75
+        self.max_local_iter = 5
+        self.hyperparameter_names = ['learning_rate', 'dropout']
+        self.next_iter = 0
+        self.lease_duration = None
+        self.batches = []
+        self.renewed = []
+        self.given_back = []
+        self.fit_time = 0.2
+        self.X_steps = []
+        self.Y_steps = []
+
+    def get_next_suggestions(self, num_suggestions):
+        # Slow enough that concurrent requests pile up behind the first fit
+        time.sleep(self.fit_time)
+        self.batches.append(num_suggestions)
+        next_trials = np.arange(self.next_iter, self.next_iter + num_suggestions)[:, None] * np.ones((1, 2))
+        self.next_iter += num_suggestions
+        return next_trials
+
+    def update_design(self, x_step, y_step):
+        self.X_steps.append(list(x_step))
+        self.Y_steps.append(y_step)
+
+    def renew_leases(self, trials):
+        self.renewed.append(trials)
+
+    def give_back(self, trials):
+        self.given_back.extend(np.asarray(trials).tolist())
+
+
+@pytest.fixture
+def serve():
+    ''' Start servers on background event loops, and stop the servers, their loops and threads after the test. '''
+    running = []
+
+    def start(controller, **kwargs):
+        server = SuggestionServer(controller, **kwargs)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        running.append((server, loop, thread))
+        return server
+
+    yield start
+    for server, loop, thread in running:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_get_next_suggestion(serve):
+    controller = StubController()
+    server = serve(controller)
+    client = SuggestionClient(port=server.port)
+    assert client.max_iter == controller.max_iter
+    assert client.hyperparameter_names == controller.hyperparameter_names
+
+    next_trial = client.get_next_suggestion()
+    assert np.shape(next_trial) == (2,)
+    assert client.next_iter == 1
+
+    next_trials = client.get_next_suggestions(3)
+    assert np.shape(next_trials) == (3, 2)
+    assert client.next_iter == 4
+    assert controller.batches == [1, 3]
+    client.close()
+
+
+def test_update_design(serve):
+    controller = StubController()
+    server = serve(controller)
+    client = SuggestionClient(port=server.port)
+    client.update_design(np.array([0.1, 0.2]), [0.5])
+    assert controller.X_steps == [[0.1, 0.2]]
+    assert controller.Y_steps == [[0.5]]
+
+    # Test that input fails without y_step being a list
+    with pytest.raises(AssertionError):
+        client.update_design(np.array([0.1, 0.2]), 0.5)
+    client.close()
+
+
+def test_heartbeat(serve):
+    # Test that a worker renews the leases of its own trials until it reports them
+    controller = StubController()
+    controller.lease_duration = 60
+    server = serve(controller)
+    client = SuggestionClient(port=server.port)
+    next_trial = client.get_next_suggestion()
+    client.heartbeat()
+    assert controller.renewed == [[next_trial.tolist()]]
+
+    # Renewals closer together than a quarter of the lease are skipped
+    client.heartbeat()
+    assert len(controller.renewed) == 1
+
+    client.update_design(next_trial, [0.5])
+    client._last_heartbeat = 0.
+    client.heartbeat()
+    assert len(controller.renewed) == 1
+    client.close()
+
+
+def test_updates_during_fit(serve):
+    # Test that heartbeats and results are answered while a fit runs, rather than after it
+    controller = StubController()
+    controller.fit_time = 2.
+    controller.lease_duration = 60
+    server = serve(controller)
+    client = SuggestionClient(port=server.port)
+    client._in_flight = [[0.1, 0.2]]
+
+    fitting = SuggestionClient(port=server.port)
+    thread = threading.Thread(target=fitting.get_next_suggestion)
+    thread.start()
+    time.sleep(0.2)
+    start = time.time()
+    client.heartbeat()
+    client.update_design(np.array([0.1, 0.2]), [0.5])
+    assert time.time() - start < 1.
+    assert controller.renewed == [[[0.1, 0.2]]] and controller.Y_steps == [[0.5]]
+    thread.join()
+    client.close()
+    fitting.close()
+
+
+def test_disconnect_gives_back_trials(serve):
+    # Test that the trials suggested for a worker that disconnected while it waited are given back
+    import socket
+    controller = StubController()
+    server = serve(controller)
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    sock.sendall(b'{"method" : "get_next_suggestion"}\n')
+    time.sleep(0.05)
+    sock.close()
+
+    deadline = time.time() + 5
+    while not controller.given_back and time.time() < deadline:
+        time.sleep(0.05)
+    assert controller.batches == [1]
+    assert controller.given_back == [[0., 0.]]
+
+
+def test_coalesced_suggestions(serve):
+    # Test that concurrent workers are served by fewer fits than requests, without duplicates
+    controller = StubController()
+    server = serve(controller)
+    num_workers = 8
+
+    def worker(_):
+        client = SuggestionClient(port=server.port)
+        next_trial = client.get_next_suggestion()
+        client.close()
+        return next_trial[0]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        next_trials = list(pool.map(worker, range(num_workers)))
+
+    assert sorted(next_trials) == list(range(num_workers))
+    assert sum(controller.batches) == num_workers
+    assert len(controller.batches) < num_workers
+
+
+def test_unix_socket(serve, tmp_path):
+    controller = StubController()
+    server = serve(controller, path=str(tmp_path / 'suggestions.sock'))
+
+    client = SuggestionClient(path=server.path)
+    assert np.shape(client.get_next_suggestion()) == (2,)
+    client.close()
+
+
+def test_cancelled_request():
+    # Test that a request cancelled while the fit runs doesn't stop the others from being served
+    controller = StubController()
+    server = SuggestionServer(controller)
+    loop = asyncio.new_event_loop()
+
+    async def cancel_first():
+        first = asyncio.ensure_future(server._queue_suggestions(1))
+        second = asyncio.ensure_future(server._queue_suggestions(2))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        return await asyncio.wait_for(second, timeout=5)
+
+    # The cancelled request's trial is given back
+    assert len(loop.run_until_complete(cancel_first())) == 2
+    assert controller.batches == [3]
+    assert controller.given_back == [[0., 0.]]
+
+    # A request cancelled before the fit starts isn't suggested for
+    async def cancel_queued():
+        first = asyncio.ensure_future(server._queue_suggestions(1))
+        second = asyncio.ensure_future(server._queue_suggestions(2))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await asyncio.wait_for(second, timeout=5)
+
+    assert len(loop.run_until_complete(cancel_queued())) == 2
+    assert controller.batches == [3, 2]
+    server._executor.shutdown(wait=True)
+    server._update_executor.shutdown(wait=True)
+    loop.close()
@@ -0,0 +1,29 @@
+from ml_experiments.stopping import MedianStoppingRule, ASHA, early_stopping_rule
+
+peer_curves = [[0.9, 0.5, 0.3, 0.2], [0.8, 0.6, 0.4, 0.3], [0.9, 0.7, 0.5], [0.7]]
+
+
+def test_median_stopping_rule():
+    rule = MedianStoppingRule(grace_period=1, min_peers=3)
+    # Not stopped during the grace period
+    assert rule.should_stop(0, [5.], peer_curves) == False
+    # Stopped when behind the median of the peers that reached the epoch
+    assert rule.should_stop(2, [0.9, 0.8, 0.7], peer_curves) == True
+    assert rule.should_stop(2, [0.9, 0.5, 0.3], peer_curves) == False
+    # Not stopped when too few peers reached the epoch
+    assert rule.should_stop(3, [0.9, 0.8, 0.7, 0.6], peer_curves) == False
+
+
+def test_asha():
+    rule = ASHA(grace_period=1, reduction_factor=2, min_peers=2)
+    # Rungs are at epochs 1, 2, 4, 8, ... counting from 1
+    assert [e for e in range(10) if rule.checks(e)] == [0, 1, 3, 7]
+    assert rule.should_stop(1, [0.9, 0.8], peer_curves) == True
+    assert rule.should_stop(1, [0.9, 0.4], peer_curves) == False
+    assert rule.should_stop(2, [0.9, 0.8, 0.7], peer_curves) == False
+
+
+def test_early_stopping_rule():
+    assert early_stopping_rule({}) is None
+    rule = early_stopping_rule({'early_stopping' : 'asha', 'grace_period' : 2, 'reduction_factor' : 4})
+    assert rule.grace_period == 2 and rule.reduction_factor == 4
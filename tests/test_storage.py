@@ -0,0 +1,110 @@
+import pytest
+import numpy as np
+from multiprocessing import Pool
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from ml_experiments.storage import LocalClient, bulk_write
+from ml_experiments.base import BaseConnection
+
+
+def test_insert_and_find(tmp_path):
+    col = LocalClient(str(tmp_path / 'store.db'))['test_databases']['test_collection']
+    inserted_id = col.insert_one({'name' : 'einstein', 'results' : {'loss' : [0.5]}}).inserted_id
+    assert col.find_one()['_id'] == inserted_id
+    assert col.find_one({'results.loss' : 0.5})['name'] == 'einstein'
+    assert col.find_one({'name' : 'curie'}) is None
+    assert col.find_one({}, {'name' : True}) == {'_id' : inserted_id, 'name' : 'einstein'}
+
+    # Test that _id is unique
+    col.insert_one({'_id' : 'einstein'})
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({'_id' : 'einstein'})
+    assert col.estimated_document_count() == 2
+    assert col.distinct('name') == ['einstein']
+
+
+def test_update_operators(tmp_path):
+    col = LocalClient(str(tmp_path / 'store.db'))['test_databases']['test_collection']
+    col.insert_one({'_id' : 0, 'next_iter' : 0, 'X_steps' : [], 'pending' : [{'iter' : 0, 'x' : [1.]}]})
+
+    raster = col.find_one_and_update({'_id' : 0}, {'$inc' : {'next_iter' : 2}}, projection={'next_iter' : True},
+                                     return_document=ReturnDocument.AFTER)
+    assert raster == {'_id' : 0, 'next_iter' : 2}
+
+    col.update_one({'_id' : 0}, {'$push' : {'X_steps' : {'$each' : [[1.], [2.]]}}, '$pull' : {'pending' : {'iter' : 0}}})
+    raster = col.find_one()
+    assert raster['X_steps'] == [[1.], [2.]]
+    assert raster['pending'] == []
+
+    bulk_write(col, [('insert_one', {'_id' : 1}), ('update_one', {'_id' : 1}, {'$set' : {'results.loss' : 0.1}})])
+    assert col.find_one({'_id' : 1})['results'] == {'loss' : 0.1}
+
+    # An ordered bulk write keeps the requests before a failure, an unordered one also the requests after it
+    requests = [('update_one', {'_id' : 1}, {'$set' : {'lr' : 0.1}}), ('insert_one', {'_id' : 1}),
+                ('update_one', {'_id' : 1}, {'$set' : {'epochs' : 10}})]
+    with pytest.raises(BulkWriteError) as error:
+        bulk_write(col, requests)
+    assert error.value.details['writeErrors'][0]['index'] == 1
+    assert 'lr' in col.find_one({'_id' : 1}) and 'epochs' not in col.find_one({'_id' : 1})
+    with pytest.raises(BulkWriteError):
+        bulk_write(col, requests, ordered=False)
+    assert col.find_one({'_id' : 1})['epochs'] == 10
+
+    # Updates that leave a document as it was don't count as modified
+    assert col.update_one({'_id' : 1}, {'$set' : {'epochs' : 10}}).modified_count == 0
+    assert col.update_one({'_id' : 1}, {'$set' : {'epochs' : 11}}).modified_count == 1
+
+    col.update_one({'_id' : 2}, {'$set' : {'next_iter' : 5}}, upsert=True)
+    assert col.count_documents({'next_iter' : {'$gte' : 2}}) == 2
+
+    # The positional $ updates the array element matched by the query
+    col.update_one({'_id' : 0}, {'$push' : {'pending' : {'$each' : [{'iter' : 1, 'lease' : 1.}, {'iter' : 2, 'lease' : 1.}]}}})
+    col.update_one({'_id' : 0, 'pending' : {'$elemMatch' : {'iter' : 2, 'lease' : 1.}}}, {'$set' : {'pending.$.lease' : 5.}})
+    col.update_one({'_id' : 0, 'pending.iter' : 1}, {'$set' : {'pending.$.lease' : 3.}})
+    assert col.find_one({'_id' : 0})['pending'] == [{'iter' : 1, 'lease' : 3.}, {'iter' : 2, 'lease' : 5.}]
+
+
+def test_slice_projection(tmp_path):
+    col = LocalClient(str(tmp_path / 'store.db'))['test_databases']['test_collection']
+    col.insert_one({'_id' : 0, 'next_iter' : 4, 'X_steps' : [[1.], [2.], [3.], [4.]], 'warm_up_list' : [[0.]]})
+
+    # Sliced arrays are included alongside the other included fields
+    raster = col.find_one({'_id' : 0}, projection={'next_iter' : True, 'X_steps' : {'$slice' : [1, 2]}})
+    assert raster == {'_id' : 0, 'next_iter' : 4, 'X_steps' : [[2.], [3.]]}
+    assert col.find_one({}, {'X_steps' : {'$slice' : [3, 100]}, 'next_iter' : True})['X_steps'] == [[4.]]
+
+    # On their own, sliced arrays are returned with every other field
+    raster = col.find_one({}, {'X_steps' : {'$slice' : -1}})
+    assert raster['X_steps'] == [[4.]] and raster['warm_up_list'] == [[0.]]
+    assert col.count_documents({'X_steps' : {'$size' : 4}}) == 1
+
+
+def tally(path):
+    col = LocalClient(path)['test_databases']['test_design']
+    return [col.find_one_and_update({'_id' : 0}, {'$inc' : {'next_iter' : 1}}, return_document=True)['next_iter']
+            for _ in range(20)]
+
+
+def test_atomic_across_processes(tmp_path):
+    # Test that concurrent processes never claim the same iteration
+    path = str(tmp_path / 'store.db')
+    LocalClient(path)['test_databases']['test_design'].insert_one({'_id' : 0, 'next_iter' : 0})
+    with Pool(4) as pool:
+        claimed = sum(pool.map(tally, [path] * 4), [])
+    assert sorted(claimed) == list(range(1, 81))
+
+
+def test_local_backend(tmp_path, study_config):
+    # Test that the controller runs without a mongo server, and only needs the database and collection keys
+    config_path = study_config('local_config', num_warm_up=3, max_iter=10, max_local_iter=5)
+
+    from ml_experiments.controller import ExperimentController
+    ec = ExperimentController(config_path)
+    next_trial = np.array(ec.get_next_suggestion())
+    ec.update_design(next_trial, [0.5])
+    assert ec.col.find_one()['X_steps'] == [next_trial.tolist()]
+
+    bc = BaseConnection()
+    bc.experiment = {'controller_backend' : 'local', 'controller_path' : str(tmp_path / 'store.db')}
+    with pytest.raises(AssertionError):
+        bc.establish_db_connection(prefix='controller')
@@ -0,0 +1,30 @@
+import numpy as np
+from ml_experiments.surrogates import select_observations, TreeModel
+
+
+bounds = [{'name' : 'learning_rate', 'type' : 'continuous', 'domain' : (0, 10)},
+          {'name' : 'dropout', 'type' : 'continuous', 'domain' : (0, 1)}]
+X = np.random.rand(50, 2) * [10, 1]
+Y = np.random.rand(50, 1)
+
+
+def test_select_observations():
+    # Test that the window keeps the most recent observations
+    X_window, Y_window = select_observations(X, Y, 'window', 10, bounds)
+    assert (X_window == X[-10:]).all()
+
+    # Test that the trust region keeps the best observation and its neighbours
+    X_region, Y_region = select_observations(X, Y, 'trust_region', 10, bounds)
+    assert len(X_region) == 10
+    assert Y_region.min() == Y.min()
+
+    # Test that the other surrogates use every observation
+    assert len(select_observations(X, Y, 'gp', 10, bounds)[0]) == 50
+
+
+def test_tree_model():
+    model = TreeModel('extra_trees', num_trees=10, random_state=0)
+    model.updateModel(X, Y, None, None)
+    m, s = model.predict(X[:5])
+    assert m.shape == s.shape == (5, 1)
+    assert model.get_fmin() <= Y.max()
@@ -0,0 +1,98 @@
+import pytest
+from pymongo.errors import AutoReconnect, OperationFailure
+from ml_experiments.writer import AsyncWriter, coalesce
+from ml_experiments.storage import LocalClient
+
+
+def test_coalesce_push():
+    # Consecutive appends to the same document become one append
+    writes = [('insert', {'_id' : 1}),
+              ('update', {'_id' : 1}, {'$push' : {'loss' : {'$each' : [0.5]}, 'val_loss' : {'$each' : [0.6]}}}),
+              ('update', {'_id' : 1}, {'$push' : {'loss' : {'$each' : [0.4]}, 'val_loss' : {'$each' : [0.5]}}})]
+    merged = coalesce(writes)
+    assert len(merged) == 2
+    assert merged[0] == writes[0]
+    assert merged[1][2] == {'$push' : {'loss' : {'$each' : [0.5, 0.4]}, 'val_loss' : {'$each' : [0.6, 0.5]}}}
+
+    # The queued updates themselves are left untouched
+    assert writes[1][2]['$push']['loss'] == {'$each' : [0.5]}
+
+
+def test_coalesce_set():
+    # Later $set values win
+    writes = [('update', {'_id' : 1}, {'$set' : {'loss' : [0.5], 'lr' : 0.1}}),
+              ('update', {'_id' : 1}, {'$set' : {'loss' : [0.5, 0.4]}})]
+    assert coalesce(writes) == [('update', {'_id' : 1}, {'$set' : {'loss' : [0.5, 0.4], 'lr' : 0.1}})]
+
+    # Values set by epoch merge, unless one field is nested in another
+    writes = [('update', {'_id' : 1}, {'$set' : {'loss.0' : 0.5}}),
+              ('update', {'_id' : 1}, {'$set' : {'loss.1' : 0.4}})]
+    assert coalesce(writes) == [('update', {'_id' : 1}, {'$set' : {'loss.0' : 0.5, 'loss.1' : 0.4}})]
+    writes = [('update', {'_id' : 1}, {'$set' : {'loss' : []}}),
+              ('update', {'_id' : 1}, {'$set' : {'loss.0' : 0.5}})]
+    assert coalesce(writes) == writes
+
+
+def test_coalesce_keeps_order():
+    # Updates to different documents, or with different operators, are not merged
+    writes = [('update', {'_id' : 1}, {'$push' : {'loss' : {'$each' : [0.5]}}}),
+              ('update', {'_id' : 2}, {'$push' : {'loss' : {'$each' : [0.4]}}}),
+              ('update', {'_id' : 2}, {'$set' : {'loss' : [0.3]}}),
+              ('update', {'_id' : 2}, {'$push' : {'loss' : 0.2}})]
+    assert coalesce(writes) == writes
+
+
+class FlakyCollection:
+    ''' Collection whose bulk writes fail with the given errors before going through. '''
+
+    def __init__(self, collection, errors):
+        self.collection = collection
+        self.errors = list(errors)
+        self.num_calls = 0
+
+    def bulk_write(self, requests, ordered=True):
+        self.num_calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+
+def test_rejected_write_is_dropped(tmp_path, caplog):
+    # Test that a write the database rejects is dropped on its own and logged, and the writes around it are kept
+    col = LocalClient(str(tmp_path / 'store.db'))['test_databases']['test_collection']
+    col.insert_one({'_id' : 1, 'loss' : []})
+    writer = AsyncWriter(col, flush_interval=60.)
+    writer.update_one({'_id' : 1}, {'$set' : {'loss.0' : 0.5}})
+    writer.insert_one({'_id' : 1})
+    writer.update_one({'_id' : 1}, {'$set' : {'loss.1' : 0.4}})
+    writer.insert_one({'_id' : 2})
+    with caplog.at_level('WARNING', logger='ml_experiments.writer'):
+        writer.close()
+    assert col.find_one({'_id' : 1})['loss'] == [0.5, 0.4]
+    assert col.find_one({'_id' : 2}) is not None
+    assert [r.getMessage().startswith('Dropping a write') for r in caplog.records] == [True]
+
+
+def test_retries(tmp_path):
+    # Test that connection errors are retried, and that resending applied writes doesn't repeat them
+    col = LocalClient(str(tmp_path / 'store.db'))['test_databases']['test_collection']
+    flaky = FlakyCollection(col, [AutoReconnect('connection reset')])
+    writer = AsyncWriter(flaky, flush_interval=60., backoff=0.)
+    writer.insert_one({'_id' : 1, 'loss' : []})
+    writer.flush()
+    flaky.errors = [AutoReconnect('connection reset')]
+    col.update_one({'_id' : 1}, {'$set' : {'loss.0' : 0.5}})
+    writer.update_one({'_id' : 1}, {'$set' : {'loss.0' : 0.5}})
+    writer.close()
+    assert col.find_one({'_id' : 1})['loss'] == [0.5]
+    assert flaky.num_calls == 4
+
+    # Other errors aren't retried, the writes are sent one at a time and only the failing one is dropped
+    flaky = FlakyCollection(col, [OperationFailure('bad write'), OperationFailure('bad write')])
+    writer = AsyncWriter(flaky, flush_interval=60., backoff=0.)
+    writer.update_one({'_id' : 1}, {'$set' : {'loss.1' : 0.4}})
+    writer.insert_one({'_id' : 2})
+    writer.close()
+    assert col.find_one({'_id' : 1})['loss'] == [0.5]
+    assert col.find_one({'_id' : 2}) is not None
+    assert flaky.num_calls == 3